@@ -186,6 +186,7 @@ def get_patch(origin: Text, target: Text):
         ]
         if target != "prod"
         else [],
+        "git_cache": None if target == "local" else "/var/cache/luh3417/git",
         "setup_queries": [
             f"update wp_options "
             f"set option_value = '{0 if target != 'prod' else 1}' "
@@ -235,6 +236,40 @@ def get_wp_config(environment: Text):
     }
 
 
+def get_snapshot_settings(environment: Text):
+    """
+    OPTIONAL
+
+    Generates the snapshot settings for the environment. Keys are the long
+    options of snapshot (see `python -m luh3417.snapshot --help`) with
+    underscores instead of dashes.
+
+    - compression -- zstd is much faster than gzip and uses all cores. On
+      prod we leave some cores to the website.
+    - media -- Media files are already compressed, no need to waste CPU on
+      them
+    - exclude -- Caches and dependencies can be rebuilt, no need to back
+      them up
+    - nice, ionice, bwlimit, dump_rate -- On prod, the snapshot must not
+      slow down the website so reading files and dumping the DB get the
+      lowest priority and a limited bandwidth (in KiB/s)
+    """
+
+    prod = environment == "prod"
+
+    return {
+        "compression": "zstd",
+        "compression_level": 3,
+        "compression_threads": 2 if prod else 0,
+        "media": "store",
+        "exclude": ["wp-content/cache", "node_modules"],
+        "nice": 19 if prod else None,
+        "ionice": "idle" if prod else None,
+        "bwlimit": 20480 if prod else None,
+        "dump_rate": 10240 if prod else None,
+    }
+
+
 def get_git_version(environment: Text):
     """
     Utility method to determine the git branch depending on the environment.
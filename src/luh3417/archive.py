@@ -0,0 +1,468 @@
+import json
+import os
+import struct
+import tarfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from os.path import basename, dirname, exists, join, splitext
+from shutil import rmtree
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterator, List, Optional, Text, Tuple
+
+from luh3417.checkpoint import Checkpoint
+from luh3417.compression import (
+    Compression,
+    codec_from_extension,
+    decompress_args,
+    detect_codec,
+    is_media,
+)
+from luh3417.luhfs import LocalLocation, Location, run_pipeline
+from luh3417.progress import CHUNK_SIZE, Progress
+from luh3417.utils import LuhError
+
+ARCHIVE_FORMATS = ("indexed", "stream")
+
+INDEX_MAGIC = b"LUH3417I"
+INDEX_VERSION = 1
+FOOTER = struct.Struct(">8sQQ")
+
+COMPRESSED_FILES = ("manifest.json", "dump.sql")
+TAR_PARTS = ("wordpress.tar", "media.tar")
+
+PARTS = {
+    "settings.json": ("settings.json",),
+    "manifest.json": ("manifest.json",),
+    "dump.sql": ("dump.sql",),
+    "wordpress": TAR_PARTS,
+}
+
+
+def split_media(root: Text) -> Tuple[List[Text], List[Text]]:
+    """
+    Lists all the entries of root (relatively to it) and sorts them between
+    regular entries (including all directories, so that permissions are kept)
+    and media files which are already compressed.
+    """
+
+    regular = []
+    media = []
+
+    for dir_path, dir_names, file_names in os.walk(root):
+        rel = os.path.relpath(dir_path, root)
+
+        for name in dir_names:
+            regular.append(os.path.normpath(join(rel, name)))
+
+        for name in file_names:
+            path = os.path.normpath(join(rel, name))
+
+            if is_media(name) and not os.path.islink(join(root, path)):
+                media.append(path)
+            else:
+                regular.append(path)
+
+    return regular, media
+
+
+def tar_file_list(root: Text, files: List[Text], dest: Text, compression: Compression):
+    """
+    Creates at dest a TAR archive of the specified files (relative to root),
+    without recursing into directories
+    """
+
+    with NamedTemporaryFile(mode="wb") as file_list, open(dest, "wb") as out:
+        file_list.write(b"".join(f.encode("utf-8") + b"\0" for f in files))
+        file_list.flush()
+
+        results = run_pipeline(
+            [
+                [
+                    "tar",
+                    "-C",
+                    root,
+                    "--no-recursion",
+                    "--null",
+                    "-T",
+                    file_list.name,
+                    "-c",
+                ],
+                compression.compress_args(),
+            ],
+            stdout=out,
+        )
+
+    for ret, err in results:
+        if ret:
+            raise LuhError(f"Could not create archive part {dest}: {err}")
+
+
+def compress_file(source: Text, dest: Text, compression: Compression):
+    """
+    Compresses the file at source into dest
+    """
+
+    with open(source, "rb") as i, open(dest, "wb") as o:
+        ((ret, err),) = run_pipeline([compression.compress_args()], stdin=i, stdout=o)
+
+    if ret:
+        raise LuhError(f"Could not compress {source}: {err}")
+
+
+def decompress_file(source: Text, dest: Text):
+    """
+    Decompresses the file at source into dest, guessing the codec
+    """
+
+    with open(source, "rb") as i:
+        codec = detect_codec(i.read(512))
+        i.seek(0)
+
+        with open(dest, "wb") as o:
+            ((ret, err),) = run_pipeline([decompress_args(codec)], stdin=i, stdout=o)
+
+    if ret:
+        raise LuhError(f"Could not decompress {source}: {err}")
+
+
+@contextmanager
+def atomic_output(dest: Text) -> Iterator[Text]:
+    """
+    Gives a temporary path next to dest, which becomes dest only if the
+    block succeeds. This way, a file of the work dir which has its final
+    name is complete, even if a previous run was interrupted while writing
+    it.
+    """
+
+    tmp_path = join(dirname(dest), f".{basename(dest)}.tmp")
+    yield tmp_path
+    os.replace(tmp_path, dest)
+
+
+def pack_parts(
+    work_dir: Text,
+    compression: Compression,
+    media: Text,
+    checkpoint: Optional[Checkpoint] = None,
+):
+    """
+    Splits the content of the snapshot's work dir into individually compressed
+    parts:
+
+    - `manifest.json` and `dump.sql` get compressed (`dump.sql.<ext>`, ...)
+    - `wordpress/` becomes `wordpress.tar.<ext>`. If the media policy is to
+      store them, media files (which are already compressed) are put into
+      an uncompressed `media.tar` so that no CPU is wasted on them.
+
+    The work dir can then be archived without compression.
+
+    Parts which already exist are complete and left as they are, so that an
+    interrupted packing can be resumed. With a checkpoint, the packing is
+    recorded as done before `wordpress/` gets deleted, so that a partially
+    deleted tree is never packed again.
+    """
+
+    wp_root = join(work_dir, "wordpress")
+
+    if not checkpoint or not checkpoint.is_done("steps", "pack"):
+        if compression.codec != "none":
+            for name in COMPRESSED_FILES:
+                path = join(work_dir, name)
+                dest = path + compression.extension
+
+                if exists(path):
+                    if not exists(dest):
+                        with atomic_output(dest) as tmp_path:
+                            compress_file(path, tmp_path, compression)
+
+                    os.unlink(path)
+
+        regular, media_files = split_media(wp_root)
+
+        if media != "store":
+            regular += media_files
+            media_files = []
+
+        parts = [(regular, f"wordpress.tar{compression.extension}", compression)]
+
+        if media_files:
+            parts.append((media_files, "media.tar", Compression("none")))
+
+        for files, name, part_compression in parts:
+            dest = join(work_dir, name)
+
+            if not exists(dest):
+                with atomic_output(dest) as tmp_path:
+                    tar_file_list(wp_root, files, tmp_path, part_compression)
+
+        if checkpoint:
+            checkpoint.mark_done("steps", "pack")
+
+    if exists(wp_root):
+        rmtree(wp_root)
+
+
+def part_of(name: Text, prefix: Text) -> bool:
+    """
+    Tells if the file name is the given part, compressed or not
+    """
+
+    return name == prefix or name.startswith(prefix + ".")
+
+
+def unpack_parts(work_dir: Text):
+    """
+    Reverts pack_parts() on an extracted archive. Archives which were not
+    split are left untouched.
+    """
+
+    names = sorted(os.listdir(work_dir))
+    wp_root = join(work_dir, "wordpress")
+
+    for prefix in COMPRESSED_FILES:
+        for name in names:
+            if name != prefix and part_of(name, prefix):
+                path = join(work_dir, name)
+                decompress_file(path, join(work_dir, prefix))
+                os.unlink(path)
+
+    for prefix in TAR_PARTS:
+        for name in names:
+            if part_of(name, prefix):
+                path = join(work_dir, name)
+                LocalLocation(path).extract_archive_to_dir(wp_root)
+                os.unlink(path)
+
+
+@dataclass
+class Member:
+    """
+    A member of an indexed archive: where its data starts, its size and how
+    it is compressed
+    """
+
+    name: Text
+    offset: int
+    size: int
+    codec: Text
+
+
+Index = Dict[Text, Member]
+
+
+def resume_archive(location: Location, checkpoint: Checkpoint) -> Tuple[Dict, int]:
+    """
+    Finds where to resume writing a partial archive: the members recorded in
+    the checkpoint which are entirely in the file, and the offset where the
+    last of them ends. The TAR header of that member is read back to make
+    sure that the file is the one which was being written.
+    """
+
+    state = checkpoint.get("archive")
+
+    if not state or not state["index"]:
+        return {}, 0
+
+    size = location.disk_usage() or 0
+    index = {}
+    offset = 0
+    last = None
+
+    for name, member in sorted(state["index"].items(), key=lambda m: m[1]["offset"]):
+        end = member["offset"] + member["size"] + (-member["size"] % tarfile.BLOCKSIZE)
+
+        if end > size:
+            break
+
+        index[name] = member
+        offset = end
+        last = name
+
+    if last is None:
+        return {}, 0
+
+    header = location.get_range(state["headers"][last], tarfile.BLOCKSIZE)
+
+    try:
+        info = tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+        assert info.size == index[last]["size"]
+    except (tarfile.TarError, AssertionError):
+        return {}, 0
+
+    return index, offset
+
+
+def write_indexed_archive(
+    work_dir: Text,
+    location: Location,
+    progress: Optional[Progress] = None,
+    checkpoint: Optional[Checkpoint] = None,
+):
+    """
+    Writes the (packed) parts found in work_dir into an indexed archive at
+    the given location.
+
+    The archive is a regular uncompressed TAR, so it can be opened by any
+    tool. The JSON index of members is appended after the end of the TAR
+    (where TAR readers don't look), followed by a fixed-size footer giving
+    the position of the index. This way, any member can be read from its
+    offset without reading the rest of the file, which works remotely as
+    well.
+
+    Returns the size of the archive. If a progress is given, the bytes of the
+    parts are counted into it.
+
+    With a checkpoint, each member written is recorded. If the checkpoint
+    says that the archive was partially written by a previous run, the
+    members which made it into the file are kept and the others are
+    appended after them.
+    """
+
+    names = [
+        name
+        for prefix in ("settings.json",) + COMPRESSED_FILES + TAR_PARTS
+        for name in sorted(os.listdir(work_dir))
+        if part_of(name, prefix)
+    ]
+
+    index, offset = {}, 0
+    headers = {}
+
+    if checkpoint:
+        index, offset = resume_archive(location, checkpoint)
+        headers = {n: checkpoint.get("archive")["headers"][n] for n in index}
+
+    with location.open_write(offset if index else None) as out:
+        for name in names:
+            if name in index:
+                continue
+
+            path = join(work_dir, name)
+
+            with open(path, "rb") as f:
+                info = tarfile.TarInfo(name)
+                info.size = os.fstat(f.fileno()).st_size
+                info.mtime = int(os.fstat(f.fileno()).st_mtime)
+                info.mode = 0o644
+
+                header = info.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+                out.write(header)
+                headers[name] = offset + len(header) - tarfile.BLOCKSIZE
+                offset += len(header)
+
+                index[name] = {
+                    "offset": offset,
+                    "size": info.size,
+                    "codec": codec_from_extension(splitext(name)[1]),
+                }
+
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    out.write(chunk)
+
+                    if progress:
+                        progress.add(len(chunk))
+
+                padding = -info.size % tarfile.BLOCKSIZE
+                out.write(b"\0" * padding)
+                offset += info.size + padding
+
+            if checkpoint:
+                out.flush()
+                checkpoint.set("archive", {"index": index, "headers": headers})
+
+        end = 2 * tarfile.BLOCKSIZE
+        end += -(offset + end) % tarfile.RECORDSIZE
+        out.write(b"\0" * end)
+        offset += end
+
+        data = json.dumps({"version": INDEX_VERSION, "members": index}).encode()
+        out.write(data)
+        out.write(FOOTER.pack(INDEX_MAGIC, offset, len(data)))
+
+    return offset + len(data) + FOOTER.size
+
+
+def read_index(location: Location) -> Optional[Index]:
+    """
+    Reads the index of an indexed archive, using only two small reads at the
+    end of the file. Returns None if the archive is not indexed.
+    """
+
+    try:
+        magic, offset, size = FOOTER.unpack(location.get_tail(FOOTER.size))
+    except struct.error:
+        return None
+
+    if magic != INDEX_MAGIC:
+        return None
+
+    try:
+        content = json.loads(location.get_range(offset, size).decode())
+        assert content["version"] == INDEX_VERSION
+
+        return {
+            name: Member(name=name, **member)
+            for name, member in content["members"].items()
+        }
+    except (ValueError, KeyError, TypeError, AssertionError):
+        raise LuhError(f"The index of {location} is corrupted")
+
+
+def extract_member(location: Location, member: Member, prefix: Text, work_dir: Text):
+    """
+    Extracts a member of an indexed archive into the work dir, reading only
+    its bytes from the archive. TAR parts are extracted into the `wordpress`
+    directory while other files are decompressed to the name of their part.
+    """
+
+    commands = [
+        location.range_args(member.offset, member.size),
+        decompress_args(member.codec),
+    ]
+
+    if prefix in TAR_PARTS:
+        target_dir = join(work_dir, "wordpress")
+        LocalLocation(target_dir).ensure_exists_as_dir()
+        results = run_pipeline(commands + [["tar", "-C", target_dir, "-x"]])
+    else:
+        with open(join(work_dir, prefix), "wb") as f:
+            results = run_pipeline(commands, stdout=f)
+
+    for ret, err in results:
+        if ret:
+            raise LuhError(f"Could not extract {member.name} from {location}: {err}")
+
+
+class SnapshotReader:
+    """
+    Reads a snapshot archive into a work dir. With indexed archives, only the
+    requested parts are read, by example to get the settings without
+    transferring nor extracting the whole archive. Other archives are
+    extracted completely the first time something is requested.
+    """
+
+    def __init__(self, location: Location, work_dir: Text):
+        self.location = location
+        self.work_dir = work_dir
+        self.index = read_index(location)
+        self.extracted = False
+
+    def extract(self, *parts: Text) -> None:
+        """
+        Extracts the given parts of the snapshot: `settings.json`,
+        `manifest.json`, `dump.sql` and/or `wordpress`.
+        """
+
+        if self.index is None:
+            if not self.extracted:
+                self.location.extract_archive_to_dir(self.work_dir)
+                unpack_parts(self.work_dir)
+                self.extracted = True
+
+            return
+
+        for part in parts:
+            for prefix in PARTS[part]:
+                for name, member in self.index.items():
+                    if part_of(name, prefix):
+                        extract_member(self.location, member, prefix, self.work_dir)
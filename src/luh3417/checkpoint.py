@@ -0,0 +1,103 @@
+import json
+import os
+from logging import getLogger
+from threading import Lock
+from typing import Any, Dict, Optional, Text
+
+logger = getLogger("luh3417.checkpoint")
+
+
+class Checkpoint:
+    """
+    Records the progress of a long operation (which steps, shards or tables
+    are done, and a few values needed to continue) so that a later run can
+    resume it instead of starting over.
+
+    The state is saved as JSON at the given path after each change, by
+    replacing the file so that it's never half-written. Without a path, the
+    checkpoint only lives in memory. This is safe to use from several
+    threads.
+
+    >>> checkpoint = Checkpoint("/tmp/work/checkpoint.json")
+    >>> for table in tables:
+    >>>     if not checkpoint.is_done("tables", table):
+    >>>         dump(table)
+    >>>         checkpoint.mark_done("tables", table)
+    """
+
+    def __init__(self, path: Optional[Text] = None):
+        self.path = path
+        self.lock = Lock()
+        self.data: Dict[Text, Any] = {"done": {}, "values": {}}
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+
+                assert isinstance(data["done"], dict)
+                assert isinstance(data["values"], dict)
+                self.data = data
+            except (OSError, ValueError, KeyError, TypeError, AssertionError):
+                logger.warning("Ignoring unreadable checkpoint %s", path)
+
+    @property
+    def resumed(self) -> bool:
+        """
+        Tells if anything was recorded by a previous run
+        """
+
+        return bool(self.data["done"] or self.data["values"])
+
+    def save(self) -> None:
+        """
+        Writes the state to the checkpoint's file (if any). Must be called
+        with the lock.
+        """
+
+        if not self.path:
+            return
+
+        tmp_path = f"{self.path}.tmp"
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+
+        os.replace(tmp_path, self.path)
+
+    def is_done(self, step: Text, item: Any = True) -> bool:
+        """
+        Tells if the item of the step (or the whole step) was done
+        """
+
+        with self.lock:
+            return item in self.data["done"].get(step, [])
+
+    def mark_done(self, step: Text, item: Any = True) -> None:
+        """
+        Records that the item of the step (or the whole step) is done
+        """
+
+        with self.lock:
+            done = self.data["done"].setdefault(step, [])
+
+            if item not in done:
+                done.append(item)
+                self.save()
+
+    def get(self, name: Text, default: Any = None) -> Any:
+        """
+        Gets a recorded value
+        """
+
+        with self.lock:
+            return self.data["values"].get(name, default)
+
+    def set(self, name: Text, value: Any) -> None:
+        """
+        Records a value, which must be serializable as JSON
+        """
+
+        with self.lock:
+            self.data["values"][name] = value
+            self.save()
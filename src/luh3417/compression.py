@@ -0,0 +1,178 @@
+from dataclasses import dataclass
+from os.path import splitext
+from shutil import which
+from typing import List, Optional, Text
+
+from luh3417.utils import LuhError
+
+CODECS = ("none", "gzip", "pigz", "zstd", "xz")
+
+EXTENSIONS = {"none": "", "gzip": ".gz", "pigz": ".gz", "zstd": ".zst", "xz": ".xz"}
+
+LEVELS = {"gzip": (1, 9), "pigz": (0, 11), "zstd": (1, 22), "xz": (0, 9)}
+
+MAGICS = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\xfd7zXZ\x00", "xz"),
+]
+
+MEDIA_POLICIES = ("compress", "store")
+
+MEDIA_EXTENSIONS = {
+    "7z",
+    "aac",
+    "avif",
+    "bz2",
+    "flac",
+    "gif",
+    "gz",
+    "heic",
+    "jpeg",
+    "jpg",
+    "m4a",
+    "m4v",
+    "mkv",
+    "mov",
+    "mp3",
+    "mp4",
+    "ogg",
+    "oga",
+    "ogv",
+    "pdf",
+    "png",
+    "rar",
+    "tgz",
+    "webm",
+    "webp",
+    "woff",
+    "woff2",
+    "xz",
+    "zip",
+    "zst",
+}
+
+
+@dataclass
+class Compression:
+    """
+    Describes how an archive stream gets compressed: the codec, its level
+    (None to use the codec's default) and the number of threads for codecs
+    that can use several cores (0 meaning all of them).
+    """
+
+    codec: Text = "gzip"
+    level: Optional[int] = None
+    threads: int = 0
+
+    def __post_init__(self):
+        if self.codec not in CODECS:
+            raise LuhError(f"Unknown compression codec: {self.codec}")
+
+        if self.level is not None and self.codec != "none":
+            low, high = LEVELS[self.codec]
+
+            if not low <= self.level <= high:
+                raise LuhError(
+                    f"Compression level for {self.codec} must be between "
+                    f"{low} and {high}"
+                )
+
+    @property
+    def extension(self) -> Text:
+        """
+        Extension to append to the name of a file compressed this way
+        """
+
+        return EXTENSIONS[self.codec]
+
+    def ensure_available(self) -> None:
+        """
+        Makes sure that the compression program can be found locally
+        """
+
+        if self.codec != "none" and not which(self.codec):
+            raise LuhError(f"Could not find the {self.codec} program")
+
+    def compress_args(self) -> Optional[List[Text]]:
+        """
+        Generates the command line of a compressor reading from stdin and
+        writing to stdout, or None if there is no compression to do
+        """
+
+        if self.codec == "none":
+            return None
+
+        args = [self.codec]
+
+        if self.codec == "zstd":
+            args += ["-q", f"-T{self.threads}"]
+
+            if self.level is not None and self.level > 19:
+                args += ["--ultra"]
+        elif self.codec == "xz":
+            args += [f"-T{self.threads}"]
+        elif self.codec == "pigz" and self.threads:
+            args += ["-p", f"{self.threads}"]
+
+        if self.level is not None:
+            args += [f"-{self.level}"]
+
+        return args + ["-c"]
+
+
+def detect_codec(head: bytes) -> Text:
+    """
+    Given the first bytes of a file (at least 512 for plain TAR archives),
+    guesses the codec it was compressed with
+    """
+
+    for magic, codec in MAGICS:
+        if head.startswith(magic):
+            return codec
+
+    if head[257:262] == b"ustar":
+        return "none"
+
+    raise LuhError("Unrecognized archive format")
+
+
+def decompress_args(codec: Text) -> Optional[List[Text]]:
+    """
+    Generates the command line of a decompressor for the given codec, reading
+    from stdin and writing to stdout. Returns None if there is nothing to
+    decompress.
+    """
+
+    if codec == "none":
+        return None
+    elif codec in {"gzip", "pigz"}:
+        return ["pigz" if which("pigz") else "gzip", "-d", "-c"]
+    elif codec == "zstd":
+        return ["zstd", "-d", "-q", "-c"]
+    elif codec == "xz":
+        return ["xz", "-d", "-c", "-T0"]
+    else:
+        raise LuhError(f"Unknown compression codec: {codec}")
+
+
+def codec_from_extension(extension: Text) -> Text:
+    """
+    Guesses the codec from a file extension (like `.gz`). Files with another
+    extension are considered not compressed.
+    """
+
+    for codec, ext in EXTENSIONS.items():
+        if ext and ext == extension:
+            return codec
+
+    return "none"
+
+
+def is_media(file_name: Text) -> bool:
+    """
+    Tells if a file is a media which is most likely already compressed
+    """
+
+    _, ext = splitext(file_name)
+    return ext[1:].lower() in MEDIA_EXTENSIONS
@@ -0,0 +1,156 @@
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from typing import List, Sequence, Text
+
+DEFAULT_EXCLUDES = (".git", ".idea", "*.swp", "*.un~")
+ERE_SPECIAL = set(".^$+(){}|\\")
+
+
+def glob_to_ere(pattern: Text) -> Text:
+    """
+    Translates a path component's glob into a POSIX extended regular
+    expression in which wildcards never match a `/`
+    """
+
+    out = []
+    i = 0
+
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            start = i + 1 if pattern[i : i + 1] == "!" else i
+            end = pattern.find("]", start + 1)
+
+            if end < 0:
+                out.append("\\[")
+                continue
+
+            body = pattern[i:end]
+            i = end + 1
+
+            if body.startswith("!"):
+                body = "^" + body[1:]
+
+            out.append(f"[{body}]")
+        elif c in ERE_SPECIAL or c == "]":
+            out.append(f"\\{c}")
+        else:
+            out.append(c)
+
+    return "".join(out)
+
+
+@dataclass
+class Excludes:
+    """
+    A set of exclusion rules, translated for each transfer backend so that
+    excluded files are skipped on the source side (never read nor sent),
+    whichever backend is used.
+
+    Patterns follow a subset of rsync's syntax, which is honored identically
+    by tar, rsync and Python:
+
+    - `*`, `?` and `[...]` wildcards never match a `/`
+    - A pattern matches the end of a path, by example `wp-content/cache`
+      matches `wp-content/cache` and `foo/wp-content/cache`
+    - A pattern starting with `/` is anchored to the root of the transfer
+    - When a directory is matched, everything inside it is excluded as well
+    """
+
+    patterns: Sequence[Text] = field(default_factory=lambda: list(DEFAULT_EXCLUDES))
+
+    def __post_init__(self):
+        self._parsed = []
+
+        for pattern in self.patterns:
+            anchored = pattern.startswith("/")
+            parts = [p for p in pattern.strip("/").split("/") if p]
+
+            if parts:
+                self._parsed.append((anchored, parts))
+
+    def matches(self, path: Text) -> bool:
+        """
+        Tells if the path (relative to the root of the transfer) or any of its
+        parents is excluded
+        """
+
+        parts = [p for p in path.split("/") if p and p != "."]
+
+        for anchored, pattern in self._parsed:
+            for end in range(len(pattern), len(parts) + 1):
+                start = end - len(pattern)
+
+                if anchored and start:
+                    break
+
+                if all(fnmatchcase(p, q) for p, q in zip(parts[start:end], pattern)):
+                    return True
+
+        return False
+
+    def tar_args(self) -> List[Text]:
+        """
+        Options for a tar which archives `.` (or a list of paths starting with
+        `./`)
+        """
+
+        out = ["--no-wildcards-match-slash"]
+
+        for anchored, parts in self._parsed:
+            pattern = "/".join(parts)
+
+            if anchored:
+                out += ["--anchored", f"--exclude=./{pattern}", "--no-anchored"]
+            else:
+                out += [f"--exclude={pattern}"]
+
+        return out
+
+    def find_args(self) -> List[Text]:
+        """
+        Options for a GNU find which starts from `.`, to put before the
+        expression. They prune excluded entries, so the expression must be
+        given as an alternative:
+
+        >>> ["find", "."] + excludes.find_args() + ["-type", "f", "-print"]
+        """
+
+        if not self._parsed:
+            return []
+
+        out = ["-regextype", "posix-extended", "("]
+
+        for anchored, parts in self._parsed:
+            if len(out) > 3:
+                out.append("-o")
+
+            prefix = r"\./" if anchored else r"\./(.*/)?"
+            out += ["-regex", prefix + "/".join(glob_to_ere(p) for p in parts)]
+
+        return out + [")", "-prune", "-o"]
+
+    def rsync_args(self) -> List[Text]:
+        """
+        Options for rsync
+        """
+
+        return [
+            f"--exclude={'/' if anchored else ''}{'/'.join(parts)}"
+            for anchored, parts in self._parsed
+        ]
+
+
+def make_excludes(extra: Sequence[Text] = (), defaults: bool = True) -> Excludes:
+    """
+    Generates the exclusion rules from the default ones and the configured
+    ones
+    """
+
+    return Excludes(list(DEFAULT_EXCLUDES if defaults else []) + list(extra or []))
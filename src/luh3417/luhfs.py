@@ -1,12 +1,29 @@
+import os
 import re
 import subprocess
+from base64 import b64decode, b64encode
+from contextlib import contextmanager
 from dataclasses import dataclass, replace
+from hashlib import sha1
 from pathlib import Path
 from posixpath import join
+from secrets import token_hex
 from shlex import quote
 from subprocess import CompletedProcess, Popen
-from typing import Text, Tuple
-
+from tempfile import TemporaryFile
+from typing import (
+    BinaryIO,
+    ContextManager,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Text,
+    Tuple,
+)
+
+from luh3417.compression import Compression, decompress_args, detect_codec
+from luh3417.exclude import Excludes
 from luh3417.luhssh import SshManager
 from luh3417.utils import LuhError
 
@@ -26,6 +43,67 @@ def parse_location(location: Text) -> "Location":
         return LocalLocation(path=location)
 
 
+def run_pipeline(
+    commands: Sequence[Optional[Sequence[Text]]],
+    stdin: Optional[BinaryIO] = None,
+    stdout: Optional[BinaryIO] = None,
+) -> List[Tuple[int, Text]]:
+    """
+    Runs the commands the same way a shell pipeline would, each stdout being
+    piped into the next command's stdin. None commands are skipped, which
+    makes optional steps (like compression) easy to express.
+
+    Returns, for each command that was run, its return code and the beginning
+    of its error output.
+    """
+
+    commands = [c for c in commands if c]
+    processes = []
+    errors = []
+
+    for i, command in enumerate(commands):
+        err = TemporaryFile()
+        last = i == len(commands) - 1
+
+        p = subprocess.Popen(
+            command,
+            stdin=processes[-1].stdout if processes else stdin,
+            stdout=(stdout if stdout is not None else subprocess.DEVNULL)
+            if last
+            else subprocess.PIPE,
+            stderr=err,
+        )
+
+        if processes:
+            processes[-1].stdout.close()
+
+        processes.append(p)
+        errors.append(err)
+
+    out = []
+
+    for p, err in zip(processes, errors):
+        p.wait()
+        err.seek(0)
+        out.append((p.returncode, err.read(1000).decode("utf-8", "replace")))
+        err.close()
+
+    return out
+
+
+def _range_script(path: Text, offset: int, size: int) -> List[Text]:
+    """
+    Command outputting a range of bytes from a file. On regular files, tail
+    seeks directly to the offset so the beginning of the file is not read.
+    """
+
+    return [
+        "sh",
+        "-c",
+        f"tail -c +{offset + 1} {quote(path)} | head -c {size}",
+    ]
+
+
 @dataclass
 class Location:
     """
@@ -37,26 +115,55 @@ class Location:
 
     path: Text
 
+    def open_read(self) -> ContextManager[BinaryIO]:
+        """
+        Opens the file for reading, as a binary stream. This is a context
+        manager and errors are raised when leaving it.
+
+        >>> with location.open_read() as f:
+        >>>     data = f.read()
+        """
+
+        raise NotImplementedError
+
+    def open_write(self, offset: Optional[int] = None) -> ContextManager[BinaryIO]:
+        """
+        Creates or overrides the file and opens it for writing, as a binary
+        stream. The parent directory must exist and the location must not be
+        a directory. This is a context manager and errors are raised when
+        leaving it.
+
+        If an offset is given, the existing file is truncated at the offset
+        and written from there instead, in order to resume a previous write.
+        """
+
+        raise NotImplementedError
+
     def get_content(self) -> Text:
         """
         Calling this returns the whole content of the file
         """
 
-        raise NotImplementedError
+        with self.open_read() as f:
+            content = f.read()
+
+        try:
+            return content.decode("utf-8")
+        except UnicodeDecodeError:
+            raise LuhError(f"The file {self} is not valid UTF-8")
 
     def set_content(self, content) -> None:
         """
-        Creates or overrides the file so it receives the provided content.
-        The parent directory must exist and the location must not be a
-        directory.
+        Creates or overrides the file so it receives the provided content,
+        either text (encoded in UTF-8) or bytes. The parent directory must
+        exist and the location must not be a directory.
         """
 
-        out, err, ret = self.run_script(
-            f"echo -n {quote(content)} > {quote(self.path)}"
-        )
+        if isinstance(content, str):
+            content = content.encode("utf-8")
 
-        if ret:
-            raise LuhError(f"Cannot set content: {err}")
+        with self.open_write() as f:
+            f.write(content)
 
     def ensure_exists_as_dir(self) -> None:
         """
@@ -66,10 +173,57 @@ class Location:
 
         raise NotImplementedError
 
-    def archive_local_dir(self, local_path) -> None:
+    def get_head(self, size: int) -> bytes:
+        """
+        Returns the first `size` bytes of the file
+        """
+
+        raise NotImplementedError
+
+    def get_tail(self, size: int) -> bytes:
+        """
+        Returns the last `size` bytes of the file
+        """
+
+        raise NotImplementedError
+
+    def range_args(self, offset: int, size: int) -> List[Text]:
+        """
+        Generates the command line of a process writing on stdout `size`
+        bytes of the file, starting at `offset`. Only those bytes are read
+        (and transferred, when remote).
+        """
+
+        raise NotImplementedError
+
+    def get_range(self, offset: int, size: int) -> bytes:
+        """
+        Returns `size` bytes of the file, starting at `offset`
+        """
+
+        p = subprocess.Popen(
+            self.range_args(offset, size),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+
+        out, err = p.communicate()
+
+        if p.returncode:
+            raise LuhError(f"Could not read {self}: {err}")
+
+        return out
+
+    def archive_local_dir(
+        self,
+        local_path: Text,
+        compression: Optional[Compression] = None,
+        excludes: Optional[Excludes] = None,
+    ) -> None:
         """
-        Puts all the content of `local_path` into a TAR/GZ archive at the
-        current location.
+        Puts all the content of `local_path` into a TAR archive at the
+        current location, compressed as specified (gzip by default). Excluded
+        files are left out.
 
         Beware it's probably the opposite of what you imagined (:
         """
@@ -79,25 +233,56 @@ class Location:
     def extract_archive_to_dir(self, target_dir: Text) -> None:
         """
         If the file at this location is an archive, then extract its content
-        into the specified target_dir. Otherwise raise an error.
+        into the specified target_dir. Otherwise raise an error. The
+        compression codec is detected from the content of the file.
         """
 
         raise NotImplementedError
 
-    def run_script(self, script: Text) -> Tuple[Text, Text, int]:
+    def run_script(
+        self, script: Text, errors: Text = "strict"
+    ) -> Tuple[Text, Text, int]:
         """
         Runs the provided script with bash, on the machine targeted by this
-        location.
+        location. The script and its output are UTF-8, `errors` tells how to
+        handle invalid bytes (use "surrogateescape" for file names, so that
+        they survive the round trip).
         """
 
         raise NotImplementedError
 
-    def chown(self, owner: Text) -> None:
+    def chown(self, owner: Text) -> Tuple[int, int]:
         """
-        Chown recursively this location
+        Chown recursively this location. Only the entries which don't already
+        have the right owner are changed, so that the inodes of a tree which
+        is mostly right are left untouched. Returns the number of entries
+        which were changed and the total number of entries.
         """
 
-        raise NotImplementedError
+        user, sep, group = owner.partition(":")
+        mismatch = []
+
+        if user:
+            mismatch.append(f"! -user {quote(user)}")
+
+        if group:
+            mismatch.append(f"! -group {quote(group)}")
+        elif user and sep:
+            mismatch.append(f'! -group "$(id -gn {quote(user)})"')
+
+        if not mismatch:
+            raise LuhError(f"Invalid owner: {owner}")
+
+        out, err, ret = self.run_script(
+            f"find {quote(self.path)} -printf t "
+            f"\\( {' -o '.join(mismatch)} \\) -printf f "
+            f"-exec chown -h {quote(owner)} {{}} +"
+        )
+
+        if ret:
+            raise LuhError(f"Failed to chown: {err[:1000]}")
+
+        return out.count("f"), out.count("t")
 
     def exists(self):
         """
@@ -115,10 +300,73 @@ class Location:
 
         return not ret
 
-    def set_git_repo(self, repo: Text, version: Text):
+    def disk_usage(self) -> Optional[int]:
+        """
+        Estimates the total size of the files at this location, in bytes.
+        Returns None if it can't be estimated.
+        """
+
+        out, err, ret = self.run_script(f"du -sb {quote(self.path)}")
+
+        try:
+            return int(out.split()[0]) if not ret else None
+        except (ValueError, IndexError):
+            return None
+
+    def sha256(self) -> Optional[Text]:
+        """
+        Computes the SHA-256 of the file where it is, so that its content
+        doesn't need to be read to know if it changed. Returns None if it
+        can't be computed.
+        """
+
+        out, err, ret = self.run_script(f"sha256sum {quote(self.path)}")
+
+        try:
+            digest = out.split()[0] if not ret else None
+        except IndexError:
+            return None
+
+        if digest and re.match(r"^[0-9a-f]{64}$", digest):
+            return digest
+
+    def remove_children(self, paths: Sequence[Text]) -> None:
+        """
+        Recursively removes the specified paths, which are relative to this
+        location. Paths which aren't valid UTF-8 must carry their raw bytes
+        as surrogates (like list_location() gives them).
+        """
+
+        lines = [f"cd {quote(self.path)} || exit 1"]
+
+        for i in range(0, len(paths), 100):
+            chunk = " ".join(quote(p) for p in paths[i : i + 100])
+            lines.append(f"rm -rf -- {chunk} || exit 1")
+
+        out, err, ret = self.run_script("\n".join(lines), "surrogateescape")
+
+        if ret:
+            raise LuhError(f"Could not remove files from {self}: {err[:1000]}")
+
+    def set_git_repo(
+        self,
+        repo: Text,
+        version: Text,
+        shallow: bool = False,
+        cache: Optional[Text] = None,
+    ):
         """
         Sets the current location to be a git repo at the given version. Any
         pre-existing file or directory at this location will be overridden.
+
+        Only the given version is checked out: with `shallow` the history is
+        truncated to its last commit, otherwise the history is complete but
+        file contents of older commits are only fetched when needed (if the
+        server supports it).
+
+        If `cache` is a directory (on the machine of this location), a bare
+        mirror of the repo is kept in it and updated before cloning, so that
+        repeated deployments only fetch the new commits.
         """
 
         location = self.path
@@ -126,20 +374,76 @@ class Location:
         if location and location[-1] == "/":
             location = location[0:-1]
 
+        if shallow:
+            depth = "--depth 1"
+        else:
+            depth = "--filter=blob:none"
+
+        if cache:
+            mirror = join(cache, sha1(repo.encode()).hexdigest() + ".git")
+            source = quote(f"file://{mirror}")
+            update_cache = """
+                mkdir -p {cache}
+
+                (
+                    flock 9
+
+                    if [ -d {mirror} ]
+                    then
+                        git -C {mirror} fetch --quiet --prune origin
+                    else
+                        git clone --quiet --mirror {repo} {mirror}
+                    fi
+                ) 9> {lock}
+            """.format(
+                cache=quote(cache),
+                mirror=quote(mirror),
+                lock=quote(f"{mirror}.lock"),
+                repo=quote(repo),
+            )
+
+            if not shallow:
+                depth = ""
+        else:
+            source = quote(repo)
+            update_cache = ""
+
         out, err, ret = self.run_script(
             """
-                git clone -b {version} {repo} {location}__ \\
-                && mv {location} {location}___ \\
-                && mv {location}__ {location} \\
-                && rm -fr {location}___
+                set -e
+                {update_cache}
+                rm -rf {location}__
+                git clone --quiet {depth} -b {version} {source} {location}__
+                git -C {location}__ remote set-url origin {repo}
+
+                if [ -e {location} ] || [ -L {location} ]
+                then
+                    mv {location} {location}___
+                fi
+
+                mv {location}__ {location}
+                rm -fr {location}___
             """.format(
-                repo=quote(repo), version=quote(version), location=quote(location)
+                update_cache=update_cache,
+                depth=depth,
+                source=source,
+                repo=quote(repo),
+                version=quote(version),
+                location=quote(location),
             )
         )
 
         if ret:
             raise LuhError(f"Could not clone repo: {err}")
 
+    def batch(self, stop_on_error: bool = True) -> "RemoteBatch":
+        """
+        Creates a batch of operations to be run on the machine of this
+        location in a single round trip (see RemoteBatch)
+        """
+
+        return RemoteBatch(self, stop_on_error)
+
     def child(self, file_name) -> "Location":
         """
         Generates the location object for a child file named file_name
@@ -183,16 +487,26 @@ class SshLocation(Location):
 
         return f"{self.user}@{self.host}"
 
-    def ssh_run(self, args, *p_args, **kwargs) -> CompletedProcess:
+    def ssh_manager(self, payload: Text = "control") -> SshManager:
+        """
+        Gets the SSH connection to this location's host for this payload
+        """
+
+        return SshManager.instance(self.user, self.host, payload=payload)
+
+    def ssh_run(
+        self, args, *p_args, payload: Text = "control", **kwargs
+    ) -> CompletedProcess:
         """
         Runs a process remotely using subprocess.run(). This will enforce
         an UTF-8 encoding for stdin/out. Otherwise it's the same argument
         as run() and the SSH command is automatically appended to the args.
+        The payload is the type of data going through (see luhssh.PAYLOADS).
         """
 
         kwargs = dict(kwargs, encoding="utf-8")
 
-        new_args = SshManager.instance(self.user, self.host).get_args(args)
+        new_args = self.ssh_manager(payload).get_args(args)
 
         cp = subprocess.run(new_args, *p_args, **kwargs)
 
@@ -203,13 +517,14 @@ class SshLocation(Location):
 
         return cp
 
-    def ssh_popen(self, args, *p_args, **kwargs) -> Popen:
+    def ssh_popen(self, args, *p_args, payload: Text = "control", **kwargs) -> Popen:
         """
         Opens a process through SSH. It's the same arguments as Popen() except
-        that the SSH command will be prepended to the args.
+        that the SSH command will be prepended to the args. The payload is the
+        type of data going through (see luhssh.PAYLOADS).
         """
 
-        new_args = SshManager.instance(self.user, self.host).get_args(args)
+        new_args = self.ssh_manager(payload).get_args(args)
 
         cp = subprocess.Popen(new_args, *p_args, **kwargs)
 
@@ -220,24 +535,79 @@ class SshLocation(Location):
 
         return cp
 
-    def get_content(self) -> Text:
+    @contextmanager
+    def open_read(self) -> Iterator[BinaryIO]:
         """
-        Uses a remote cat to get the content
+        Reads the stdout of a remote cat
         """
 
-        cp = self.ssh_run(
-            ["cat", self.path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        p = self.ssh_popen(
+            ["cat", self.path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            payload="binary",
         )
 
-        if cp.returncode == 1:
+        try:
+            yield p.stdout
+        finally:
+            p.stdout.close()
+            err = p.stderr.read(1000).decode(errors="replace")
+            p.wait()
+
+        if p.returncode == 255:
+            raise LuhError(
+                f"SSH connection to {self.ssh_target} could not be established"
+            )
+        elif p.returncode == 1:
             raise LuhError(
                 f"The file {self} does not exist or you don't have "
                 f"permissions to read it"
             )
-        elif cp.returncode:
-            raise LuhError(f"Unknown error while reading {self}")
+        elif p.returncode:
+            raise LuhError(f"Unknown error while reading {self}: {err}")
 
-        return cp.stdout
+    @contextmanager
+    def open_write(self, offset: Optional[int] = None) -> Iterator[BinaryIO]:
+        """
+        Writes into the stdin of a remote cat
+        """
+
+        if offset is None:
+            script = f"cat > {quote(self.path)}"
+        else:
+            script = (
+                f"truncate -s {offset} {quote(self.path)} "
+                f"&& cat >> {quote(self.path)}"
+            )
+
+        p = self.ssh_popen(
+            ["sh", "-c", script],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            payload="binary",
+        )
+
+        try:
+            yield p.stdin
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            err = p.stderr.read(1000).decode(errors="replace")
+            p.wait()
+
+        if p.returncode == 255:
+            raise LuhError(
+                f"SSH connection to {self.ssh_target} could not be established"
+            )
+        elif p.returncode:
+            raise LuhError(f"Cannot set content of {self}: {err}")
 
     def ensure_exists_as_dir(self) -> None:
         """
@@ -253,74 +623,115 @@ class SshLocation(Location):
         if cp.returncode:
             raise LuhError(f"Could not create {self} as a directory: {cp.stderr}")
 
-    def archive_local_dir(self, local_path: Text):
+    def get_head(self, size: int) -> bytes:
         """
-        Generates the archive locally and pipe it to a remote dd to write it
-        on disk on the other side
+        Uses a remote head to get the beginning of the file
         """
 
-        tar = subprocess.Popen(
-            ["tar", "-C", local_path, "-c", "-z", "."],
+        p = self.ssh_popen(
+            ["head", "-c", f"{size}", self.path],
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
-        dd = self.ssh_popen(
-            ["dd", f"of={self.path}"],
-            stdout=subprocess.DEVNULL,
+
+        out, err = p.communicate()
+
+        if p.returncode:
+            raise LuhError(f"Could not read {self}: {err}")
+
+        return out
+
+    def get_tail(self, size: int) -> bytes:
+        """
+        Uses a remote tail to get the end of the file
+        """
+
+        p = self.ssh_popen(
+            ["tail", "-c", f"{size}", self.path],
+            stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            stdin=tar.stdout,
         )
 
-        _, dd_err = dd.communicate()
-        _, tar_err = tar.communicate()
+        out, err = p.communicate()
 
-        if dd.returncode:
-            raise LuhError(f"Could not write remote archive: {dd_err}")
+        if p.returncode:
+            raise LuhError(f"Could not read {self}: {err}")
 
-        if tar.returncode:
-            raise LuhError(f"Could not create the archive: {tar_err}")
+        return out
 
-    def extract_archive_to_dir(self, target_dir: Text) -> None:
+    def range_args(self, offset: int, size: int) -> List[Text]:
         """
-        Cat the remote file and pipe it into tar
+        The range is cut remotely so only the needed bytes go through SSH
         """
 
-        parse_location(target_dir).ensure_exists_as_dir()
-
-        cat = self.ssh_popen(
-            ["cat", self.path], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        return self.ssh_manager("binary").get_args(
+            _range_script(self.path, offset, size)
         )
-        tar = subprocess.Popen(
-            ["tar", "-C", target_dir, "-x", "-z"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-            stdin=cat.stdout,
+
+    def archive_local_dir(
+        self,
+        local_path: Text,
+        compression: Optional[Compression] = None,
+        excludes: Optional[Excludes] = None,
+    ):
+        """
+        Generates the archive locally and pipe it to a remote dd to write it
+        on disk on the other side
+        """
+
+        if compression is None:
+            compression = Compression()
+
+        (tar_ret, tar_err), *comp, (dd_ret, dd_err) = run_pipeline(
+            [
+                ["tar", "-C", local_path]
+                + (excludes or Excludes([])).tar_args()
+                + ["-c", "."],
+                compression.compress_args(),
+                self.ssh_manager("binary").get_args(["dd", f"of={self.path}"]),
+            ]
         )
 
-        _, tar_err = tar.communicate()
-        _, cat_err = cat.communicate()
+        if dd_ret:
+            raise LuhError(f"Could not write remote archive: {dd_err}")
 
-        if cat.returncode:
-            raise LuhError(f"Error while reading the remote archive: {cat_err}")
+        if tar_ret:
+            raise LuhError(f"Could not create the archive: {tar_err}")
 
-        if tar.returncode:
-            raise LuhError(f"Error while extracting the archive: {tar_err}")
+        for ret, err in comp:
+            if ret:
+                raise LuhError(f"Could not compress the archive: {err}")
 
-    def chown(self, owner: Text) -> None:
+    def extract_archive_to_dir(self, target_dir: Text) -> None:
         """
-        Simply use chown
+        Cat the remote file and pipe it into tar
         """
 
-        cp = self.ssh_run(
-            ["chown", "-R", owner, self.path],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
+        parse_location(target_dir).ensure_exists_as_dir()
+
+        codec = detect_codec(self.get_head(512))
+
+        (cat_ret, cat_err), *decomp, (tar_ret, tar_err) = run_pipeline(
+            [
+                self.ssh_manager("binary").get_args(["cat", self.path]),
+                decompress_args(codec),
+                ["tar", "-C", target_dir, "-x"],
+            ]
         )
 
-        if cp.returncode:
-            raise LuhError(f"Failed to chown: {cp.stderr[:1000]}")
+        if cat_ret:
+            raise LuhError(f"Error while reading the remote archive: {cat_err}")
 
-    def run_script(self, script: Text) -> Tuple[Text, Text, int]:
+        for ret, err in decomp:
+            if ret:
+                raise LuhError(f"Error while decompressing the archive: {err}")
+
+        if tar_ret:
+            raise LuhError(f"Error while extracting the archive: {tar_err}")
+
+    def run_script(
+        self, script: Text, errors: Text = "strict"
+    ) -> Tuple[Text, Text, int]:
         """
         Runs the script through SSH piping
         """
@@ -331,6 +742,7 @@ class SshLocation(Location):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             encoding="utf-8",
+            errors=errors,
         )
 
         cp.stdin.write(script)
@@ -351,10 +763,10 @@ class LocalLocation(Location):
     def __str__(self):
         return self.path
 
-    def get_content(self) -> Text:
+    @contextmanager
+    def open_read(self) -> Iterator[BinaryIO]:
         try:
-            with open(self.path, "r", encoding="utf-8") as f:
-                return f.read()
+            f = open(self.path, "rb")
         except PermissionError:
             raise LuhError(f"You don't have the permission to read {self}")
         except FileNotFoundError:
@@ -362,6 +774,26 @@ class LocalLocation(Location):
         except OSError:
             raise LuhError(f"Unknown error while opening {self}")
 
+        with f:
+            yield f
+
+    @contextmanager
+    def open_write(self, offset: Optional[int] = None) -> Iterator[BinaryIO]:
+        try:
+            if offset is None:
+                f = open(self.path, "wb")
+            else:
+                f = open(self.path, "r+b")
+                f.truncate(offset)
+                f.seek(offset)
+        except PermissionError:
+            raise LuhError(f"You don't have the permission to write {self}")
+        except OSError as e:
+            raise LuhError(f"Cannot set content of {self}: {e}")
+
+        with f:
+            yield f
+
     def ensure_exists_as_dir(self) -> None:
         try:
             Path(self.path).mkdir(parents=True, exist_ok=True)
@@ -372,14 +804,48 @@ class LocalLocation(Location):
         except OSError:
             raise LuhError(f"Unknown error while creating {self}")
 
-    def archive_local_dir(self, local_path):
-        cp = subprocess.run(
-            ["tar", "-C", local_path, "-c", "-z", "-f", self.path, "."],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+    def get_head(self, size: int) -> bytes:
+        try:
+            with open(self.path, "rb") as f:
+                return f.read(size)
+        except OSError as e:
+            raise LuhError(f"Could not read {self}: {e}")
 
-        if cp.returncode:
+    def get_tail(self, size: int) -> bytes:
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - size))
+                return f.read(size)
+        except OSError as e:
+            raise LuhError(f"Could not read {self}: {e}")
+
+    def range_args(self, offset: int, size: int) -> List[Text]:
+        return _range_script(self.path, offset, size)
+
+    def archive_local_dir(
+        self,
+        local_path: Text,
+        compression: Optional[Compression] = None,
+        excludes: Optional[Excludes] = None,
+    ):
+        if compression is None:
+            compression = Compression()
+
+        try:
+            with open(self.path, "wb") as f:
+                results = run_pipeline(
+                    [
+                        ["tar", "-C", local_path]
+                        + (excludes or Excludes([])).tar_args()
+                        + ["-c", "."],
+                        compression.compress_args(),
+                    ],
+                    stdout=f,
+                )
+        except OSError as e:
+            raise LuhError(f"Could not create archive {self.path}: {e}")
+
+        if any(ret for ret, _ in results):
             raise LuhError(f"Could not create archive {self.path}")
 
     def extract_archive_to_dir(self, target_dir: Text) -> None:
@@ -389,30 +855,27 @@ class LocalLocation(Location):
 
         parse_location(target_dir).ensure_exists_as_dir()
 
-        tar = subprocess.run(
-            ["tar", "-C", target_dir, "-x", "-z", "-f", self.path],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-        )
-
-        if tar.returncode:
-            raise LuhError(f"Error while extracting the archive: {tar.stderr}")
-
-    def chown(self, owner: Text) -> None:
-        """
-        A simple local chown
-        """
-
-        cp = subprocess.run(
-            ["chown", "-R", owner, self.path],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-        )
+        codec = detect_codec(self.get_head(512))
 
-        if cp.returncode:
-            raise LuhError(f"Failed to chown: {cp.stderr[:1000]}")
+        try:
+            with open(self.path, "rb") as f:
+                *decomp, (tar_ret, tar_err) = run_pipeline(
+                    [decompress_args(codec), ["tar", "-C", target_dir, "-x"]],
+                    stdin=f,
+                )
+        except OSError as e:
+            raise LuhError(f"Could not read {self}: {e}")
+
+        for ret, err in decomp:
+            if ret:
+                raise LuhError(f"Error while decompressing the archive: {err}")
+
+        if tar_ret:
+            raise LuhError(f"Error while extracting the archive: {tar_err}")
 
-    def run_script(self, script: Text) -> Tuple[Text, Text, int]:
+    def run_script(
+        self, script: Text, errors: Text = "strict"
+    ) -> Tuple[Text, Text, int]:
         """
         Just pipe the script to bash
         """
@@ -423,6 +886,7 @@ class LocalLocation(Location):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             encoding="utf-8",
+            errors=errors,
         )
 
         cp.stdin.write(script)
@@ -430,3 +894,145 @@ class LocalLocation(Location):
         out, err = cp.communicate()
 
         return out, err, cp.returncode
+
+
+@dataclass
+class BatchResult:
+    """
+    Outcome of an operation run within a RemoteBatch. The return code is None
+    if the operation was skipped because a previous one failed.
+    """
+
+    out: Text
+    err: Text
+    ret: Optional[int]
+
+
+class RemoteBatch:
+    """
+    Queues operations which are then run in a single bash invocation on the
+    machine of the location, saving one round trip per operation. Each
+    operation runs in its own sub-shell and its output, errors and return
+    code are reported separately.
+
+    All locations given to the operations must be on the same machine as the
+    batch's location.
+
+    >>> batch = remote.batch()
+    >>> batch.set_content(remote.child("robots.txt"), "User-agent: *")
+    >>> batch.run_script("systemctl reload apache2", error=None)
+    >>> results = batch.run()
+    """
+
+    def __init__(self, location: Location, stop_on_error: bool = True):
+        self.location = location
+        self.stop_on_error = stop_on_error
+        self.marker = f"__luh_{token_hex(8)}"
+        self.operations: List[Tuple[Text, Optional[Text]]] = []
+
+    def run_script(
+        self, script: Text, error: Optional[Text] = "Script failed"
+    ) -> "RemoteBatch":
+        """
+        Queues a script. If the script fails, run() raises a LuhError with the
+        error message (unless it is None, then the failure is only reported in
+        the results).
+        """
+
+        self.operations.append((script, error))
+        return self
+
+    def set_content(self, location: Location, content) -> "RemoteBatch":
+        """
+        Queues a Location.set_content(). The content is base64-encoded within
+        the script, so that it can be binary.
+        """
+
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        data = b64encode(content).decode()
+
+        return self.run_script(
+            f"printf %s {data} | base64 -d > {quote(location.path)}",
+            "Cannot set content",
+        )
+
+    def make_script(self) -> Text:
+        """
+        Generates the script which runs all the operations and then outputs
+        one line per operation: the batch's marker, index, return code and
+        base64-encoded stdout/stderr, separated by colons. The marker tells
+        those lines apart from anything else the remote shell might output
+        (like a banner from the profile).
+        """
+
+        lines = [
+            "__luh_dir=$(mktemp -d) || exit 1",
+            "trap 'rm -rf \"$__luh_dir\"' EXIT",
+            "__luh_failed=0",
+        ]
+
+        for i, (script, error) in enumerate(self.operations):
+            check = error is not None and self.stop_on_error
+
+            lines += [
+                'if [ "$__luh_failed" = 0 ]',
+                "then",
+                "(",
+                script,
+                f') > "$__luh_dir/{i}.out" 2> "$__luh_dir/{i}.err" < /dev/null',
+                f'__luh_ret=$?; echo "$__luh_ret" > "$__luh_dir/{i}.ret"',
+                f'[ "$__luh_ret" = 0 ] || __luh_failed={int(check)}',
+                "fi",
+            ]
+
+        lines += [
+            f"for __luh_i in $(seq 0 {len(self.operations) - 1})",
+            "do",
+            '    __luh_f="$__luh_dir/$__luh_i"',
+            '    [ -e "$__luh_f.ret" ] || continue',
+            f'    printf "{self.marker}:%s:%s:%s:%s\\n" \\',
+            '        "$__luh_i" "$(cat "$__luh_f.ret")" \\',
+            '        "$(base64 -w0 < "$__luh_f.out")" "$(base64 -w0 < "$__luh_f.err")"',
+            "done",
+        ]
+
+        return "\n".join(lines)
+
+    def run(self) -> List[BatchResult]:
+        """
+        Runs all the queued operations in one go and returns their results,
+        in the same order. Raises a LuhError for the first failed operation
+        which has an error message.
+        """
+
+        if not self.operations:
+            return []
+
+        out, err, ret = self.location.run_script(self.make_script())
+
+        if ret:
+            raise LuhError(f"Could not run operations on {self.location}: {err}")
+
+        results = [BatchResult("", "", None) for _ in self.operations]
+
+        for line in out.splitlines():
+            if not line.startswith(f"{self.marker}:"):
+                continue
+
+            try:
+                _, i, code, op_out, op_err = line.split(":")
+                results[int(i)] = BatchResult(
+                    out=b64decode(op_out).decode("utf-8", "replace"),
+                    err=b64decode(op_err).decode("utf-8", "replace"),
+                    ret=int(code),
+                )
+            except (ValueError, IndexError):
+                raise LuhError(f"Invalid result from {self.location}: {line[:1000]}")
+
+        for (_, error), result in zip(self.operations, results):
+            if error is not None and result.ret:
+                raise LuhError(f"{error}: {result.err[:1000]}")
+
+        return results
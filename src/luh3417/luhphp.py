@@ -1,60 +1,430 @@
 import json
+import os
 import re
+import signal
 import subprocess
+from decimal import Decimal
+from functools import partial
+from hashlib import sha256
 from itertools import chain
-from typing import Any, Dict, Text
-
-from luh3417.luhfs import Location
+from select import select
+from shutil import which
+from tempfile import TemporaryFile
+from threading import Lock
+from time import monotonic
+from typing import Any, BinaryIO, Callable, Dict, Optional, Text, Tuple
+
+from luh3417.luhfs import LocalLocation, Location
+from luh3417.progress import CHUNK_SIZE
 from luh3417.utils import LuhError
 
-PHP_STR = (
-    r"\"(?:[^\"\\]|\\(?:[nrtvef\\$\"]|[0-7]{1,3}|x[0-9A-Fa-f]{1,2}|u[0-9A-Fa-f]+))*\""
-    r"|'(?:[^'\\]|\\')*'"
+PHP_STR = r"\"(?:[^\"\\]|\\[\s\S])*\"|'(?:[^'\\]|\\[\s\S])*'"
+
+PHP_ESCAPES = {
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"v": b"\v",
+    b"e": b"\x1b",
+    b"f": b"\f",
+    b"\\": b"\\",
+    b"$": b"$",
+    b'"': b'"',
+}
+
+PHP_DQ_TOKEN = re.compile(
+    rb"\\([nrtvef\\$\"])"
+    rb"|\\([0-7]{1,3})"
+    rb"|\\x([0-9A-Fa-f]{1,2})"
+    rb"|\\u\{([0-9A-Fa-f]+)\}"
+    rb"|(\$[A-Za-z_\x80-\xff]|\{\$|\$\{)"
 )
 
+PHP_WORKER = r"""
+ini_set('display_errors', 'stderr');
+$fork = function_exists('pcntl_fork');
+$replied = false;
+
+function luh3417_reply($ok, $data) {
+    global $replied;
+    $replied = true;
+    fwrite(STDOUT, ($ok ? 0 : 1) . ' ' . strlen($data) . "\n" . $data);
+    fflush(STDOUT);
+}
+
+function luh3417_output() {
+    $data = '';
+    while (ob_get_level()) {
+        $data = ob_get_clean() . $data;
+    }
+    return $data;
+}
+
+function luh3417_eval($code) {
+    eval('?>' . $code);
+}
+
+fwrite(STDOUT, ($fork ? 'fork' : 'single') . "\n");
+
+while (($line = fgets(STDIN)) !== false) {
+    $size = (int) $line;
+    $code = $size > 0 ? stream_get_contents(STDIN, $size) : '';
+    $pid = $fork ? pcntl_fork() : 0;
+
+    if ($pid > 0) {
+        pcntl_waitpid($pid, $status);
+        if (!pcntl_wifexited($status)) {
+            luh3417_reply(false, '');
+        }
+        continue;
+    }
+
+    register_shutdown_function(function () {
+        global $replied;
+        if (!$replied) {
+            luh3417_reply(false, luh3417_output());
+        }
+    });
+
+    ob_start();
+    $ok = false;
+
+    try {
+        luh3417_eval($code);
+        $ok = true;
+    } catch (Throwable $e) {
+        fwrite(STDERR, $e->getMessage() . "\n");
+    }
+
+    luh3417_reply($ok, luh3417_output());
+    exit(0);
+}
+"""
+
+PHP_INT_KEY = re.compile(r"^(0|-?[1-9][0-9]*)$")
+PHP_INT_MAX = 2**63 - 1
+
+_wp_configs: Dict[Tuple[Text, Text], Dict] = {}
+
 
 def parse_wp_config(location: "Location", config_file_name: Text = "wp-config.php"):
     """
-    Parses the WordPress configuration to get the DB configuration
+    Parses the WordPress configuration to get the DB configuration.
+
+    Parsed configurations are cached for the run (and on disk, see
+    wp_config_cache_path()), keyed by the location of the file and the hash
+    of its content, which is computed where the file is so that a cached
+    configuration doesn't need to be downloaded at all.
+
+    The file is evaluated by the local php or, if there is none, by the one
+    of the host where the file is.
     """
 
     config_location = location.child(config_file_name)
+    digest = config_location.sha256()
+    key = (f"{config_location}", digest)
+
+    if digest:
+        cached = _wp_configs.get(key) or read_cached_wp_config(*key)
+
+        if cached:
+            _wp_configs[key] = cached
+            return dict(cached)
+
     config = config_location.get_content()
-    const = extract_php_constants(config)
+
+    if which("php") or isinstance(config_location, LocalLocation):
+        const = extract_php_constants(config)
+    else:
+        const = extract_php_constants(config, partial(run_remote_php, location))
 
     try:
-        return {
+        wp_config = {
             "db_host": const["DB_HOST"],
             "db_user": const["DB_USER"],
             "db_password": const["DB_PASSWORD"],
             "db_name": const["DB_NAME"],
         }
     except KeyError as e:
-        LuhError(f"Missing config value: {e}")
+        raise LuhError(f"Missing config value: {e}")
 
+    if digest:
+        _wp_configs[key] = wp_config
+        write_cached_wp_config(*key, wp_config)
 
-def run_php(code: str):
+    return dict(wp_config)
+
+
+def wp_config_cache_path(location: Text, digest: Text) -> Optional[Text]:
     """
-    Runs PHP code and returns its output or None if there was an error
+    Path of the on-disk cache of a parsed configuration. The disk cache is
+    only used when the `LUH3417_CACHE_DIR` environment variable is set, since
+    configurations contain passwords.
+    """
+
+    cache_dir = os.environ.get("LUH3417_CACHE_DIR")
+
+    if not cache_dir:
+        return None
+
+    name = sha256(f"{location}\0{digest}".encode()).hexdigest()
+    return os.path.join(cache_dir, "wp-config", f"{name}.json")
+
+
+def read_cached_wp_config(location: Text, digest: Text) -> Optional[Dict]:
     """
+    Reads a parsed configuration from the disk cache, if there
+    """
+
+    path = wp_config_cache_path(location, digest)
+
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (TypeError, OSError, ValueError):
+        return None
+
 
-    cp = subprocess.run(
-        ["php"],
-        input=code,
-        stderr=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        encoding="utf-8",
+def write_cached_wp_config(location: Text, digest: Text, wp_config: Dict) -> None:
+    """
+    Writes a parsed configuration into the disk cache (if enabled), only
+    readable by the current user
+    """
+
+    path = wp_config_cache_path(location, digest)
+
+    if not path:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(wp_config, f)
+
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        pass
+
+
+def run_remote_php(location: Location, code: Text) -> Optional[Text]:
+    """
+    Runs PHP code on the host of the location and returns its output or None
+    if there was an error
+    """
+
+    out, err, ret = location.run_script(
+        f"php <<'LUH3417_PHP_CODE'\n{code}\nLUH3417_PHP_CODE\n"
     )
 
-    if cp.returncode:
+    if ret:
         return None
 
-    return cp.stdout
+    return out
 
 
-def extract_php_constants(file: str):
+class PhpWorker:
     """
-    Parses a PHP file to extract all the declared constants
+    A long-lived php process which evaluates the code it is sent, so that
+    PHP's startup is paid once per run instead of once per evaluation.
+
+    Code is sent on the worker's stdin as its size on a line followed by the
+    code itself. The worker answers on its stdout with a line giving the
+    status (0 for success) and the size of the output, followed by the
+    output. Each evaluation runs in a forked child (if pcntl is available)
+    so that evaluations don't see each other's constants. Otherwise the
+    worker is restarted after each evaluation.
+
+    If the worker crashes or doesn't answer within `timeout` seconds, it is
+    killed and the next evaluation starts a new one. If it can't even start,
+    a LuhError is raised with what php wrote on its stderr.
+    """
+
+    _instance: Optional["PhpWorker"] = None
+    _lock = Lock()
+
+    timeout = 30
+
+    def __init__(self):
+        self.process: Optional[subprocess.Popen] = None
+        self.errors: Optional[BinaryIO] = None
+        self.isolated = False
+        self.buffer = b""
+
+    def start(self) -> None:
+        """
+        Starts the php process and waits for it to say hello
+        """
+
+        self.errors = TemporaryFile()
+
+        try:
+            self.process = subprocess.Popen(
+                ["php", "-r", PHP_WORKER],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=self.errors,
+                start_new_session=True,
+            )
+        except OSError as e:
+            raise LuhError(f"Could not start PHP: {e}")
+
+        self.buffer = b""
+        hello = self._read_line(monotonic() + self.timeout)
+
+        if hello not in {b"fork", b"single"}:
+            raise ValueError
+
+        self.isolated = hello == b"fork"
+
+    def read_errors(self) -> Text:
+        """
+        Gets the end of what php wrote on its stderr
+        """
+
+        if not self.errors:
+            return ""
+
+        self.errors.seek(0)
+        return self.errors.read().decode("utf-8", "replace").strip()[-1000:]
+
+    def stop(self) -> None:
+        """
+        Stops the php process (and the child it might be waiting for), if
+        running
+        """
+
+        if self.process:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+            self.process.wait()
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+
+        if self.errors:
+            self.errors.close()
+            self.errors = None
+
+    def _read_some(self, deadline: float) -> None:
+        """
+        Reads what's available from the worker into the buffer, failing if
+        nothing comes before the deadline or if the worker is gone
+        """
+
+        fd = self.process.stdout.fileno()
+        ready, _, _ = select([fd], [], [], max(0.0, deadline - monotonic()))
+
+        if not ready:
+            raise TimeoutError
+
+        chunk = os.read(fd, CHUNK_SIZE)
+
+        if not chunk:
+            raise EOFError
+
+        self.buffer += chunk
+
+    def _read_line(self, deadline: float) -> bytes:
+        while b"\n" not in self.buffer:
+            self._read_some(deadline)
+
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line
+
+    def _read(self, size: int, deadline: float) -> bytes:
+        while len(self.buffer) < size:
+            self._read_some(deadline)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def run(self, code: Text) -> Optional[Text]:
+        """
+        Evaluates the code (which starts like a PHP file, with `<?php`) and
+        returns its output, or None if there was an error
+        """
+
+        data = code.encode("utf-8")
+
+        with self._lock:
+            try:
+                if not self.process:
+                    self.start()
+            except (OSError, EOFError, TimeoutError, ValueError) as e:
+                if isinstance(e, TimeoutError):
+                    reason = f"no answer after {self.timeout}s"
+                elif isinstance(e, EOFError):
+                    reason = "php exited"
+                else:
+                    reason = "unexpected answer"
+
+                err = self.read_errors()
+                self.stop()
+                raise LuhError(f"Could not start PHP ({reason}): {err or 'no error'}")
+
+            deadline = monotonic() + self.timeout
+
+            try:
+                self.process.stdin.write(f"{len(data)}\n".encode() + data)
+                self.process.stdin.flush()
+
+                status, size = self._read_line(deadline).split(b" ")
+                output = self._read(int(size), deadline)
+            except (OSError, EOFError, TimeoutError, ValueError):
+                self.stop()
+                return None
+
+            if not self.isolated:
+                self.stop()
+
+        if status != b"0":
+            return None
+
+        return output.decode("utf-8", "replace")
+
+    @classmethod
+    def instance(cls) -> "PhpWorker":
+        """
+        Gets the worker of this run
+        """
+
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+
+            return cls._instance
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """
+        Stops the worker of this run, if any
+        """
+
+        with cls._lock:
+            if cls._instance:
+                cls._instance.stop()
+                cls._instance = None
+
+
+def run_php(code: str):
+    """
+    Runs PHP code and returns its output or None if there was an error
+    """
+
+    return PhpWorker.instance().run(code)
+
+
+def extract_php_constants(
+    file: str, runner: Callable[[Text], Optional[Text]] = run_php
+):
+    """
+    Parses a PHP file to extract all the declared constants. The PHP code is
+    given to the runner (which runs it locally by default).
     """
 
     define = re.compile(r"^\s*define\(")
@@ -73,24 +443,58 @@ def extract_php_constants(file: str):
     )
 
     try:
-        data = run_php("\n".join(lines))
+        data = runner("\n".join(lines))
         return json.loads(data)
     except (ValueError, TypeError):
         raise LuhError("Configuration file has syntax errors")
 
 
+def _decode_php_escape(m) -> bytes:
+    """
+    Decodes one of the escape sequences of a double-quoted PHP string
+    """
+
+    simple, octal, hexa, code_point, variable = m.groups()
+
+    if simple:
+        return PHP_ESCAPES[simple]
+    elif octal:
+        return bytes([int(octal, 8) & 0xFF])
+    elif hexa:
+        return bytes([int(hexa, 16)])
+    elif code_point:
+        try:
+            return chr(int(code_point, 16)).encode("utf-8", "surrogatepass")
+        except (ValueError, OverflowError):
+            raise LuhError("Invalid PHP string")
+    else:
+        raise LuhError("PHP strings with variables can't be parsed")
+
+
 def parse_php_string(string: Text) -> Text:
     """
     Parses a PHP string literal (including quotes) and returns the equivalent
-    Python string (as a string, not a literal)
+    Python string (as a string, not a literal).
+
+    This follows PHP's rules: single-quoted strings only know the \\' and \\\\
+    escapes while double-quoted strings also decode the special characters,
+    octal and hexadecimal bytes and \\u{...} code points. Strings which
+    interpolate variables are refused.
     """
 
-    parser = f"<?php echo json_encode({string});"
+    if not re.fullmatch(PHP_STR, string):
+        raise LuhError("Invalid PHP string")
+
+    body = string[1:-1].encode("utf-8")
+
+    if string[0] == "'":
+        data = re.sub(rb"\\([\\'])", rb"\1", body)
+    else:
+        data = PHP_DQ_TOKEN.sub(_decode_php_escape, body)
 
     try:
-        data = run_php(parser)
-        return json.loads(data)
-    except (ValueError, TypeError):
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
         raise LuhError("Invalid PHP string")
 
 
@@ -100,24 +504,103 @@ def encode_php_string(string: Text) -> Text:
     literal
     """
 
-    quoted = string.replace("'", "\\'")
+    return f"'{escape_php_single(string)}'"
+
+
+def encode_php_float(val: float) -> Text:
+    """
+    Encodes a float the way var_export() does: the shortest representation
+    that gives back the same float, with an exponent if it's very big or
+    very small, always with a fractional part
+    """
+
+    sign, digits, exponent = Decimal(repr(val)).as_tuple()
+    minus = "-" if sign else ""
+    text = "".join(f"{d}" for d in digits).lstrip("0")
+
+    # Like dtoa, the value is 0.<digits> * 10 ** decpt
+    decpt = len(text) + exponent
+    digits = text.rstrip("0")
+
+    if not digits:
+        return f"{minus}0.0"
+
+    if decpt < -3 or decpt > 17:
+        exp = decpt - 1
+        return (
+            f"{minus}{digits[0]}.{digits[1:] or '0'}"
+            f"E{'-' if exp < 0 else '+'}{abs(exp)}"
+        )
+    elif decpt <= 0:
+        return f"{minus}0.{'0' * -decpt}{digits}"
+    elif decpt >= len(digits):
+        return f"{minus}{digits}{'0' * (decpt - len(digits))}.0"
+    else:
+        return f"{minus}{digits[:decpt]}.{digits[decpt:]}"
+
+
+def encode_php_var_string(string: Text) -> Text:
+    """
+    Encodes a string the way var_export() does, NUL bytes being concatenated
+    from a double-quoted string
+    """
+
+    quoted = escape_php_single(string).replace("\0", "' . \"\\0\" . '")
     return f"'{quoted}'"
 
 
-def encode_php_value(val):
+def escape_php_single(string: Text) -> Text:
     """
-    Transforms a JSON-encodable value into a PHP literal
+    Escapes the content of a single-quoted PHP string
     """
 
-    data = encode_php_string(json.dumps(val))
-    parser = f"<?php var_export(json_decode({data}, true));"
+    return string.replace("\\", "\\\\").replace("'", "\\'")
 
-    try:
-        data = run_php(parser)
-        assert data is not None
-        return data
-    except AssertionError:
-        raise LuhError(f"Could not encode to PHP value: {repr(val)}")
+
+def encode_php_value(val, level: int = 1) -> Text:
+    """
+    Transforms a JSON-encodable value into a PHP literal. The output is the
+    same as PHP's var_export(json_decode($json, true)): objects become
+    associative arrays (with integer keys when they look like integers) and
+    arrays are indented the same way.
+    """
+
+    if val is None:
+        return "NULL"
+    elif val is True:
+        return "true"
+    elif val is False:
+        return "false"
+    elif isinstance(val, int) and val == -PHP_INT_MAX - 1:
+        # Written as is, PHP would parse it as a float
+        return f"{-PHP_INT_MAX}-1"
+    elif isinstance(val, int) and -PHP_INT_MAX - 1 <= val <= PHP_INT_MAX:
+        return f"{val}"
+    elif isinstance(val, (int, float)):
+        return encode_php_float(float(val))
+    elif isinstance(val, str):
+        return encode_php_var_string(val)
+    elif isinstance(val, (list, tuple, dict)):
+        items = val.items() if isinstance(val, dict) else enumerate(val)
+        out = "\n" + " " * (level - 1) if level > 1 else ""
+        out += "array (\n"
+
+        for key, item in items:
+            if isinstance(key, int) or (
+                PHP_INT_KEY.match(key) and -PHP_INT_MAX - 1 <= int(key) <= PHP_INT_MAX
+            ):
+                key_text = f"{int(key)}"
+            else:
+                key_text = f"'{escape_php_single(key)}'"
+
+            out += " " * (level + 1) + f"{key_text} => "
+            out += encode_php_value(item, level + 2) + ",\n"
+
+        out += " " * (level - 1) if level > 1 else ""
+
+        return out + ")"
+
+    raise LuhError(f"Could not encode to PHP value: {repr(val)}")
 
 
 def set_wp_config_values(values: Dict[Text, Any], file_path: Text):
@@ -1,11 +1,18 @@
+import os
+import shutil
 import subprocess
 from dataclasses import dataclass
+from os.path import join
 from subprocess import DEVNULL, PIPE
-from typing import List, Optional, Text, TextIO
+from tempfile import TemporaryFile
+from typing import Dict, List, Optional, Text, TextIO
 
+from luh3417.checkpoint import Checkpoint
 from luh3417.luhfs import LocalLocation, Location, SshLocation
 from luh3417.luhssh import SshManager
+from luh3417.progress import CHUNK_SIZE, Progress, copy_stream
 from luh3417.serialized_replace import ReplaceMap, walk
+from luh3417.throttle import Throttle
 from luh3417.utils import LuhError
 
 
@@ -88,13 +95,16 @@ class LuhSql:
     ssh_host: Optional[Text]
     sudo_user: Optional[Text] = None
 
-    def ssh_args(self, args: List[Text]) -> List[Text]:
+    def ssh_args(self, args: List[Text], payload: Text = "control") -> List[Text]:
         """
-        Appends SSH connection args if required
+        Appends SSH connection args if required, for a connection tuned to the
+        payload (see luhssh.PAYLOADS)
         """
 
         if self.ssh_host and self.ssh_user:
-            return SshManager.instance(self.ssh_user, self.ssh_host).get_args(args)
+            return SshManager.instance(
+                self.ssh_user, self.ssh_host, payload=payload
+            ).get_args(args)
         else:
             return args
 
@@ -130,7 +140,10 @@ class LuhSql:
         return out
 
     def args(
-        self, command: Text, extra_args: Optional[List[Text]] = None
+        self,
+        command: Text,
+        extra_args: Optional[List[Text]] = None,
+        payload: Text = "control",
     ) -> List[Text]:
         """
         Generates the proper arguments for this command and the connection
@@ -139,44 +152,154 @@ class LuhSql:
 
         args = self.mysql_args(command, extra_args)
         args = self.sudo_args(args)
-        args = self.ssh_args(args)
+        args = self.ssh_args(args, payload)
 
         return args
 
-    def dump_to_file(self, file_path: Text):
+    def dump_to_file(
+        self,
+        file_path: Text,
+        throttle: Optional[Throttle] = None,
+        progress: Optional[Progress] = None,
+        checkpoint: Optional[Checkpoint] = None,
+    ):
+        """
+        Dumps the database into the specified file. If a throttle is given,
+        mysqldump runs with its priorities and the dump is limited to its
+        dump rate. If a progress is given, the dump's bytes are counted.
+
+        With a checkpoint, tables are dumped one by one into a directory next
+        to the file and recorded when done, so that an interrupted dump can be
+        resumed from the first table that wasn't. The dumps are then joined
+        into the file. Note that tables dumped at different times are not
+        consistent with each other.
+        """
+
+        if not checkpoint:
+            return self.dump_tables(file_path, [], throttle, progress)
+
+        tables = checkpoint.get("tables")
+
+        if tables is None:
+            sizes = self.table_sizes()
+
+            if sizes is None:
+                raise LuhError("Could not list the tables of the DB")
+
+            tables = list(sizes)
+            checkpoint.set("tables", tables)
+
+        parts_dir = f"{file_path}.parts"
+        os.makedirs(parts_dir, exist_ok=True)
+
+        for i, table in enumerate(tables):
+            if not checkpoint.is_done("tables", table):
+                part_path = join(parts_dir, f"{i:05}.sql")
+                self.dump_tables(part_path, [table], throttle, progress)
+                checkpoint.mark_done("tables", table)
+
+        with open(file_path, "wb") as f:
+            for i, _ in enumerate(tables):
+                with open(join(parts_dir, f"{i:05}.sql"), "rb") as part:
+                    shutil.copyfileobj(part, f, CHUNK_SIZE)
+
+        shutil.rmtree(parts_dir)
+
+    def dump_tables(
+        self,
+        file_path: Text,
+        tables: List[Text],
+        throttle: Optional[Throttle] = None,
+        progress: Optional[Progress] = None,
+    ):
         """
-        Dumps the database into the specified file
+        Dumps the given tables (or the whole database if none) into the file,
+        with the throttle and the progress of dump_to_file()
         """
 
-        with open(file_path, "w", encoding="utf-8") as f:
+        args = self.sudo_args(self.mysql_args("mysqldump", ["--hex-blob"]) + tables)
+
+        if throttle:
+            args = throttle.wrap(args, throttle.dump_rate)
+
+        with open(file_path, "wb") as f, TemporaryFile() as err:
             p = subprocess.Popen(
-                self.args("mysqldump", ["--hex-blob"]),
-                stderr=PIPE,
-                stdout=f,
+                self.ssh_args(args, "text"),
+                stderr=err,
+                stdout=PIPE if progress else f,
                 stdin=DEVNULL,
-                encoding="utf-8",
             )
 
-            _, err = p.communicate()
+            if progress:
+                copy_stream(p.stdout, f, progress)
+                p.stdout.close()
+
+            p.wait()
 
             if p.returncode:
-                raise LuhError(f"Could not dump MySQL DB: {err}")
+                err.seek(0)
+                message = err.read().decode("utf-8", "replace")
+                raise LuhError(f"Could not dump MySQL DB: {message}")
 
-    def restore_dump(self, fp: TextIO):
+    def restore_dump(self, fp: TextIO, progress: Optional[Progress] = None):
         """
         Restores a dump into the DB, reading the dump from an input TextIO
         (which can be the stdout of another process or simply an open file, by
-        example).
+        example). If a progress is given, the dump's bytes are counted.
+        """
+
+        with TemporaryFile() as err:
+            p = subprocess.Popen(
+                self.args("mysql", payload="text"),
+                stderr=err,
+                stdout=DEVNULL,
+                stdin=PIPE if progress else fp,
+                encoding="utf-8",
+            )
+
+            if progress:
+                copy_stream(fp, p.stdin, progress)
+                p.stdin.close()
+
+            p.wait()
+
+            if p.returncode:
+                err.seek(0)
+                message = err.read().decode("utf-8", "replace")
+                raise LuhError(f"Could not import MySQL DB: {message}")
+
+    def table_sizes(self) -> Optional[Dict[Text, int]]:
+        """
+        Gets the size of each table of the DB (data and indexes) from the
+        information_schema, which is cheap. Returns None if the sizes can't
+        be read.
         """
 
         p = subprocess.Popen(
-            self.args("mysql"), stderr=PIPE, stdout=DEVNULL, stdin=fp, encoding="utf-8"
+            self.args("mysql", ["-N", "-B"]),
+            stderr=DEVNULL,
+            stdout=PIPE,
+            stdin=PIPE,
+            encoding="utf-8",
         )
 
-        _, err = p.communicate()
+        out, _ = p.communicate(
+            "select table_name, coalesce(data_length + index_length, 0) "
+            "from information_schema.tables "
+            "where table_schema = database() "
+            "order by table_type = 'VIEW', table_name;"
+        )
 
         if p.returncode:
-            raise LuhError(f"Could not import MySQL DB: {err}")
+            return None
+
+        try:
+            return {
+                name: int(size)
+                for name, size in (line.split("\t") for line in out.splitlines())
+            }
+        except ValueError:
+            return None
 
     def run_query(self, query: Text):
         """
@@ -1,10 +1,30 @@
+import os
+import subprocess
+from hashlib import sha1
+from select import select
 from shlex import quote
 from shutil import rmtree
-from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
-from tempfile import mkdtemp
-from typing import Dict, Optional, Text, Tuple, Union
+from subprocess import DEVNULL, Popen, TimeoutExpired
+from tempfile import TemporaryFile, gettempdir, mkdtemp
+from threading import Lock
+from time import monotonic, sleep
+from typing import BinaryIO, Dict, List, Optional, Set, Text, Tuple, Union
 
-from luh3417.utils import make_doer
+from luh3417.report import report
+from luh3417.utils import LuhError, make_doer
+
+MAX_POOL_SIZE = 4
+
+# What goes through a connection: commands and their small outputs, bulky
+# data which compresses well (SQL dumps) or which doesn't (archives, media)
+PAYLOADS = ("control", "text", "binary")
+
+CIPHERS = ("aes128-gcm@openssh.com", "chacha20-poly1305@openssh.com")
+PROBE_SIZE = 32 * 1024 * 1024
+
+# Seconds given to a probe to connect, then to measure the throughput
+PROBE_CONNECT_TIMEOUT = 10
+PROBE_TIME = 2
 
 doing = make_doer("luh3417.luhssh")
 
@@ -17,6 +37,7 @@ def make_ssh_args(
     compress: bool = False,
     forward_agent: bool = False,
     nothing: bool = False,
+    cipher: Optional[Text] = None,
 ):
     """
     Generates the appropriate SSH CLI args
@@ -28,6 +49,7 @@ def make_ssh_args(
     :param compress: Compress the connection
     :param forward_agent: Enable agent forwarding
     :param nothing: Just open the connection, don't run anything
+    :param cipher: Cipher to use (None to use default)
     """
 
     out = ["ssh"]
@@ -43,6 +65,9 @@ def make_ssh_args(
     if compress:
         out += ["-C"]
 
+    if cipher:
+        out += ["-c", cipher]
+
     if nothing:
         out += ["-N"]
 
@@ -52,6 +77,71 @@ def make_ssh_args(
     return out + [f"{user}@{host}"]
 
 
+def probe_ciphers(user: Text, host: Text, port: Union[int, Text, None]) -> Dict:
+    """
+    Measures the throughput, in bytes per second, of each candidate cipher by
+    downloading zeroes from the host through a new uncompressed connection.
+    The handshake isn't counted. Each probe stops after PROBE_SIZE bytes or
+    PROBE_TIME seconds, and gives up if the host doesn't answer within
+    PROBE_CONNECT_TIMEOUT seconds. Ciphers which can't be used are left out.
+    """
+
+    out = {}
+
+    for cipher in CIPHERS:
+        args = make_ssh_args(
+            user,
+            host,
+            port,
+            options={
+                "ControlPath": "none",
+                "Compression": "no",
+                "BatchMode": "yes",
+                "ConnectTimeout": PROBE_CONNECT_TIMEOUT,
+            },
+            cipher=cipher,
+        )
+        p = Popen(
+            args + ["head", "-c", f"{PROBE_SIZE}", "/dev/zero"],
+            stdin=DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=DEVNULL,
+        )
+        deadline = monotonic() + PROBE_CONNECT_TIMEOUT
+        start = None
+        size = 0
+        complete = False
+
+        while monotonic() < deadline:
+            if not select([p.stdout], [], [], 0.1)[0]:
+                continue
+
+            chunk = p.stdout.read1(1024 * 1024)
+
+            if not chunk:
+                complete = True
+                break
+
+            if start is None:
+                start = monotonic()
+                deadline = start + PROBE_TIME
+            else:
+                size += len(chunk)
+
+        duration = monotonic() - start if start else 0
+
+        if not complete:
+            p.kill()
+
+        p.stdout.close()
+        ret = p.wait()
+
+        if size and duration > 0 and (ret == 0 or not complete):
+            out[cipher] = size / duration
+
+    return out
+
+
 class SshManager:
     """
     A manager of SSH connections. If you might open SSH connections, there is
@@ -70,14 +160,50 @@ class SshManager:
     >>>     p.wait()
     >>> finally:
     >>>     SshManager.shutdown()
+
+    The master connection is ready when instance() returns. If it can't be
+    established within `timeout` seconds, a LuhError is raised.
+
+    When the `LUH3417_SSH_PERSIST` environment variable is set (to a
+    duration understood by SSH's ControlPersist, like `10m`), master
+    connections are kept in a per-user runtime directory after the program
+    exits, and re-used by the next runs which then don't need to connect
+    again.
+
+    A single connection limits the throughput (window size, ciphering on one
+    core, server's MaxSessions), so there can be up to `pool_size` master
+    connections per host. They are opened when first needed and instance()
+    hands them out in turn for bulk payloads, while control commands always
+    go through the first one. This is safe to use from several threads.
+
+    Connections are tuned for the payload they carry (see PAYLOADS): only
+    `text` is compressed, unless `compress` is forced to True or False. The
+    cipher is SSH's default unless the `LUH3417_SSH_CIPHER` environment
+    variable names one, or is `auto` to pick the fastest of CIPHERS with a
+    quick probe of each host. These choices go into the report's notes.
     """
 
-    _instances: Dict[Tuple, "SshManager"] = {}
+    _instances: Dict[Tuple, List[Optional["SshManager"]]] = {}
+    _turns: Dict[Tuple, int] = {}
+    _locks: Dict[Tuple, Lock] = {}
+    _ciphers: Dict[Tuple, Optional[Text]] = {}
+    _noted: Set[Tuple] = set()
+    _lock = Lock()
 
     forward_agent = True
-    compress = False
-
-    def __init__(self, user: Text, host: Text, port: Text):
+    compress: Optional[bool] = None
+    timeout = 30
+    pool_size = 1
+
+    def __init__(
+        self,
+        user: Text,
+        host: Text,
+        port: Text,
+        slot: int = 0,
+        compress: bool = False,
+        cipher: Optional[Text] = None,
+    ):
         """
         Dont call directly! Use instance() instead.
         """
@@ -85,26 +211,83 @@ class SshManager:
         self.user: Text = user
         self.host: Text = host
         self.port: Text = port
+        self.slot: int = slot
+        self.compress: bool = compress
+        self.cipher: Optional[Text] = cipher
         self.control_dir: Text = None
         self.process: Popen = None
+        self.errors: Optional[BinaryIO] = None
+        self.persist: Optional[Text] = os.environ.get("LUH3417_SSH_PERSIST") or None
 
     @property
     def control(self):
         """
-        Generates the path to the control socket
+        Generates the path to the control socket. Persistent sockets are named
+        after the connection (hashed, since socket paths are short).
         """
 
+        if self.persist:
+            key = (
+                f"{self.user}@{self.host}:{self.port}:"
+                f"{self.compress}:{self.cipher}:{self.slot}"
+            )
+            return f"{self.control_dir}/{sha1(key.encode()).hexdigest()[:16]}"
+
         return f"{self.control_dir}/control"
 
+    @staticmethod
+    def runtime_dir() -> Text:
+        """
+        Directory of persistent control sockets, only accessible to the
+        current user
+        """
+
+        base = os.environ.get("XDG_RUNTIME_DIR") or gettempdir()
+        path = os.path.join(base, f"luh3417-{os.getuid()}")
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+        if os.stat(path).st_uid != os.getuid():
+            raise LuhError(f"{path} does not belong to the current user")
+
+        return path
+
+    def is_ready(self) -> bool:
+        """
+        Checks if the master connection accepts sessions
+        """
+
+        args = make_ssh_args(
+            self.user, self.host, self.port, options={"ControlPath": self.control}
+        )
+        cp = subprocess.run(
+            args[:1] + ["-O", "check"] + args[1:], stdout=DEVNULL, stderr=DEVNULL
+        )
+
+        return cp.returncode == 0
+
     def start(self):
         """
-        Starting the master connection
+        Starting the master connection (or re-using a persistent one), then
+        waiting for it to be ready
         """
 
-        doing.logger.debug(f"Connecting SSH to {self.user}@{self.host}")
+        if self.persist:
+            self.control_dir = self.runtime_dir()
+
+            if self.is_ready():
+                doing.logger.debug(
+                    f"Re-using SSH connection to {self.user}@{self.host}"
+                )
+                return
 
-        self.control_dir = mkdtemp()
+            if os.path.exists(self.control):
+                os.unlink(self.control)
+        else:
+            self.control_dir = mkdtemp()
 
+        doing.logger.debug(f"Connecting SSH to {self.user}@{self.host}")
+
+        self.errors = TemporaryFile()
         self.process = Popen(
             make_ssh_args(
                 self.user,
@@ -113,24 +296,65 @@ class SshManager:
                 options={
                     "ControlPath": self.control,
                     "ControlMaster": "yes",
-                    "ControlPersist": "no",
+                    "ControlPersist": self.persist or "no",
                 },
                 nothing=True,
                 forward_agent=self.forward_agent,
                 compress=self.compress,
-            ),
+                cipher=self.cipher,
+            )
+            + (["-f"] if self.persist else []),
             stdin=DEVNULL,
             stdout=DEVNULL,
-            stderr=PIPE,
+            stderr=self.errors,
         )
 
         doing.logger.debug(f"Process {self.process.pid} created")
 
+        self.wait_ready()
+
+        if self.persist:
+            # The master went to the background, it's not ours anymore
+            self.process = None
+
+    def wait_ready(self):
+        """
+        Waits until the master connection is ready. Fails if the master
+        process exits with an error or if it takes too long.
+        """
+
+        deadline = monotonic() + self.timeout
+        delay = 0.05
+
+        while not self.is_ready():
+            ret = self.process.poll()
+
+            if ret is not None and (ret or not self.persist):
+                self.errors.seek(0)
+                err = self.errors.read().decode("utf-8", "replace").strip()
+                raise LuhError(
+                    f"SSH connection to {self.user}@{self.host} failed: {err}"
+                )
+
+            if monotonic() > deadline:
+                self.process.kill()
+                raise LuhError(
+                    f"SSH connection to {self.user}@{self.host} was not ready "
+                    f"after {self.timeout}s"
+                )
+
+            sleep(delay)
+            delay = min(delay * 2, 0.5)
+
     def cleanup(self):
         """
-        Cleaning up this particular connection
+        Cleaning up this particular connection. Persistent connections are
+        left open.
         """
 
+        if self.persist:
+            return
+
         doing.logger.debug(f"Tearing down SSH connection to {self.user}@{self.host}")
 
         if self.process:
@@ -160,10 +384,72 @@ class SshManager:
             forward_agent=self.forward_agent,
         ) + [quote(a) for a in args]
 
+    def get_rsh(self) -> Text:
+        """
+        Generates the remote shell command to give to rsync's -e option, so
+        that rsync uses this master connection as well
+        """
+
+        args = make_ssh_args(
+            self.user,
+            self.host,
+            self.port,
+            options={"ControlPath": self.control, "ControlMaster": "no"},
+            compress=self.compress,
+            forward_agent=self.forward_agent,
+        )
+
+        return " ".join(quote(a) for a in args[:-1])
+
     @classmethod
-    def instance(cls, user, host, port=None) -> "SshManager":
+    def set_pool_size(cls, streams: int) -> None:
         """
-        Gets or create and start the manager instance for this user and host
+        Sizes the pool of connections for the given number of concurrent
+        streams (without going over MAX_POOL_SIZE)
+        """
+
+        cls.pool_size = max(1, min(streams, MAX_POOL_SIZE))
+
+    @classmethod
+    def _profile(cls, key: Tuple, payload: Text) -> Tuple[bool, Optional[Text]]:
+        """
+        Chooses the compression and cipher of the connections carrying this
+        payload to this host. Must be called with the host's lock.
+        """
+
+        if payload not in PAYLOADS:
+            raise LuhError(f"Unknown SSH payload type: {payload}")
+
+        compress = payload == "text" if cls.compress is None else cls.compress
+        cipher = os.environ.get("LUH3417_SSH_CIPHER") or None
+        user, host, port = key
+
+        if cipher == "auto":
+            if key not in cls._ciphers:
+                with doing(f"Probing SSH ciphers of {host}"):
+                    rates = probe_ciphers(user, host, port)
+
+                report.note(f"ssh.{user}@{host}:{port}.probe", rates)
+                cls._ciphers[key] = max(rates, key=rates.get) if rates else None
+
+            cipher = cls._ciphers[key]
+
+        if (key, payload) not in cls._noted:
+            cls._noted.add((key, payload))
+            report.note(
+                f"ssh.{user}@{host}:{port}.{payload}",
+                {"compress": compress, "cipher": cipher},
+            )
+
+        return compress, cipher
+
+    @classmethod
+    def instance(cls, user, host, port=None, payload="control") -> "SshManager":
+        """
+        Gets the next manager instance of the pool for this user, host and
+        type of payload (always the first one for control commands), creating
+        and starting it if needed. Only the connection of a given host are
+        waited for while a connection starts.
         """
 
         if port is None:
@@ -171,11 +457,37 @@ class SshManager:
 
         key = (user, host, port)
 
-        if key not in cls._instances:
-            cls._instances[key] = cls(user, host, port)
-            cls._instances[key].start()
+        with cls._lock:
+            lock = cls._locks.setdefault(key, Lock())
 
-        return cls._instances[key]
+        with lock:
+            compress, cipher = cls._profile(key, payload)
+
+        pool_key = key + (compress, cipher)
+
+        with cls._lock:
+            pool = cls._instances.setdefault(pool_key, [])
+            pool.extend([None] * (cls.pool_size - len(pool)))
+
+            if payload == "control":
+                slot = 0
+            else:
+                slot = cls._turns.get(pool_key, 0) % cls.pool_size
+                cls._turns[pool_key] = slot + 1
+
+        with lock:
+            if pool[slot] is None:
+                manager = cls(user, host, port, slot, compress, cipher)
+
+                try:
+                    manager.start()
+                except Exception:
+                    manager.cleanup()
+                    raise
+
+                pool[slot] = manager
+
+            return pool[slot]
 
     @classmethod
     def shutdown(cls):
@@ -183,14 +495,13 @@ class SshManager:
         Global shutdown of all manager instances
         """
 
-        if cls._instances:
-            doing.logger.debug("Shutting down SSH connections")
+        with cls._lock:
+            managers = [m for pool in cls._instances.values() for m in pool if m]
+            cls._instances.clear()
+            cls._turns.clear()
 
-            to_delete = []
-
-            for k, manager in cls._instances.items():
-                manager.cleanup()
-                to_delete.append(k)
+        if managers:
+            doing.logger.debug("Shutting down SSH connections")
 
-            for k in to_delete:
-                del cls._instances[k]
+        for manager in managers:
+            manager.cleanup()
@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple, dataclass
+from os.path import join
+from shlex import quote
+from stat import S_IMODE, S_ISDIR, S_ISLNK, S_ISREG
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Text, Tuple
+
+from luh3417.exclude import Excludes
+from luh3417.utils import LuhError
+
+if TYPE_CHECKING:
+    from luh3417.luhfs import Location
+
+MANIFEST_VERSION = 1
+
+
+@dataclass
+class Entry:
+    """
+    Description of a file in the manifest. The type is the same as find's %y
+    (f for files, d for directories, l for symlinks), mtime is in integer
+    seconds (like rsync's quick check), link is the target of symlinks and
+    sha256 the hash of regular files' content (if computed).
+    """
+
+    path: Text
+    type: Text
+    size: int
+    mtime: int
+    mode: int
+    link: Optional[Text] = None
+    sha256: Optional[Text] = None
+
+    def same_as(self, other: "Entry") -> bool:
+        """
+        Cheap comparison with another entry (presumably from another tree),
+        the same way rsync's quick check would do it
+        """
+
+        if self.type != other.type:
+            return False
+        elif self.type == "f":
+            return self.size == other.size and self.mtime == other.mtime
+        elif self.type == "l":
+            return self.link == other.link
+        else:
+            return True
+
+
+Manifest = Dict[Text, Entry]
+
+
+def hash_file(path: Text) -> Text:
+    """
+    Computes the SHA-256 of a file
+    """
+
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def stat_entry(root: Text, path: Text) -> Optional[Entry]:
+    """
+    Generates the entry for a local file (relative to root). Returns None for
+    file types that are not supported (sockets, devices, ...).
+    """
+
+    full_path = join(root, path)
+    st = os.lstat(full_path)
+
+    if S_ISREG(st.st_mode):
+        file_type = "f"
+    elif S_ISDIR(st.st_mode):
+        file_type = "d"
+    elif S_ISLNK(st.st_mode):
+        file_type = "l"
+    else:
+        return None
+
+    return Entry(
+        path=path,
+        type=file_type,
+        size=st.st_size,
+        mtime=int(st.st_mtime),
+        mode=S_IMODE(st.st_mode),
+        link=os.readlink(full_path) if file_type == "l" else None,
+    )
+
+
+def build_manifest(root: Text, with_hash: bool = True) -> Manifest:
+    """
+    Walks the local root directory to list all of its entries. Content hashes
+    are computed in parallel since hashlib releases the GIL.
+    """
+
+    manifest = {}
+
+    try:
+        for dir_path, dir_names, file_names in os.walk(root):
+            rel = os.path.relpath(dir_path, root)
+
+            for name in dir_names + file_names:
+                path = os.path.normpath(join(rel, name))
+                entry = stat_entry(root, path)
+
+                if entry:
+                    manifest[path] = entry
+
+        if with_hash:
+            files = [e for e in manifest.values() if e.type == "f"]
+
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                hashes = pool.map(lambda e: hash_file(join(root, e.path)), files)
+
+                for entry, sha256 in zip(files, hashes):
+                    entry.sha256 = sha256
+    except OSError as e:
+        raise LuhError(f"Could not build the manifest of {root}: {e}")
+
+    return manifest
+
+
+def refresh_entry(manifest: Manifest, root: Text, path: Text) -> None:
+    """
+    Updates the entry of a file which was modified after the manifest was
+    built (by example wp-config.php when restoring)
+    """
+
+    try:
+        entry = stat_entry(root, path)
+
+        if entry and entry.type == "f":
+            entry.sha256 = hash_file(join(root, path))
+    except OSError as e:
+        raise LuhError(f"Could not refresh manifest entry {path}: {e}")
+
+    if entry:
+        manifest[path] = entry
+    else:
+        manifest.pop(path, None)
+
+
+def save_manifest(manifest: Manifest, file_path: Text) -> None:
+    """
+    Writes the manifest as compact JSON (one array per entry)
+    """
+
+    content = {
+        "version": MANIFEST_VERSION,
+        "fields": [f for f in Entry.__dataclass_fields__],
+        "entries": [astuple(e) for e in manifest.values()],
+    }
+
+    try:
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(content, f, separators=(",", ":"))
+    except OSError as e:
+        raise LuhError(f"Could not write manifest: {e}")
+
+
+def load_manifest(file_path: Text) -> Optional[Manifest]:
+    """
+    Loads the manifest written by save_manifest(). Returns None if there is no
+    manifest (snapshots made by older versions don't have one).
+    """
+
+    try:
+        with open(file_path, "r", encoding="utf-8") as f:
+            content = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        raise LuhError(f"Could not read manifest: {e}")
+
+    if content.get("version") != MANIFEST_VERSION:
+        raise LuhError(f'Unsupported manifest version: {content.get("version")}')
+
+    fields = content["fields"]
+    entries = (Entry(**dict(zip(fields, values))) for values in content["entries"])
+
+    return {e.path: e for e in entries}
+
+
+def list_location(
+    location: "Location", excludes: Optional[Excludes] = None
+) -> Manifest:
+    """
+    Lists the files at a (potentially remote) location without reading them,
+    using a single find call. If the location does not exist, the listing is
+    empty. Excluded files are left out of the listing.
+
+    Like with os.walk(), bytes of file names which aren't valid UTF-8 are
+    kept as surrogates.
+    """
+
+    out, err, ret = location.run_script(
+        f"""
+            if [ ! -d {quote(location.path)} ]
+            then
+                exit 0
+            fi
+
+            find {quote(location.path)} -mindepth 1 \\
+                -printf '%y\\0%s\\0%T@\\0%m\\0%l\\0%P\\0'
+        """,
+        "surrogateescape",
+    )
+
+    if ret:
+        raise LuhError(f"Could not list files of {location}: {err[:1000]}")
+
+    fields = out.split("\0")[:-1]
+    manifest = {}
+
+    for i in range(0, len(fields), 6):
+        file_type, size, mtime, mode, link, path = fields[i : i + 6]
+
+        if file_type not in {"f", "d", "l"}:
+            continue
+
+        if excludes and excludes.matches(path):
+            continue
+
+        manifest[path] = Entry(
+            path=path,
+            type=file_type,
+            size=int(size),
+            mtime=int(float(mtime)),
+            mode=int(mode, 8),
+            link=link if file_type == "l" else None,
+        )
+
+    return manifest
+
+
+def top_level(paths: Iterable[Text]) -> List[Text]:
+    """
+    Filters out paths which are inside another path of the list
+    """
+
+    paths = set(paths)
+    out = []
+
+    for path in sorted(paths):
+        parts = path.split("/")
+
+        if not any("/".join(parts[:i]) in paths for i in range(1, len(parts))):
+            out.append(path)
+
+    return out
+
+
+def diff_manifests(
+    source: Manifest, target: Manifest, excludes: Optional[Excludes] = None
+) -> Tuple[List[Text], List[Text]]:
+    """
+    Computes what has to be done to make the target tree identical to the
+    source tree. Returns a tuple with the paths to send (sorted so that
+    parents come first) and the top-most paths to delete. Excluded paths are
+    ignored on both sides, so they are neither sent nor deleted.
+    """
+
+    if excludes is None:
+        excludes = Excludes()
+
+    to_send = []
+    to_delete = []
+
+    for path, entry in source.items():
+        if excludes.matches(path):
+            continue
+
+        current = target.get(path)
+
+        if current and current.type != entry.type:
+            to_delete.append(path)
+
+        if not current or not entry.same_as(current):
+            to_send.append(path)
+
+    for path in target:
+        if path not in source and not excludes.matches(path):
+            to_delete.append(path)
+
+    return sorted(to_send), top_level(to_delete)
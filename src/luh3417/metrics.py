@@ -0,0 +1,250 @@
+import os
+import re
+import socket
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from logging import getLogger
+from time import time
+from typing import Dict, List, Optional, Text, Tuple
+
+logger = getLogger("luh3417.metrics")
+
+
+def parse_label(label: Text) -> Text:
+    """
+    Validates a `key=value` label given on the CLI
+    """
+
+    key, sep, value = label.partition("=")
+
+    if not sep or not re.match(r"^[a-zA-Z_][a-zA-Z0-9_]*$", key):
+        raise ArgumentTypeError(f"Invalid metrics label: {label}")
+
+    return label
+
+
+def parse_address(address: Text) -> Text:
+    """
+    Validates a `host:port` address given on the CLI
+    """
+
+    host, _, port = address.rpartition(":")
+
+    if not port.isdigit():
+        raise ArgumentTypeError(f"Invalid StatsD address: {address}")
+
+    return address
+
+
+def add_metrics_args(parser: ArgumentParser) -> None:
+    """
+    Adds the metrics export options to a CLI parser
+    """
+
+    parser.add_argument(
+        "--metrics-textfile",
+        help=(
+            "Writes the metrics of the run to this file, in the Prometheus "
+            "format (for node_exporter's textfile collector)"
+        ),
+    )
+    parser.add_argument(
+        "--statsd",
+        help="Sends the metrics of the run to this StatsD server (host:port)",
+        type=parse_address,
+    )
+    parser.add_argument(
+        "--metrics-label",
+        help="Label added to all metrics, as `key=value`. Can be repeated.",
+        type=parse_label,
+        action="append",
+        default=[],
+    )
+
+
+def make_sinks(args: Namespace, command: Text) -> List["MetricsSink"]:
+    """
+    Creates the metrics sinks requested by the CLI arguments. The command
+    name (snapshot, restore, ...) is added to the labels.
+    """
+
+    labels = {"command": command}
+    labels.update(label.split("=", 1) for label in args.metrics_label)
+    sinks = []
+
+    if args.metrics_textfile:
+        sinks.append(PrometheusSink(args.metrics_textfile, labels))
+
+    if args.statsd:
+        sinks.append(StatsdSink(args.statsd, labels))
+
+    return sinks
+
+
+def slug(text: Text) -> Text:
+    """
+    Makes a metric-friendly name out of a phase message
+    """
+
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_")
+
+
+class MetricsSink:
+    """
+    Receives the measures of a run: the phases when they end (as exported by
+    Phase.as_dict()), the named values (like the archive size) and finally
+    the outcome of the run. All metrics carry the sink's labels.
+    """
+
+    def __init__(self, labels: Dict[Text, Text]):
+        self.labels = labels
+        self.start = time()
+
+    def phase(self, phase: Dict) -> None:
+        """
+        Called at the end of each phase
+        """
+
+        raise NotImplementedError
+
+    def value(self, name: Text, value: float) -> None:
+        """
+        Called when a named value is known
+        """
+
+        raise NotImplementedError
+
+    def close(self, success: bool) -> None:
+        """
+        Called at the end of the run
+        """
+
+        raise NotImplementedError
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Writes the metrics of the last run in the Prometheus text format, for
+    node_exporter's textfile collector. The file is replaced atomically at
+    the end of the run.
+    """
+
+    def __init__(self, path: Text, labels: Dict[Text, Text]):
+        super().__init__(labels)
+        self.path = path
+        self.samples: Dict[Tuple[Text, Tuple], float] = {}
+
+    def add(self, name: Text, value: float, **labels: Text) -> None:
+        """
+        Adds a sample to the file. A sample with the same name and labels
+        replaces the previous one.
+        """
+
+        labels = tuple(sorted(dict(self.labels, **labels).items()))
+        self.samples[(f"luh3417_{name}", labels)] = value
+
+    def phase(self, phase: Dict) -> None:
+        name = phase["message"]
+
+        self.add("phase_duration_seconds", phase["wall"], phase=name)
+        self.add("phase_cpu_seconds", phase["cpu_self"], phase=name, kind="self")
+        self.add(
+            "phase_cpu_seconds", phase["cpu_children"], phase=name, kind="children"
+        )
+        self.add("phase_bytes", phase["bytes_in"], phase=name, direction="in")
+        self.add("phase_bytes", phase["bytes_out"], phase=name, direction="out")
+        self.add("phase_success", int(phase["status"] == "ok"), phase=name)
+
+    def value(self, name: Text, value: float) -> None:
+        self.add(name, value)
+
+    def close(self, success: bool) -> None:
+        self.add("run_duration_seconds", time() - self.start)
+        self.add("run_success", int(success))
+        self.add("run_timestamp_seconds", self.start)
+
+        lines = []
+        last_name = None
+
+        for (name, labels), value in sorted(
+            self.samples.items(), key=lambda s: s[0][0]
+        ):
+            if name != last_name:
+                lines.append(f"# TYPE {name} gauge")
+                last_name = name
+
+            label_text = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+        tmp_path = f"{self.path}.tmp"
+
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error("Could not write metrics to %s: %s", self.path, e)
+
+
+def escape_label(value: Text) -> Text:
+    """
+    Escapes a Prometheus label value
+    """
+
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sends the metrics to a StatsD server over UDP as they come. Labels are
+    sent as DogStatsD-style tags (`|#key:value`), which most StatsD servers
+    understand.
+    """
+
+    def __init__(self, address: Text, labels: Dict[Text, Text]):
+        super().__init__(labels)
+
+        host, _, port = address.rpartition(":")
+        self.address = (host or "localhost", int(port))
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(
+        self, name: Text, value: float, kind: Text, tags: Optional[Dict] = None
+    ) -> None:
+        """
+        Sends a single metric. Errors are only logged, since metrics must not
+        break the run.
+        """
+
+        tags = dict(self.labels, **(tags or {}))
+        tag_text = ",".join(
+            f"{k}:{re.sub(r'[,|#:]', '_', v)}" for k, v in sorted(tags.items())
+        )
+        packet = f"luh3417.{name}:{value}|{kind}"
+
+        if tag_text:
+            packet += f"|#{tag_text}"
+
+        try:
+            self.socket.sendto(packet.encode("utf-8"), self.address)
+        except OSError as e:
+            logger.debug("Could not send metric to StatsD: %s", e)
+
+    def phase(self, phase: Dict) -> None:
+        tags = {"phase": slug(phase["message"])}
+
+        self.send("phase.duration", round(phase["wall"] * 1000), "ms", tags)
+        self.send("phase.bytes_in", phase["bytes_in"], "g", tags)
+        self.send("phase.bytes_out", phase["bytes_out"], "g", tags)
+
+        if phase["status"] != "ok":
+            self.send("phase.errors", 1, "c", tags)
+
+    def value(self, name: Text, value: float) -> None:
+        self.send(name, value, "g")
+
+    def close(self, success: bool) -> None:
+        self.send("run.duration", round((time() - self.start) * 1000), "ms")
+        self.send("run.success", int(success), "g")
+        self.socket.close()
@@ -0,0 +1,235 @@
+import os
+from dataclasses import dataclass, field
+from shlex import quote
+from shutil import which
+from typing import Dict, List, Optional, Sequence, Text, Tuple
+
+from luh3417.compression import Compression
+from luh3417.exclude import Excludes
+from luh3417.luhfs import Location
+from luh3417.progress import format_size
+from luh3417.utils import LuhError
+
+FILES_PER_STREAM = 5000
+MAX_STREAMS = 8
+
+# Rough compression ratios used to estimate the size of the archive. Files
+# are mostly media which don't compress, dumps compress very well.
+FILES_RATIO = 0.9
+DB_RATIO = 0.25
+
+
+@dataclass
+class SourceStats:
+    """
+    Cheap statistics about the source of a snapshot: size and number of
+    files, number of CPUs of its host and size of each DB table
+    """
+
+    files_size: int
+    files_count: int
+    cpu_count: int
+    tables: Dict[Text, int] = field(default_factory=dict)
+
+    @property
+    def db_size(self) -> int:
+        """
+        Total size of the DB tables
+        """
+
+        return sum(self.tables.values())
+
+
+def gather_source_stats(
+    source: Location,
+    tables: Optional[Dict[Text, int]],
+    excludes: Optional[Excludes] = None,
+) -> SourceStats:
+    """
+    Gets the statistics of the source in a single round trip. The table
+    sizes must be obtained from the DB beforehand (None if not available).
+    Excluded files are not counted.
+    """
+
+    find_args = " ".join(quote(a) for a in (excludes or Excludes([])).find_args())
+
+    out, err, ret = source.run_script(
+        f"""
+            cd {quote(source.path)} || exit 1
+            find . {find_args} -type f -printf '%s\\n' \\
+                | awk '{{s += $1; n++}} END {{print s + 0, n + 0}}'
+            nproc 2> /dev/null || echo 1
+        """
+    )
+
+    try:
+        if ret:
+            raise ValueError
+        files_size, files_count, cpu_count = (int(x) for x in out.split())
+    except ValueError:
+        raise LuhError(f"Could not gather the statistics of {source}: {err[:1000]}")
+
+    return SourceStats(
+        files_size=files_size,
+        files_count=files_count,
+        cpu_count=cpu_count,
+        tables=tables or {},
+    )
+
+
+def free_space(location: Location) -> Optional[int]:
+    """
+    Free space, in bytes, of the volume where the location is (or will be,
+    if it doesn't exist yet). Returns None if it can't be known.
+    """
+
+    out, err, ret = location.run_script(
+        f"""
+            p={quote(location.path)}
+
+            while [ ! -e "$p" ]
+            do
+                p=$(dirname "$p")
+            done
+
+            df -PB1 "$p" | awk 'NR == 2 {{print $4}}'
+        """
+    )
+
+    try:
+        return int(out) if not ret else None
+    except ValueError:
+        return None
+
+
+def choose_codec() -> Text:
+    """
+    Picks the fastest compression codec available locally
+    """
+
+    for codec in ("zstd", "pigz"):
+        if which(codec):
+            return codec
+
+    return "gzip"
+
+
+def choose_streams(stats: SourceStats) -> int:
+    """
+    Picks the number of copy streams: one per few thousand files, within the
+    limits of both hosts' CPUs
+    """
+
+    cpus = min(stats.cpu_count, os.cpu_count() or 1, MAX_STREAMS)
+    return max(1, min(cpus, stats.files_count // FILES_PER_STREAM))
+
+
+@dataclass
+class Plan:
+    """
+    How a snapshot is going to be done, with the estimated resources it
+    needs. Sizes are in bytes.
+    """
+
+    stats: SourceStats
+    compression: Compression
+    streams: int
+    temp_dir: Optional[Text]
+    temp_needed: int
+    temp_free: Optional[int]
+    archive_size: int
+    backup_free: Optional[int]
+
+    @property
+    def problems(self) -> List[Text]:
+        """
+        Lists the reasons why the snapshot would fail
+        """
+
+        out = []
+
+        if self.temp_free is not None and self.temp_free < self.temp_needed:
+            out.append(
+                f"Not enough space in {self.temp_dir}: "
+                f"{format_size(self.temp_free)} free, "
+                f"{format_size(self.temp_needed)} needed"
+            )
+
+        if self.backup_free is not None and self.backup_free < self.archive_size:
+            out.append(
+                f"Not enough space for the archive: "
+                f"{format_size(self.backup_free)} free, "
+                f"~{format_size(self.archive_size)} needed"
+            )
+
+        return out
+
+    def describe(self) -> Text:
+        """
+        Generates a human-readable description of the plan
+        """
+
+        def size(value):
+            return "unknown" if value is None else format_size(value)
+
+        lines = [
+            f"Files: {self.stats.files_count} ({size(self.stats.files_size)})",
+            f"Database: {len(self.stats.tables)} tables "
+            f"({size(self.stats.db_size)})",
+            f"Compression: {self.compression.codec}",
+            f"Copy streams: {self.streams}",
+            f"Temporary directory: {self.temp_dir} "
+            f"({size(self.temp_needed)} needed, {size(self.temp_free)} free)",
+            f"Estimated archive size: {size(self.archive_size)} "
+            f"({size(self.backup_free)} free)",
+            f"Data to transfer: " f"{size(self.stats.files_size + self.stats.db_size)}",
+        ]
+
+        return "\n".join(lines + [f"Problem: {p}" for p in self.problems])
+
+    def check(self) -> None:
+        """
+        Fails if the snapshot can't be done
+        """
+
+        problems = self.problems
+
+        if problems:
+            raise LuhError(". ".join(problems))
+
+
+def estimate_archive_size(stats: SourceStats, compression: Compression) -> int:
+    """
+    Roughly estimates the size of the archive
+    """
+
+    if compression.codec == "none":
+        return stats.files_size + stats.db_size
+
+    return int(stats.files_size * FILES_RATIO + stats.db_size * DB_RATIO)
+
+
+def choose_temp_dir(
+    candidates: Sequence[Location], needed: int
+) -> Tuple[Optional[Text], Optional[int]]:
+    """
+    Picks the first candidate directory which has enough free space (or the
+    one with the most space if none has enough). Returns its path and its
+    free space.
+    """
+
+    best = None
+
+    for candidate in candidates:
+        free = free_space(candidate)
+
+        if free is None:
+            continue
+
+        if free >= needed:
+            return candidate.path, free
+
+        if best is None or free > best[1]:
+            best = (candidate.path, free)
+
+    return best or (None, None)
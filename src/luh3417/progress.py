@@ -0,0 +1,153 @@
+import os
+from logging import getLogger
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import BinaryIO, Optional, Text
+
+logger = getLogger("luh3417.progress")
+
+PROGRESS_INTERVAL = 10
+CHUNK_SIZE = 1024 * 1024
+
+
+def format_size(size: float) -> Text:
+    """
+    Formats a size in bytes for humans
+    """
+
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+
+        size /= 1024
+
+    return f"{size:.1f} TiB"
+
+
+def format_duration(seconds: float) -> Text:
+    """
+    Formats a duration for humans
+    """
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return f"{hours}h{minutes:02}m"
+    elif minutes:
+        return f"{minutes}m{seconds:02}s"
+    else:
+        return f"{seconds}s"
+
+
+class Progress:
+    """
+    Counts the bytes going through the pipes of a long operation and, while
+    it is running, periodically logs how much was done, the rate and (if the
+    total is estimated) the remaining time.
+
+    Counters are shared between threads, so a single progress can follow
+    several concurrent streams.
+
+    >>> with Progress("Copying files", total=estimate) as progress:
+    >>>     copy_stream(source, dest, progress)
+    """
+
+    def __init__(
+        self,
+        name: Text,
+        total: Optional[int] = None,
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.start = perf_counter()
+        self.thread: Optional[Thread] = None
+
+    def add(self, size: int) -> None:
+        """
+        Counts bytes which went through
+        """
+
+        with self.lock:
+            self.done += size
+
+    def line(self) -> Text:
+        """
+        Generates the progress line
+        """
+
+        elapsed = perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0
+        out = f"{self.name}: {format_size(self.done)}"
+
+        if self.total:
+            percent = min(100, 100 * self.done / self.total)
+            out += f" / ~{format_size(self.total)} ({percent:.0f}%)"
+
+        out += f", {format_size(rate)}/s"
+
+        if self.total and rate and self.done < self.total:
+            out += f", ETA {format_duration((self.total - self.done) / rate)}"
+
+        return out
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            logger.info(self.line())
+
+    def __enter__(self) -> "Progress":
+        self.start = perf_counter()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+
+def copy_stream(
+    source: BinaryIO, dest: BinaryIO, progress: Optional[Progress] = None
+) -> int:
+    """
+    Copies everything from the source to the destination, both being file
+    objects backed by a file descriptor (pipes, files) that were not used
+    for buffered I/O yet. Data goes straight between the descriptors, in big
+    chunks, so the copy costs very little on top of the pipeline itself.
+
+    If the destination is a pipe which gets closed, the copy stops and the
+    source is closed so that the writer on the other side stops as well.
+
+    Returns the number of bytes copied.
+    """
+
+    fd_in = source.fileno()
+    fd_out = dest.fileno()
+    total = 0
+
+    try:
+        while True:
+            chunk = os.read(fd_in, CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            view = memoryview(chunk)
+
+            while view:
+                view = view[os.write(fd_out, view) :]
+
+            total += len(chunk)
+
+            if progress:
+                progress.add(len(chunk))
+    except BrokenPipeError:
+        source.close()
+
+    return total
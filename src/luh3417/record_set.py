@@ -1,6 +1,10 @@
-from dataclasses import dataclass, replace
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 from ipaddress import IPv4Address, IPv6Address, ip_address
-from typing import Dict, List, Optional, Sequence, Text, Union
+from threading import Lock, RLock
+from time import monotonic, sleep
+from typing import Dict, List, Optional, Sequence, Text, Tuple, Union
 
 from libcloud.dns.base import DNSDriver, Record
 from libcloud.dns.base import Zone as CloudZone
@@ -9,6 +13,9 @@ from libcloud.dns.types import RecordType
 
 IpAddress = Union[IPv4Address, IPv6Address, Text]
 
+DNS_WORKERS = 4
+DOMAIN_CACHE_SIZE = 4096
+
 
 class RecordSetError(Exception):
     pass
@@ -16,30 +23,59 @@ class RecordSetError(Exception):
 
 def parse_domain(domain: Union[Text, "Domain"]) -> "Domain":
     """
-    Transforms a domain as a text string into a Domain instance. Calling with
-    a domain will return a copy of the said domain
+    Transforms a domain as a text string into a Domain instance. Domains are
+    immutable and interned: parsing the same text twice gives the same
+    instance, and calling with a domain returns it as is.
+
+    A trailing dot (as found in the data of CNAME records) is ignored and the
+    empty string is the relative name of a zone's apex.
     """
 
     if isinstance(domain, Domain):
-        return replace(domain)
-    else:
-        parts = tuple(p.lower() for p in reversed(domain.split(".")))
+        return domain
 
-        if any(not p for p in parts):
-            raise RecordSetError(f"Domain {domain} does not appear to be valid")
+    return _parse_text(domain)
 
-        return Domain(domain, tuple(p.lower() for p in reversed(domain.split("."))))
 
+@lru_cache(maxsize=DOMAIN_CACHE_SIZE)
+def _parse_text(domain: Text) -> "Domain":
+    """
+    Does the actual parsing of parse_domain()
+    """
 
-@dataclass
+    if not domain:
+        return Domain(domain, ())
+
+    parts = tuple(
+        p.lower()
+        for p in reversed(
+            domain[:-1].split(".") if domain.endswith(".") else domain.split(".")
+        )
+    )
+
+    if any(not p for p in parts):
+        raise RecordSetError(f"Domain {domain} does not appear to be valid")
+
+    return Domain(domain, parts)
+
+
+@dataclass(frozen=True)
 class Domain:
     """
     Lightly-parsed domain name, mostly here to do some basic operations (see
-    below)
+    below).
+
+    The labels are stored lower-case and from the TLD down in `parts`, and
+    joined in `key` (like "org.my.foo.") so that comparing two domains or
+    checking that one contains the other are simple string comparisons.
     """
 
     domain: Text
-    parts: Sequence[Text]
+    parts: Tuple[Text, ...]
+    key: Text = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "key", "".join(f"{p}." for p in self.parts))
 
     def __str__(self):
         """
@@ -53,8 +89,13 @@ class Domain:
         Tests the equality domain-wise (aka case-insensitive)
         """
 
-        other = parse_domain(other)
-        return self.parts == other.parts
+        if other is None:
+            return False
+
+        return self.key == parse_domain(other).key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def contains(self, other: Union[Text, "Domain"]) -> bool:
         """
@@ -62,16 +103,7 @@ class Domain:
         domain
         """
 
-        other = parse_domain(other)
-
-        try:
-            for i, part in enumerate(self.parts):
-                if other.parts[i] != part:
-                    return False
-        except IndexError:
-            return False
-        else:
-            return True
+        return parse_domain(other).key.startswith(self.key)
 
     def truncate(self, other: Union[Text, "Domain"]) -> "Domain":
         """
@@ -88,18 +120,56 @@ class Domain:
                 f"Cannot truncate {other} with {self} because not contained"
             )
 
-        i = 0
+        return parse_domain(".".join(reversed(other.parts[len(self.parts) :])))
+
+
+class ZoneIndex:
+    """
+    Trie of the zones by reversed labels (TLD first), in order to find the
+    zone of a domain with the longest matching suffix in a time which only
+    depends on the number of labels of the domain, and not on the number of
+    zones.
+
+    When several zones have the same domain, the first one wins.
+    """
+
+    def __init__(self, zones: Sequence["Zone"]):
+        self.root: Dict = {}
+
+        for zone in zones:
+            node = self.root
 
-        try:
-            for i, part in enumerate(self.parts):
-                if other.parts[i] != part:
-                    break
-        except IndexError:
-            pass
+            for part in zone.domain.parts:
+                node = node.setdefault(part, {})
 
-        out = other.parts[i + 1 :]
+            node.setdefault(None, zone)
+
+    def find(self, domain: Domain) -> Optional["Zone"]:
+        """
+        Finds the most specific zone containing the domain
+        """
+
+        node = self.root
+        found = node.get(None)
+
+        for part in domain.parts:
+            node = node.get(part)
+
+            if node is None:
+                break
+
+            found = node.get(None, found)
+
+        return found
+
+
+def supports_update(driver: DNSDriver) -> bool:
+    """
+    Tells if the driver implements the update of records (which is optional
+    in libcloud)
+    """
 
-        return Domain(domain=".".join(reversed(out)), parts=tuple(out))
+    return type(driver).update_record is not DNSDriver.update_record
 
 
 def list_or_iterate(obj, word, *args, **kwargs):
@@ -119,12 +189,14 @@ class Zone:
     """
     A DNS zone, represented by its domain (like my.org), a provider (like
     digitalocean) and credentials which is a kwarg dict which will be passed
-    to the constructor of the provider.
+    to the constructor of the provider. Calls to the provider can be limited
+    to `rate_limit` per second.
     """
 
     domain: Domain
     provider: Text
     credentials: Dict[Text, Text]
+    rate_limit: Optional[float] = None
 
     def get_cloud_zone(self, driver: DNSDriver) -> Optional[CloudZone]:
         """
@@ -138,11 +210,27 @@ class Zone:
 
 class RecordSet:
     """
-    A class to manage records by set instead of creating them alone
+    A class to manage records by set instead of creating them alone.
+
+    Changes are first planned for a set of entries (see plan_ips() and
+    plan_alias()) against the listing of their zones, then applied
+    concurrently while respecting the rate limit of each provider account.
+
+    Provider APIs are slow and rate-limited, so for the lifetime of the
+    record set each driver is created once, the zones of each driver are
+    listed once and the records of each zone are listed once. The cached
+    records are then kept up to date as records are created, updated and
+    deleted through the record set.
     """
 
     def __init__(self, zones: Sequence[Zone]):
         self.zones = zones
+        self._zone_index = ZoneIndex(zones)
+        self._drivers: Dict[Tuple, DNSDriver] = {}
+        self._cloud_zones: Dict[Tuple, Dict[Sequence[Text], CloudZone]] = {}
+        self._records: Dict[Tuple, List[Record]] = {}
+        self._limiters: Dict[Tuple, RateLimiter] = {}
+        self._lock = RLock()
 
     def _get_zone_info(self, domain):
         """
@@ -155,7 +243,7 @@ class RecordSet:
             raise RecordSetError(f"Cannot find a zone for {domain}")
 
         driver = self.get_driver(zone)
-        cloud_zone = zone.get_cloud_zone(driver)
+        cloud_zone = self.get_cloud_zone(zone)
 
         if not cloud_zone:
             raise RecordSetError(f"Cannot find the zone for {domain} in the provider")
@@ -166,86 +254,333 @@ class RecordSet:
 
     def get_zone(self, domain: Union[Domain, Text]) -> Optional[Zone]:
         """
-        Given a domain, returns the first matching zone (aka zone which
-        contains the provided domain)
+        Given a domain, returns the most specific zone which contains the
+        provided domain
         """
 
-        domain = parse_domain(domain)
+        return self._zone_index.find(parse_domain(domain))
 
-        for zone in self.zones:
-            if zone.domain.contains(domain):
-                return zone
+    def _driver_key(self, zone: Zone) -> Tuple:
+        """
+        Zones of a same provider account share their driver
+        """
+
+        return zone.provider, tuple(sorted(zone.credentials.items()))
 
     def get_driver(self, zone: Zone) -> DNSDriver:
         """
-        Given a zone, starts the appropriate driver
+        Given a zone, starts the appropriate driver (or returns the one
+        already started for the same provider and credentials)
         """
 
-        cls = get_driver(zone.provider)
-        return cls(**zone.credentials)
+        key = self._driver_key(zone)
 
-    def set_ips(self, domain: Union[Domain, Text], ips: Sequence[IpAddress]):
+        with self._lock:
+            if key not in self._drivers:
+                cls = get_driver(zone.provider)
+                self._drivers[key] = cls(**zone.credentials)
+
+            return self._drivers[key]
+
+    def get_cloud_zone(self, zone: Zone) -> Optional[CloudZone]:
         """
-        Given a domain and a set of IP addresses, defines the correct A and
-        AAAA records while also deleting the extraneous one (and CNAME too)
+        Finds the libcloud zone of this zone in the provider, listing the
+        zones of the provider account only the first time
+        """
+
+        key = self._driver_key(zone)
+
+        with self._lock:
+            if key not in self._cloud_zones:
+                index = {}
+
+                for cloud_zone in list_or_iterate(self.get_driver(zone), "zones"):
+                    try:
+                        index[parse_domain(cloud_zone.domain).parts] = cloud_zone
+                    except RecordSetError:
+                        continue
+
+                self._cloud_zones[key] = index
+
+            return self._cloud_zones[key].get(zone.domain.parts)
+
+    def get_records(self, driver: DNSDriver, cloud_zone: CloudZone) -> List[Record]:
         """
+        Lists the records of the zone, from the provider the first time and
+        from the cache afterwards. The returned list can be modified.
+        """
+
+        key = (id(driver), cloud_zone.id)
+
+        with self._lock:
+            if key not in self._records:
+                self._records[key] = list(
+                    list_or_iterate(driver, "records", cloud_zone)
+                )
+
+            return list(self._records[key])
+
+    def create_record(
+        self, driver: DNSDriver, cloud_zone: CloudZone, **kwargs
+    ) -> Record:
+        """
+        Creates a record in the zone and adds it to the cached listing
+        """
+
+        record = driver.create_record(zone=cloud_zone, **kwargs)
+
+        with self._lock:
+            self._records.setdefault((id(driver), cloud_zone.id), []).append(record)
+
+        return record
+
+    def delete_record(self, driver: DNSDriver, record: Record) -> None:
+        """
+        Deletes a record and removes it from the cached listing
+        """
+
+        record.delete()
+
+        with self._lock:
+            records = self._records.get((id(driver), record.zone.id), [])
+            records[:] = [r for r in records if r.id != record.id]
+
+    def update_record(self, driver: DNSDriver, record: Record, **kwargs) -> Record:
+        """
+        Updates a record and replaces it in the cached listing
+        """
+
+        updated = record.update(**kwargs)
 
+        with self._lock:
+            records = self._records.get((id(driver), record.zone.id), [])
+            records[:] = [updated if r.id == record.id else r for r in records]
+
+        return updated
+
+    def get_limiter(self, zone: Zone) -> "RateLimiter":
+        """
+        Gets the rate limiter of the provider account of the zone
+        """
+
+        key = self._driver_key(zone)
+
+        with self._lock:
+            if key not in self._limiters:
+                self._limiters[key] = RateLimiter(zone.rate_limit)
+
+            return self._limiters[key]
+
+    def _find_records(self, domain: Union[Domain, Text]):
+        """
+        Gets the current records of the domain, along with helpers to make
+        changes in its zone: change() and replace(), which gives the changes
+        to replace a record with another data (an update if the provider
+        supports it, otherwise a deletion and a creation).
+        """
+
+        zone = self.get_zone(domain)
         cloud_zone, driver, sub_domain = self._get_zone_info(domain)
+        records = [
+            r
+            for r in self.get_records(driver, cloud_zone)
+            if sub_domain == (r.name or "")
+        ]
+
+        def change(action: Text, type_: Text, data: Text, record=None) -> Change:
+            return Change(
+                action=action,
+                zone=zone,
+                driver=driver,
+                cloud_zone=cloud_zone,
+                name=record.name if record is not None else f"{sub_domain}",
+                type=type_,
+                data=data,
+                record=record,
+            )
+
+        def replace(record: Record, type_: Text, data: Text) -> List[Change]:
+            if supports_update(driver):
+                return [change("update", type_, data, record)]
+
+            return [
+                change("delete", record.type, record.data, record),
+                change("create", type_, data),
+            ]
+
+        return records, change, replace
+
+    def plan_ips(
+        self, domain: Union[Domain, Text], ips: Sequence[IpAddress]
+    ) -> List["Change"]:
+        """
+        Computes the changes which make the domain point to this set of IP
+        addresses with A and AAAA records, while also deleting the
+        extraneous ones (and CNAME too). An extraneous record is updated
+        rather than deleted when an address of its type is missing (if the
+        provider supports updates).
+        """
+
+        records, change, replace = self._find_records(domain)
 
         expected_ips = set(ip_address(ip) for ip in ips)
         found_ips = set()
         to_delete: List[Record] = []
 
-        for record in list_or_iterate(driver, "records", cloud_zone):  # type: Record
-            if sub_domain == record.name:
-                if record.type in {RecordType.A, RecordType.AAAA}:
-                    ip = ip_address(record.data)
-                    found_ips.add(ip)
+        for record in records:  # type: Record
+            if record.type in {RecordType.A, RecordType.AAAA}:
+                ip = ip_address(record.data)
+                found_ips.add(ip)
 
-                    if ip not in expected_ips:
-                        to_delete.append(record)
-                elif record.type == RecordType.CNAME:
+                if ip not in expected_ips:
                     to_delete.append(record)
+            elif record.type == RecordType.CNAME:
+                to_delete.append(record)
 
-        for record in to_delete:
-            record.delete()
+        out = []
 
-        for ip in expected_ips - found_ips:
-            driver.create_record(
-                name=f"{sub_domain}",
-                zone=cloud_zone,
-                type=RecordType.A if ip.version == 4 else RecordType.AAAA,
-                data=f"{ip}",
-            )
+        for ip in sorted(expected_ips - found_ips, key=lambda x: (x.version, x)):
+            type_ = RecordType.A if ip.version == 4 else RecordType.AAAA
+            reusable = [r for r in to_delete if r.type == type_]
 
-    def set_alias(self, domain: Union[Domain, Text], target: Union[Text, Domain]):
+            if reusable:
+                to_delete.remove(reusable[0])
+                out += replace(reusable[0], type_, f"{ip}")
+            else:
+                out.append(change("create", type_, f"{ip}"))
+
+        return [change("delete", r.type, r.data, r) for r in to_delete] + out
+
+    def plan_alias(
+        self, domain: Union[Domain, Text], target: Union[Text, Domain]
+    ) -> List["Change"]:
         """
-        Sets the domain to be an alias. It will first remove any AAAA or A
-        record attached to this domain.
+        Computes the changes which make the domain an alias (a CNAME) of the
+        target, removing any A or AAAA record attached to this domain.
         """
 
-        cloud_zone, driver, sub_domain = self._get_zone_info(domain)
+        records, change, replace = self._find_records(domain)
         target = parse_domain(target)
-        to_delete: List[Record] = []
+        out = []
         to_check: Optional[Record] = None
 
-        for record in list_or_iterate(driver, "records", cloud_zone):  # type: Record
-            if sub_domain == record.name:
-                if record.type in {RecordType.A, RecordType.AAAA}:
-                    to_delete.append(record)
-                elif record.type == RecordType.CNAME:
+        for record in records:  # type: Record
+            if record.type in {RecordType.A, RecordType.AAAA}:
+                out.append(change("delete", record.type, record.data, record))
+            elif record.type == RecordType.CNAME:
+                if to_check:
+                    out.append(change("delete", record.type, record.data, record))
+                else:
                     to_check = record
 
-        for record in to_delete:
-            record.delete()
-
         if to_check:
             if target != to_check.data:
-                to_check.update(data=f"{target}.")
+                out += replace(to_check, RecordType.CNAME, f"{target}.")
         else:
-            driver.create_record(
-                name=f"{sub_domain}",
-                data=f"{target}.",
-                type=RecordType.CNAME,
-                zone=cloud_zone,
+            out.append(change("create", RecordType.CNAME, f"{target}."))
+
+        return out
+
+    def apply_change(self, change: "Change") -> None:
+        """
+        Applies a single change, within the rate limit of its provider
+        """
+
+        self.get_limiter(change.zone).wait()
+
+        if change.action == "delete":
+            self.delete_record(change.driver, change.record)
+        elif change.action == "update":
+            self.update_record(
+                change.driver,
+                change.record,
+                name=change.name,
+                type=change.type,
+                data=change.data,
+            )
+        else:
+            self.create_record(
+                change.driver,
+                change.cloud_zone,
+                name=change.name,
+                type=change.type,
+                data=change.data,
             )
+
+    def apply(self, changes: Sequence["Change"], workers: int = DNS_WORKERS) -> None:
+        """
+        Applies the changes concurrently. Deletions go first, then updates
+        and finally creations, so that a CNAME is never created next to the
+        records it replaces.
+        """
+
+        for action in ("delete", "update", "create"):
+            batch = [c for c in changes if c.action == action]
+
+            if batch:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    list(pool.map(self.apply_change, batch))
+
+    def set_ips(self, domain: Union[Domain, Text], ips: Sequence[IpAddress]):
+        """
+        Given a domain and a set of IP addresses, defines the correct A and
+        AAAA records while also deleting the extraneous one (and CNAME too)
+        """
+
+        self.apply(self.plan_ips(domain, ips))
+
+    def set_alias(self, domain: Union[Domain, Text], target: Union[Text, Domain]):
+        """
+        Sets the domain to be an alias. It will first remove any AAAA or A
+        record attached to this domain.
+        """
+
+        self.apply(self.plan_alias(domain, target))
+
+
+@dataclass
+class Change:
+    """
+    A change to apply to a zone: `create` a record, `update` an existing
+    record or `delete` it
+    """
+
+    action: Text
+    zone: Zone
+    driver: DNSDriver
+    cloud_zone: CloudZone
+    name: Text
+    type: Text
+    data: Text
+    record: Optional[Record] = None
+
+    def __str__(self):
+        domain = f"{self.name}.{self.zone.domain}" if self.name else self.zone.domain
+        return f"{self.action} {domain} {self.type} {self.data}"
+
+
+class RateLimiter:
+    """
+    Spaces out calls so that there are at most `rate` calls per second (no
+    limit if None). This is safe to use from several threads.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        self.interval = 1 / rate if rate else 0
+        self.next = 0.0
+        self.lock = Lock()
+
+    def wait(self) -> None:
+        """
+        Waits until the next call is allowed
+        """
+
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = monotonic()
+            start = max(now, self.next)
+            self.next = start + self.interval
+
+        sleep(start - now)
@@ -0,0 +1,248 @@
+import json
+import os
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from logging import getLogger
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from threading import Lock, get_ident
+from time import perf_counter, time
+from typing import Any, Dict, List, Optional, Sequence, Text
+
+
+def cpu_time(who: int) -> float:
+    """
+    User + system CPU time, in seconds, of this process (RUSAGE_SELF) or of
+    its terminated children (RUSAGE_CHILDREN)
+    """
+
+    usage = getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+@dataclass
+class Phase:
+    """
+    Measures of a phase of the program (one doing() block):
+
+    - `wall` is the duration of the phase, in seconds
+    - `cpu_self` and `cpu_children` are the CPU times spent by this process
+      and by the (local) sub-processes it waited for. Those are process-wide
+      counters, so concurrent phases see each other's CPU time.
+    - `bytes_in` and `bytes_out` are the amounts of data the phase has read
+      and written, as reported by the code running in the phase
+
+    The status is `running` until the phase ends, then `ok` or `error`.
+    """
+
+    logger: Text
+    message: Text
+    start: float = field(default_factory=time)
+    wall: Optional[float] = None
+    cpu_self: Optional[float] = None
+    cpu_children: Optional[float] = None
+    bytes_in: int = 0
+    bytes_out: int = 0
+    status: Text = "running"
+    thread: int = field(default_factory=get_ident)
+
+    def __post_init__(self):
+        self._clock = perf_counter()
+        self._cpu_self = cpu_time(RUSAGE_SELF)
+        self._cpu_children = cpu_time(RUSAGE_CHILDREN)
+
+    def finish(self, status: Text = "ok") -> None:
+        """
+        Marks the end of the phase and computes its measures
+        """
+
+        self.wall = perf_counter() - self._clock
+        self.cpu_self = cpu_time(RUSAGE_SELF) - self._cpu_self
+        self.cpu_children = cpu_time(RUSAGE_CHILDREN) - self._cpu_children
+        self.status = status
+
+    def rate(self, size: int) -> Optional[float]:
+        """
+        Computes the throughput in bytes per second for the given size
+        """
+
+        if self.wall:
+            return size / self.wall
+
+    def as_dict(self) -> Dict:
+        """
+        Exports the phase for the report
+        """
+
+        return {
+            "logger": self.logger,
+            "message": self.message,
+            "start": self.start,
+            "wall": self.wall,
+            "cpu_self": self.cpu_self,
+            "cpu_children": self.cpu_children,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "rate_in": self.rate(self.bytes_in),
+            "rate_out": self.rate(self.bytes_out),
+            "status": self.status,
+        }
+
+
+class Report:
+    """
+    Collects the phases of the program, from any thread, in order to write
+    them as a JSON report or as a Chrome trace (which can be opened in
+    chrome://tracing or https://ui.perfetto.dev/)
+    """
+
+    def __init__(self):
+        self.phases: List[Phase] = []
+        self.values: Dict[Text, float] = {}
+        self.notes: Dict[Text, Any] = {}
+        self.sinks: List = []
+        self.lock = Lock()
+
+    def start(self, logger: Text, message: Text) -> Phase:
+        """
+        Starts and records a new phase
+        """
+
+        phase = Phase(logger, message)
+
+        with self.lock:
+            self.phases.append(phase)
+
+        return phase
+
+    def finish(self, phase: Phase, status: Text = "ok") -> None:
+        """
+        Ends a phase and gives it to the metrics sinks
+        """
+
+        phase.finish(status)
+
+        for sink in self.sinks:
+            sink.phase(phase.as_dict())
+
+    def set_value(self, name: Text, value: float) -> None:
+        """
+        Records a named value of the run (like the size of the archive)
+        """
+
+        with self.lock:
+            self.values[name] = value
+
+        for sink in self.sinks:
+            sink.value(name, value)
+
+    def note(self, name: Text, value: Any) -> None:
+        """
+        Records a choice made during the run (like the settings of a
+        connection), which only goes into the JSON report
+        """
+
+        with self.lock:
+            self.notes[name] = value
+
+    def as_dict(self) -> Dict:
+        """
+        Generates the JSON report
+        """
+
+        with self.lock:
+            phases = list(self.phases)
+            values = dict(self.values)
+            notes = dict(self.notes)
+
+        return {
+            "pid": os.getpid(),
+            "phases": [p.as_dict() for p in phases],
+            "values": values,
+            "notes": notes,
+        }
+
+    def as_trace(self) -> Dict:
+        """
+        Generates the Chrome trace, one complete event per finished phase
+        """
+
+        pid = os.getpid()
+
+        with self.lock:
+            phases = [p for p in self.phases if p.wall is not None]
+
+        return {
+            "traceEvents": [
+                {
+                    "name": p.message,
+                    "cat": p.logger,
+                    "ph": "X",
+                    "ts": int(p.start * 1e6),
+                    "dur": int(p.wall * 1e6),
+                    "pid": pid,
+                    "tid": p.thread,
+                    "args": p.as_dict(),
+                }
+                for p in phases
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def write(self, report_path: Optional[Text], trace_path: Optional[Text]):
+        """
+        Writes the report and/or the trace to the given paths (if not None)
+        """
+
+        for path, content in [(report_path, self.as_dict), (trace_path, self.as_trace)]:
+            if path:
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(content(), f, indent=4)
+
+
+report = Report()
+
+
+def add_report_args(parser: ArgumentParser) -> None:
+    """
+    Adds the --report and --trace options to a CLI parser
+    """
+
+    parser.add_argument(
+        "--report",
+        help=(
+            "Writes a JSON report of the duration, CPU time, bytes and "
+            "throughput of each phase to this file"
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        help="Writes the phases as a Chrome trace (JSON) to this file",
+    )
+
+
+@contextmanager
+def reporting(
+    report_path: Optional[Text], trace_path: Optional[Text], sinks: Sequence = ()
+):
+    """
+    Feeds the metrics sinks (see luh3417.metrics) during the block. When
+    leaving it, even if the program is exiting because of an error, the sinks
+    are closed and the report and trace are written.
+    """
+
+    report.sinks.extend(sinks)
+    success = False
+
+    try:
+        yield
+        success = True
+    finally:
+        for sink in sinks:
+            report.sinks.remove(sink)
+            sink.close(success)
+
+        try:
+            report.write(report_path, trace_path)
+        except OSError as e:
+            getLogger("luh3417.report").error("Could not write report: %s", e)
@@ -2,9 +2,12 @@ import json
 from json import JSONDecodeError
 from typing import Dict, List, Optional, Text
 
-from luh3417.luhfs import Location, parse_location
+from luh3417.exclude import Excludes, make_excludes
+from luh3417.luhfs import Location, RemoteBatch, parse_location
 from luh3417.luhsql import LuhSql, create_root_from_source
-from luh3417.record_set import RecordSet, Zone, parse_domain
+from luh3417.manifest import Manifest, build_manifest, diff_manifests, list_location
+from luh3417.progress import Progress
+from luh3417.record_set import DNS_WORKERS, Change, RecordSet, Zone, parse_domain
 from luh3417.serialized_replace import ReplaceMap
 from luh3417.snapshot import sync_files
 from luh3417.utils import LuhError, escape
@@ -46,16 +49,66 @@ def get_wp_config(config: Dict) -> Dict:
         raise LuhError("Configuration is incomplete, missing wp_config")
 
 
-def restore_files(wp_root: Text, remote: Location):
+def get_excludes(config: Dict) -> Excludes:
     """
-    Restores the file from the local wp_root to the remote location
+    Reads the configuration to extract the exclusion rules: the ones of the
+    patch plus the ones the snapshot was made with, so that the files left
+    out of the snapshot aren't deleted from the target.
+    """
+
+    snapshot_excludes = config.get("args", {}).get("exclude") or []
+
+    return make_excludes(config["exclude"] + snapshot_excludes)
+
+
+def restore_files(
+    wp_root: Text,
+    remote: Location,
+    manifest: Optional[Manifest],
+    streams: int = 1,
+    excludes: Optional[Excludes] = None,
+):
+    """
+    Restores the file from the local wp_root to the remote location. The
+    manifest of the snapshot is compared to a listing of the remote, so that
+    only the files which differ are transferred and the extra ones deleted.
+    The transfer is split into `streams` concurrent rsync. Excluded files are
+    neither sent nor deleted.
+
+    If the snapshot has no manifest, it is built from the extracted files.
+
+    Returns the number of bytes that were sent.
     """
 
     local = parse_location(wp_root)
-    sync_files(local, remote, delete=True)
+
+    if manifest is None:
+        manifest = build_manifest(wp_root, with_hash=False)
+
+    to_send, to_delete = diff_manifests(
+        manifest, list_location(remote, excludes), excludes
+    )
+
+    if to_delete:
+        remote.remove_children(to_delete)
+
+    if to_send:
+        sizes = {path: manifest[path].size for path in to_send}
+        sync_files(
+            local,
+            remote,
+            files=to_send,
+            streams=streams,
+            sizes=sizes,
+            excludes=excludes,
+        )
+
+        return sum(sizes.values())
+
+    return 0
 
 
-def restore_db(db: LuhSql, dump_path: Text):
+def restore_db(db: LuhSql, dump_path: Text, progress: Optional[Progress] = None):
     """
     Restores the specified file into DB, using the wp config and remote
     location to connect the DB.
@@ -63,7 +116,7 @@ def restore_db(db: LuhSql, dump_path: Text):
 
     try:
         with open(dump_path, "r", encoding="utf-8") as f:
-            db.restore_dump(f)
+            db.restore_dump(f, progress)
     except OSError as e:
         raise LuhError(f"Could not read SQL dump: {e}")
 
@@ -108,30 +161,35 @@ def ensure_db_exists(wp_config, mysql_root, source: Location):
     db.run_query(f"grant all on {name}.* to {user}@{host};")
 
 
-def install_outer_files(outer_files: List[Dict], source: Location):
+def install_outer_files(outer_files: List[Dict], source: Location, batch: RemoteBatch):
     """
-    Given the list of outer files, sets the appropriate content to the
-    appropriate location
+    Given the list of outer files, queues in the batch the setting of the
+    appropriate content to the appropriate location
     """
 
     for f in outer_files:
         location = source.child(f["name"])
-        location.set_content(f["content"])
+        batch.set_content(location, f["content"])
 
 
-def run_post_install(post_install: List[Text], source: Location):
+def run_post_install(post_install: List[Text], batch: RemoteBatch):
     """
-    Running the post-install scripts
+    Queues the post-install scripts in the batch. Their failure doesn't stop
+    the restoration.
     """
 
     for script in post_install:
-        source.run_script(script)
+        batch.run_script(script, None)
 
 
-def configure_dns(dns: Dict):
+def configure_dns(dns: Dict, dry_run: bool = False) -> List[Change]:
     """
-    Configures the DNS zones by loading all the zones into RecordSet and then
-    calling RecordSet on all entries to configure them properly
+    Configures the DNS zones by loading all the zones into RecordSet, then
+    planning the changes needed by all entries against the current records
+    of their zones and finally applying them in one batch. With `dry_run`,
+    the changes are only planned.
+
+    Returns the list of planned changes.
     """
 
     zones = []
@@ -141,16 +199,30 @@ def configure_dns(dns: Dict):
         zones.append(Zone(**zone))
 
     rs = RecordSet(zones)
+    changes = []
+    seen = set()
 
     for entry in dns["entries"]:
+        domain = parse_domain(entry["params"]["domain"])
+
+        if domain in seen:
+            raise LuhError(f'Several DNS entries for {entry["params"]["domain"]}')
+
+        seen.add(domain)
+
         if entry["type"] == "alias":
-            func = rs.set_alias
+            func = rs.plan_alias
         elif entry["type"] == "ips":
-            func = rs.set_ips
+            func = rs.plan_ips
         else:
             raise LuhError(f'Unknown entry type {entry["type"]}')
 
-        func(**entry["params"])
+        changes.extend(func(**entry["params"]))
+
+    if not dry_run:
+        rs.apply(changes, workers=dns.get("workers", DNS_WORKERS))
+
+    return changes
 
 
 def patch_config(
@@ -166,7 +238,10 @@ def patch_config(
     - `source`
     - `owner` - Same syntax as chown owner, changes the ownership of restored
       files
-    - `git` - A list of repositories to clone (cf below).
+    - `git` - A list of repositories to clone (cf below). Each entry can be
+      `shallow` to only get the last commit.
+    - `git_cache` - Directory on the target host where bare mirrors of the
+      `git` repositories are kept, to make repeated clones faster
     - `setup_queries` - A list of SQL queries (as strings) that will be
       executed after restoring the DB
     - `php_define` - A dictionary of constant/value to be defined in wp-config
@@ -176,6 +251,9 @@ def patch_config(
     - `outer_files` - Files to place on the host's filesystem
     - `post_install` - A list of Bash scripts to be executed when the install
       is done
+    - `streams` - Number of concurrent rsync streams used to restore files
+    - `exclude` - Patterns of files which are not restored (and not deleted
+      from the target either), in addition to the default ones
 
     Example for the `git` value:
 
@@ -213,6 +291,7 @@ def patch_config(
     base_config = {
         "owner": None,
         "git": [],
+        "git_cache": None,
         "setup_queries": [],
         "php_define": {},
         "replace_in_dump": [],
@@ -220,6 +299,8 @@ def patch_config(
         "outer_files": [],
         "post_install": [],
         "dns": {},
+        "streams": 1,
+        "exclude": [],
     }
 
     for k, v in config.items():
@@ -1,14 +1,23 @@
 from argparse import ArgumentParser, Namespace
-from os.path import join
+from functools import partial
+from os.path import getsize, join
 from tempfile import TemporaryDirectory
+from time import time
 from typing import Optional, Sequence
 
+from luh3417.archive import SnapshotReader
 from luh3417.luhfs import Location, parse_location
 from luh3417.luhphp import set_wp_config_values
 from luh3417.luhsql import create_from_source, patch_sql_dump
+from luh3417.luhssh import SshManager
+from luh3417.manifest import load_manifest, refresh_entry
+from luh3417.metrics import add_metrics_args, make_sinks
+from luh3417.progress import Progress
+from luh3417.report import add_report_args, reporting
 from luh3417.restore import (
     configure_dns,
     ensure_db_exists,
+    get_excludes,
     get_remote,
     get_wp_config,
     install_outer_files,
@@ -20,6 +29,7 @@ from luh3417.restore import (
     run_post_install,
     run_queries,
 )
+from luh3417.scheduler import Scheduler
 from luh3417.utils import make_doer, run_main, setup_logging
 
 doing = make_doer("luh3417.restore")
@@ -41,6 +51,24 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
         help="Allow to restore the backup in-place, overriding its origin",
         action="store_true",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help=(
+            "Maximum number of restoration steps (files, database, DNS, ...) "
+            "running at the same time"
+        ),
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--dns-dry-run",
+        help="Only logs the DNS changes instead of applying them",
+        action="store_true",
+    )
+
+    add_report_args(parser)
+    add_metrics_args(parser)
 
     parser.add_argument(
         "snapshot",
@@ -63,76 +91,166 @@ def main(args: Optional[Sequence[str]] = None):
     args = parse_args(args)
     snap: Location = args.snapshot
 
-    with TemporaryDirectory() as d:
-        with doing("Extracting archive"):
-            snap.extract_archive_to_dir(d)
+    with reporting(args.report, args.trace, make_sinks(args, "restore")):
+        with TemporaryDirectory() as d:
+            with doing("Reading snapshot settings"):
+                reader = SnapshotReader(snap, d)
+                reader.extract("settings.json")
 
-        with doing("Reading configuration"):
-            config = patch_config(
-                read_config(join(d, "settings.json")), args.patch, args.allow_in_place
-            )
+            with doing("Reading configuration"):
+                config = patch_config(
+                    read_config(join(d, "settings.json")),
+                    args.patch,
+                    args.allow_in_place,
+                )
+                remote = get_remote(config)
+                wp_config = get_wp_config(config)
+                SshManager.set_pool_size(config["streams"])
 
-        dump = join(d, "dump.sql")
+            with doing("Extracting archive"):
+                reader.extract("manifest.json", "dump.sql", "wordpress")
 
-        if config["replace_in_dump"]:
-            with doing("Patch the SQL dump"):
-                new_dump = join(d, "dump_patched.sql")
-                patch_sql_dump(
-                    dump, new_dump, make_replace_map(config["replace_in_dump"])
-                )
-                dump = new_dump
+            wp_root = join(d, "wordpress")
+            manifest = load_manifest(join(d, "manifest.json"))
+            scheduler = Scheduler(args.jobs)
 
-        if config["php_define"]:
-            with doing("Patch wp-config.php"):
-                set_wp_config_values(
-                    config["php_define"], join(d, "wordpress", "wp-config.php")
-                )
+            if config["replace_in_dump"]:
+                dump = join(d, "dump_patched.sql")
+            else:
+                dump = join(d, "dump.sql")
+
+            def patch_dump():
+                with doing("Patch the SQL dump"):
+                    patch_sql_dump(
+                        join(d, "dump.sql"),
+                        dump,
+                        make_replace_map(config["replace_in_dump"]),
+                    )
 
-        with doing("Restoring files"):
-            remote = get_remote(config)
-            restore_files(join(d, "wordpress"), remote)
+            def patch_wp_config():
+                with doing("Patch wp-config.php"):
+                    set_wp_config_values(
+                        config["php_define"], join(wp_root, "wp-config.php")
+                    )
+
+                    if manifest is not None:
+                        refresh_entry(manifest, wp_root, "wp-config.php")
+
+            def files():
+                with doing("Restoring files") as phase:
+                    phase.bytes_out = restore_files(
+                        wp_root,
+                        remote,
+                        manifest,
+                        config["streams"],
+                        get_excludes(config),
+                    )
 
-        if config["git"]:
-            with doing("Cloning Git repos"):
-                for repo in config["git"]:
-                    location = remote.child(repo["location"])
-                    location.set_git_repo(repo["repo"], repo["version"])
+            def git_repo(repo):
+                location = remote.child(repo["location"])
+
+                with doing(f"Cloning {repo['repo']}@{repo['version']} to {location}"):
+                    location.set_git_repo(
+                        repo["repo"],
+                        repo["version"],
+                        repo.get("shallow", False),
+                        config["git_cache"],
+                    )
+
+            def owner():
+                with doing("Changing files owner"):
+                    start = time()
+                    changed, total = remote.chown(config["owner"])
                     doing.logger.info(
-                        "Cloned %s@%s to %s", repo["repo"], repo["version"], location
+                        "Changed owner of %s out of %s files in %.1fs",
+                        changed,
+                        total,
+                        time() - start,
                     )
 
-        if config["owner"]:
-            with doing("Changing files owner"):
-                remote.chown(config["owner"])
+            def ensure_db():
+                with doing("Ensuring that DB and user exist"):
+                    ensure_db_exists(wp_config, config["mysql_root"], remote)
+
+            def database():
+                with doing("Restoring DB") as phase:
+                    db = create_from_source(wp_config, remote)
+
+                    with Progress("Restoring DB", getsize(dump)) as progress:
+                        restore_db(db, dump, progress)
+
+                    phase.bytes_out = progress.done
+
+                if config["setup_queries"]:
+                    with doing("Running setup queries"):
+                        run_queries(db, config["setup_queries"])
+
+            def post_install():
+                with doing("Creating outer files and running post install scripts"):
+                    batch = remote.batch()
+                    install_outer_files(config["outer_files"], remote, batch)
+                    run_post_install(config["post_install"], batch)
+                    results = batch.run()
+
+                    for script, result in zip(
+                        config["post_install"], results[len(config["outer_files"]) :]
+                    ):
+                        if result.ret:
+                            doing.logger.warning(
+                                "Post install script failed: %s\n%s", script, result.err
+                            )
+
+            def dns():
+                with doing("Configuring DNS"):
+                    changes = configure_dns(config["dns"], args.dns_dry_run)
+
+                    for change in changes:
+                        doing.logger.info(
+                            "DNS change%s: %s",
+                            " (dry run)" if args.dns_dry_run else "",
+                            change,
+                        )
+
+            files_deps = []
+            db_deps = []
+            install_deps = ["files", "database"]
+
+            if config["replace_in_dump"]:
+                scheduler.add("patch_dump", patch_dump)
+                db_deps.append("patch_dump")
+
+            if config["php_define"]:
+                scheduler.add("patch_wp_config", patch_wp_config)
+                files_deps.append("patch_wp_config")
+
+            scheduler.add("files", files, after=files_deps)
+
+            git_steps = []
 
-        with doing("Reading WP config"):
-            wp_config = get_wp_config(config)
+            for repo in config["git"]:
+                name = f"git:{repo['location']}"
+                scheduler.add(name, partial(git_repo, repo), after=["files"])
+                git_steps.append(name)
 
-        if config["mysql_root"]:
-            mysql_root = config["mysql_root"]
+            install_deps += git_steps
 
-            with doing("Ensuring that DB and user exist"):
-                ensure_db_exists(wp_config, mysql_root, remote)
+            if config["owner"]:
+                scheduler.add("owner", owner, after=["files"] + git_steps)
+                install_deps.append("owner")
 
-        with doing("Restoring DB"):
-            db = create_from_source(wp_config, remote)
-            restore_db(db, dump)
+            if config["mysql_root"]:
+                scheduler.add("ensure_db", ensure_db)
+                db_deps.append("ensure_db")
 
-        if config["setup_queries"]:
-            with doing("Running setup queries"):
-                run_queries(db, config["setup_queries"])
+            scheduler.add("database", database, after=db_deps)
 
-        if config["outer_files"]:
-            with doing("Creating outer files"):
-                install_outer_files(config["outer_files"], remote)
+            if config["outer_files"] or config["post_install"]:
+                scheduler.add("post_install", post_install, after=install_deps)
 
-        if config["post_install"]:
-            with doing("Running post install scripts"):
-                run_post_install(config["post_install"], remote)
+            if config["dns"]:
+                scheduler.add("dns", dns)
 
-        if config["dns"]:
-            with doing("Configuring DNS"):
-                configure_dns(config["dns"])
+            scheduler.run()
 
 
 def __main__():
@@ -0,0 +1,121 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Sequence, Text
+
+from luh3417.utils import LuhError
+
+
+@dataclass
+class Step:
+    """
+    A unit of work of the scheduler: a blocking function and the names of the
+    steps which must be done before it starts
+    """
+
+    name: Text
+    func: Callable[[], Any]
+    after: Sequence[Text] = ()
+
+
+class StepFailed(Exception):
+    """
+    Wraps the exit of a step (which happens when a doing() block fails, after
+    the error was logged) so it can travel through the event loop
+    """
+
+    def __init__(self, name: Text, code: Any):
+        self.name = name
+        self.code = code
+
+
+class Scheduler:
+    """
+    Runs steps concurrently while respecting their dependencies, so the total
+    duration is the one of the critical path rather than the sum of all steps.
+
+    Steps are blocking functions (most of them wait on SSH or MySQL
+    subprocesses) which are run in a thread pool by an asyncio event loop.
+    At most `jobs` steps run at the same time. When a step fails, no new step
+    is started, the running ones are waited for and the failure is
+    propagated.
+
+    >>> scheduler = Scheduler(jobs=2)
+    >>> scheduler.add("files", restore_files)
+    >>> scheduler.add("db", restore_db)
+    >>> scheduler.add("post_install", post_install, after=["files", "db"])
+    >>> scheduler.run()
+    """
+
+    def __init__(self, jobs: int = 4):
+        if jobs < 1:
+            raise LuhError("The number of jobs must be at least 1")
+
+        self.jobs = jobs
+        self.steps: List[Step] = []
+
+    def add(self, name: Text, func: Callable[[], Any], after: Sequence[Text] = ()):
+        """
+        Adds a step. The steps it depends on must have been added before,
+        which also guarantees that there is no dependency cycle.
+        """
+
+        names = {step.name for step in self.steps}
+
+        if name in names:
+            raise LuhError(f"Step {name} is defined twice")
+
+        for dependency in after:
+            if dependency not in names:
+                raise LuhError(f"Step {name} depends on unknown step {dependency}")
+
+        self.steps.append(Step(name, func, after))
+
+    @staticmethod
+    def _call(step: Step) -> Any:
+        try:
+            return step.func()
+        except SystemExit as e:
+            raise StepFailed(step.name, e.code)
+
+    async def _run(self, loop, executor) -> Dict[Text, Any]:
+        semaphore = asyncio.Semaphore(self.jobs)
+        tasks = {}
+
+        async def run_step(step: Step):
+            await asyncio.gather(*(tasks[name] for name in step.after))
+
+            async with semaphore:
+                return await loop.run_in_executor(executor, self._call, step)
+
+        for step in self.steps:
+            tasks[step.name] = asyncio.ensure_future(run_step(step))
+
+        try:
+            results = await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+
+        return dict(zip(tasks.keys(), results))
+
+    def run(self) -> Dict[Text, Any]:
+        """
+        Runs all the steps and returns their results by name. If a step
+        exited, the program exits with the same code once the running steps
+        are done.
+        """
+
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+
+        try:
+            return loop.run_until_complete(self._run(loop, executor))
+        except StepFailed as e:
+            exit(e.code)
+        finally:
+            executor.shutdown(wait=True)
+            loop.close()
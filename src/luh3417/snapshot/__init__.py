@@ -1,79 +1,360 @@
+import heapq
 import subprocess
-from typing import Sequence, Text
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os.path import dirname
+from tempfile import NamedTemporaryFile, TemporaryFile
+from typing import Callable, Dict, List, Optional, Sequence, Text, Tuple
 
+from luh3417.checkpoint import Checkpoint
+from luh3417.exclude import Excludes
 from luh3417.luhfs import LocalLocation, Location, SshLocation
-from luh3417.luhssh import SshManager
+from luh3417.manifest import Manifest, list_location
+from luh3417.progress import Progress, copy_stream
+from luh3417.throttle import Throttle
 from luh3417.utils import LuhError
 
+MAX_UNITS_PER_STREAM = 64
 
-def sync_files(remote: Location, local: Location, delete: bool = False):
+# When copies can be resumed, the tree is cut into more shards than streams
+# so that less is copied again after an interruption
+SHARDS_PER_STREAM = 8
+
+
+def balance(sizes: Dict[Text, int], streams: int) -> List[List[Text]]:
+    """
+    Spreads the paths into at most `streams` shards of similar total size,
+    putting the biggest paths first into the lightest shard.
+    """
+
+    shards = [(0, i, []) for i in range(0, streams)]
+
+    for path in sorted(sizes, key=lambda p: sizes[p], reverse=True):
+        total, i, paths = heapq.heappop(shards)
+        paths.append(path)
+        heapq.heappush(shards, (total + sizes[path], i, paths))
+
+    return [paths for _, _, paths in sorted(shards, key=lambda s: s[1]) if paths]
+
+
+def make_tree_shards(
+    listing: Manifest, streams: int
+) -> Tuple[List[List[Text]], List[Text]]:
+    """
+    Partitions a tree into shards, each shard being a list of files and
+    directories to be copied recursively.
+
+    The tree is first split by top-level entries. Then, as long as some
+    directory is too big to be balanced (more than half a shard), it is
+    replaced by its children.
+
+    The directories which were split are returned as well, since their own
+    entries (mode, owner, times) must still be copied without recursion.
+    """
+
+    children: Dict[Text, List[Text]] = {}
+    totals: Dict[Text, int] = {}
+
+    for path, entry in listing.items():
+        parent = dirname(path)
+        children.setdefault(parent, []).append(path)
+        totals[path] = totals.get(path, 0) + entry.size
+
+        while parent:
+            totals[parent] = totals.get(parent, 0) + entry.size
+            parent = dirname(parent)
+
+    target = sum(e.size for e in listing.values()) / streams / 2
+    units = {path: totals[path] for path in children.get("", [])}
+    split = []
+
+    while len(units) < streams * MAX_UNITS_PER_STREAM:
+        big = [
+            p
+            for p, size in units.items()
+            if size > target and listing[p].type == "d" and children.get(p)
+        ]
+
+        if not big:
+            break
+
+        for path in big:
+            del units[path]
+            split.append(path)
+            units.update({child: totals[child] for child in children[path]})
+
+    return balance(units, streams), sorted(split)
+
+
+def run_parallel(
+    tasks: Sequence[Callable[[], None]], workers: Optional[int] = None
+) -> None:
+    """
+    Runs the tasks in as many threads (or in the given number of threads)
+    and waits for all of them to finish, then raises the first error that
+    happened (if any)
+    """
+
+    if len(tasks) <= 1:
+        for task in tasks:
+            task()
+
+        return
+
+    with ThreadPoolExecutor(max_workers=min(workers or len(tasks), len(tasks))) as pool:
+        futures = [pool.submit(task) for task in tasks]
+
+    for future in futures:
+        future.result()
+
+
+def _rsh_args(*locations: Location) -> List[Text]:
+    """
+    Makes rsync go through the SSH master connection of the remote location.
+    That connection isn't compressed since rsync compresses by itself.
+    """
+
+    for location in locations:
+        if isinstance(location, SshLocation):
+            return ["-e", location.ssh_manager("binary").get_rsh()]
+
+    return []
+
+
+def sync_files(
+    remote: Location,
+    local: Location,
+    delete: bool = False,
+    files: Optional[Sequence[Text]] = None,
+    streams: int = 1,
+    sizes: Optional[Dict[Text, int]] = None,
+    excludes: Optional[Excludes] = None,
+):
     """
-    Use rsync to copy files from a location to another
+    Use rsync to copy files from a location to another. Modification times
+    are preserved so that later syncs can rely on rsync's quick check.
+    Excluded files are not sent (nor deleted from the destination).
+
+    If a list of files (relative to the source) is given, only those are
+    copied, without recursion, which is how manifest-based delta transfers
+    are done. This list can then be split into several concurrent rsync
+    streams, balanced using the sizes of the files if provided.
     """
 
     local.ensure_exists_as_dir()
 
-    args = [
-        "rsync",
-        "-rz",
-        "--exclude=.git",
-        "--exclude=.idea",
-        "--exclude=*.swp",
-        "--exclude=*.un~",
-    ]
+    if excludes is None:
+        excludes = Excludes()
+
+    if files and streams > 1:
+        shards = balance({f: (sizes or {}).get(f, 1) for f in files}, streams)
+        return run_parallel(
+            [
+                partial(sync_files, remote, local, files=shard, excludes=excludes)
+                for shard in shards
+            ]
+        )
+
+    args = ["rsync", "-ltz"] + excludes.rsync_args() + _rsh_args(remote, local)
 
-    if delete:
-        args.append("--delete")
+    with NamedTemporaryFile(mode="wb") as files_from:
+        if files is None:
+            args.append("-r")
+        else:
+            files_from.write(
+                b"".join(f.encode("utf-8", "surrogateescape") + b"\0" for f in files)
+            )
+            files_from.flush()
+            args += ["--from0", f"--files-from={files_from.name}"]
 
-    args += [remote.rsync_path(True), local.rsync_path(True)]
+        if delete:
+            args.append("--delete")
 
-    cp = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        args += [remote.rsync_path(True), local.rsync_path(True)]
+
+        cp = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
     if cp.returncode:
         raise LuhError(f"Error while copying files: {cp.stderr}")
 
 
-def _build_args(location: Location, args: Sequence[Text]) -> Sequence[Text]:
+def _build_args(
+    location: Location, args: Sequence[Text], payload: Text = "control"
+) -> Sequence[Text]:
     """
-    Builds args to use either with SSH either straight
+    Builds args to use either with SSH (tuned for the payload) either straight
     """
 
     if isinstance(location, LocalLocation):
         return args
     elif isinstance(location, SshLocation):
-        return SshManager.instance(location.user, location.host).get_args(args)
+        return location.ssh_manager(payload).get_args(args)
 
 
-def copy_files(remote: Location, local: Location):
+def copy_files(
+    remote: Location,
+    local: Location,
+    streams: int = 1,
+    excludes: Optional[Excludes] = None,
+    throttle: Optional[Throttle] = None,
+    progress: Optional[Progress] = None,
+    checkpoint: Optional[Checkpoint] = None,
+):
     """
     Copies files from the remote location to the local locations. Files are
     serialized and pipelined through tar, maybe locally, maybe through SSH
-    depending on the locations.
+    depending on the locations. Excluded files are skipped by the remote tar.
+
+    With several streams, the remote tree is listed and split into shards of
+    similar size which are copied by concurrent tar pipelines, all of them
+    going through the same SSH master connection.
+
+    The remote tar runs with the priorities of the throttle, if any, and its
+    bandwidth limit is shared between the streams.
+
+    If a progress is given, the bytes of the tar streams are counted into it.
+
+    With a checkpoint, the tree is always split into shards (several per
+    stream), which are recorded along with the shards that were copied. A
+    copy interrupted by a failure can then be resumed by copying the other
+    shards only.
+
+    Once the shards are copied, a last pass copies whatever isn't named by
+    them, which are the files created since the listing (possibly by a
+    previous run). Directories which were split between shards are copied
+    after that, without recursion, so that their permissions and times are
+    kept as well.
     """
 
-    remote_args = _build_args(
-        remote, ["tar", "--warning=no-file-changed", "-C", remote.path, "-c", "."]
-    )
     local_args_1 = _build_args(local, ["mkdir", "-p", local.path])
-    local_args_2 = _build_args(local, ["tar", "-C", local.path, "-x"])
 
     cp = subprocess.run(local_args_1, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
     if cp.returncode:
         raise LuhError(f'Error while creating target dir "{local}": {cp.stderr}')
 
-    remote_p = subprocess.Popen(
-        remote_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    local_p = subprocess.Popen(
-        local_args_2,
-        stdin=remote_p.stdout,
-        stderr=subprocess.PIPE,
-        stdout=subprocess.DEVNULL,
+    if excludes is None:
+        excludes = Excludes()
+
+    dirs = []
+
+    if checkpoint:
+        shards = checkpoint.get("shards")
+        dirs = checkpoint.get("dirs", [])
+
+        if shards is None:
+            listing = list_location(remote, excludes)
+            shards, dirs = make_tree_shards(listing, streams * SHARDS_PER_STREAM)
+            shards = shards or [None]
+            checkpoint.set("dirs", dirs)
+            checkpoint.set("shards", shards)
+    elif streams > 1:
+        listing = list_location(remote, excludes)
+        shards, dirs = make_tree_shards(listing, streams)
+        shards = shards or [None]
+    else:
+        shards = [None]
+
+    if throttle is None:
+        throttle = Throttle()
+
+    rate = throttle.bwlimit and max(1, throttle.bwlimit // min(streams, len(shards)))
+
+    def copy_shard(i: int, shard: Optional[List[Text]]):
+        _copy_shard(remote, local, shard, excludes, throttle, rate, progress)
+
+        if checkpoint:
+            checkpoint.mark_done("shards", i)
+
+    run_parallel(
+        [
+            partial(copy_shard, i, shard)
+            for i, shard in enumerate(shards)
+            if not checkpoint or not checkpoint.is_done("shards", i)
+        ],
+        streams,
     )
 
-    remote_p.wait()
-    local_p.wait()
+    if shards != [None]:
+        named = [path for shard in shards for path in shard]
+        _copy_shard(remote, local, None, excludes, throttle, rate, progress, skip=named)
+
+    if dirs and not (checkpoint and checkpoint.is_done("dirs")):
+        _copy_shard(remote, local, dirs, excludes, throttle, rate, progress, False)
+
+        if checkpoint:
+            checkpoint.mark_done("dirs")
+
+
+def _copy_shard(
+    remote: Location,
+    local: Location,
+    files: Optional[List[Text]],
+    excludes: Excludes,
+    throttle: Throttle,
+    rate: Optional[int],
+    progress: Optional[Progress] = None,
+    recursive: bool = True,
+    skip: Sequence[Text] = (),
+):
+    """
+    Copies the specified files (or everything but the skipped paths if None)
+    from the remote to the local location through a tar pipeline, the remote
+    tar being throttled and limited to the given rate (in KiB/s). With a
+    progress, the stream goes through this process in order to be counted.
+
+    Listed files which vanished since the listing (caches, temporary uploads)
+    are skipped with a warning instead of failing the copy.
+    """
+
+    remote_args = ["tar", "--warning=no-file-changed", "-C", remote.path]
+    remote_args += excludes.tar_args()
+
+    if files is None:
+        # Skipped paths are read one per line, so names with a newline can't
+        # be skipped (they're copied again instead)
+        names = [f"./{f}\n" for f in skip if "\n" not in f]
+
+        if names:
+            remote_args += ["--anchored", "--no-wildcards", "-X", "-"]
+
+        remote_args += ["-c", "."]
+    else:
+        names = [f"./{f}\0" for f in files]
+        remote_args += ["--ignore-failed-read"]
+
+        if not recursive:
+            remote_args += ["--no-recursion"]
+
+        remote_args += ["--null", "-T", "-", "-c"]
+
+    remote_args = _build_args(remote, throttle.wrap(remote_args, rate), "binary")
+    local_args_2 = _build_args(local, ["tar", "-C", local.path, "-x"], "binary")
+
+    with TemporaryFile() as file_list:
+        file_list.write("".join(names).encode("utf-8", "surrogateescape"))
+        file_list.seek(0)
+
+        remote_p = subprocess.Popen(
+            remote_args,
+            stdin=file_list,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        local_p = subprocess.Popen(
+            local_args_2,
+            stdin=subprocess.PIPE if progress else remote_p.stdout,
+            stderr=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+        )
+
+        if progress:
+            copy_stream(remote_p.stdout, local_p.stdin, progress)
+            local_p.stdin.close()
+
+        remote_p.stdout.close()
+        remote_p.wait()
+        local_p.wait()
 
     if remote_p.returncode:
         err = remote_p.stderr.read(1000)
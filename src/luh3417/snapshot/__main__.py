@@ -1,18 +1,48 @@
 import json
+import os
+import shutil
 from argparse import ArgumentParser, Namespace
+from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime
-from os.path import join
-from tempfile import TemporaryDirectory
-from typing import Dict, Optional, Sequence, Text
-
-from luh3417.luhfs import Location, parse_location
+from hashlib import sha1
+from os.path import dirname, getsize, isdir, join
+from tempfile import TemporaryDirectory, gettempdir
+from typing import Dict, Iterator, List, Optional, Sequence, Text, Tuple
+
+from luh3417.archive import ARCHIVE_FORMATS, pack_parts, write_indexed_archive
+from luh3417.checkpoint import Checkpoint
+from luh3417.compression import CODECS, MEDIA_POLICIES, Compression
+from luh3417.exclude import Excludes, make_excludes
+from luh3417.luhfs import LocalLocation, Location, parse_location
 from luh3417.luhphp import parse_wp_config
 from luh3417.luhsql import create_from_source
+from luh3417.luhssh import SshManager
+from luh3417.manifest import build_manifest, save_manifest
+from luh3417.metrics import add_metrics_args, make_sinks
+from luh3417.plan import (
+    Plan,
+    choose_codec,
+    choose_streams,
+    choose_temp_dir,
+    estimate_archive_size,
+    free_space,
+    gather_source_stats,
+)
+from luh3417.progress import Progress
+from luh3417.report import add_report_args, report, reporting
 from luh3417.snapshot import copy_files
-from luh3417.utils import make_doer, run_main, setup_logging
+from luh3417.throttle import IONICE_CLASSES, Throttle
+from luh3417.utils import LuhError, make_doer, run_main, setup_logging
 
 doing = make_doer("luh3417.snapshot")
 
+CHECKPOINT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# Files of the work dir which are not part of the snapshot: the checkpoint
+# and whatever was being written when a previous run was interrupted
+WORK_FILES = ("/checkpoint.json", "/*.tmp")
+
 
 def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     """
@@ -46,11 +76,242 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     parser.add_argument(
         "-t",
         "--file-name-template",
-        help="Template for snapshot file name. Defaults to: `{base}_{time}.tar.gz`",
-        default="{base}_{time}.tar.gz",
+        help=(
+            "Template for snapshot file name. Defaults to: `{base}_{time}{ext}` "
+            "where `{ext}` depends on the compression (by example `.tar.gz`)"
+        ),
+        default="{base}_{time}{ext}",
+    )
+    parser.add_argument(
+        "-c",
+        "--compression",
+        help=(
+            "Compression codec of the archive. Defaults to the fastest one "
+            "available: zstd, pigz or gzip."
+        ),
+        choices=CODECS,
+    )
+    parser.add_argument(
+        "-l",
+        "--compression-level",
+        help="Compression level, defaults to the codec's default",
+        type=int,
+    )
+    parser.add_argument(
+        "--compression-threads",
+        help=(
+            "Number of threads for pigz, zstd and xz. Defaults to 0, which "
+            "means all the cores"
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--media",
+        help=(
+            "What to do with media files (images, videos, ...), which are "
+            "already compressed: `compress` them with the rest or `store` "
+            "them uncompressed. Defaults to compress."
+        ),
+        choices=MEDIA_POLICIES,
+        default="compress",
+    )
+    parser.add_argument(
+        "-s",
+        "--streams",
+        help=(
+            "Number of concurrent streams used to copy files. With more than "
+            "one, the files tree is split into shards of similar size. "
+            "Defaults to one per 5000 files, within the number of CPUs."
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        help=(
+            "Pattern of files to exclude from the snapshot, in addition to the "
+            "default ones (.git, .idea, swap files). Can be repeated."
+        ),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "-f",
+        "--archive-format",
+        help=(
+            "Format of the archive. `indexed` archives are TAR files of "
+            "individually compressed parts with an index, which allows to "
+            "read the settings or the dump without reading the whole "
+            "archive. `stream` archives are simple compressed TAR files. "
+            "Defaults to indexed."
+        ),
+        choices=ARCHIVE_FORMATS,
+        default="indexed",
+    )
+    parser.add_argument(
+        "--nice",
+        help="CPU niceness (0 to 19) of the commands reading the source",
+        type=int,
+    )
+    parser.add_argument(
+        "--ionice",
+        help=(
+            "I/O scheduling class of the commands reading the source: "
+            "`best-effort` (with the lowest priority) or `idle`"
+        ),
+        choices=IONICE_CLASSES.keys(),
+    )
+    parser.add_argument(
+        "--bwlimit",
+        help=(
+            "Maximum rate at which files are read from the source, in KiB/s. "
+            "Requires pv on the source host."
+        ),
+        type=int,
+    )
+    parser.add_argument(
+        "--dump-rate",
+        help=(
+            "Maximum rate at which the database is dumped, in KiB/s. Requires "
+            "pv on the source host."
+        ),
+        type=int,
+    )
+
+    parser.add_argument(
+        "--temp-dir",
+        help=(
+            "Directory where the snapshot is prepared. Defaults to the first "
+            "of the system's temporary directories with enough space."
+        ),
+    )
+    parser.add_argument(
+        "--plan",
+        help="Only prints how the snapshot would be done and what it needs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help=(
+            "Keeps the work files of the snapshot if it fails and, if a "
+            "previous run with this option failed, continues from where it "
+            "stopped. The database is then dumped table by table."
+        ),
+        action="store_true",
+    )
+
+    add_report_args(parser)
+    add_metrics_args(parser)
+
+    parsed = parser.parse_args(args)
+
+    try:
+        if parsed.compression:
+            get_compression(parsed)
+
+        get_throttle(parsed)
+    except LuhError as e:
+        parser.error(e.message)
+
+    return parsed
+
+
+def get_compression(args: Namespace) -> Compression:
+    """
+    Generates the compression settings from the arguments
+    """
+
+    return Compression(
+        codec=args.compression,
+        level=args.compression_level,
+        threads=args.compression_threads,
+    )
+
+
+def temp_candidates(args: Namespace) -> List[Text]:
+    """
+    Lists the directories where the snapshot can be prepared
+    """
+
+    if args.temp_dir:
+        return [args.temp_dir]
+    else:
+        return [gettempdir(), "/var/tmp"]
+
+
+def make_plan(args: Namespace, wp_config: Dict) -> Plan:
+    """
+    Gathers the statistics of the source and decides how to do the snapshot:
+    compression codec and copy streams (unless specified) and temporary
+    directory
+    """
+
+    db = create_from_source(wp_config, args.source)
+    stats = gather_source_stats(
+        args.source, db.table_sizes(), make_excludes(args.exclude)
+    )
+
+    compression = Compression(
+        codec=args.compression or choose_codec(),
+        level=args.compression_level,
+        threads=args.compression_threads,
+    )
+    archive_size = estimate_archive_size(stats, compression)
+    temp_needed = stats.files_size + stats.db_size
+
+    if args.archive_format == "indexed" or args.media == "store":
+        temp_needed += archive_size
+
+    candidates = temp_candidates(args)
+    resume_dir = args.resume and find_resume_dir(args)
+
+    # A resumed snapshot continues in its work directory, where part of the
+    # space is already used
+    if resume_dir:
+        candidates = [dirname(resume_dir)]
+        temp_needed = max(0, temp_needed - disk_usage(resume_dir))
+
+    temp_dir, temp_free = choose_temp_dir(
+        [LocalLocation(c) for c in candidates], temp_needed
+    )
+
+    return Plan(
+        stats=stats,
+        compression=compression,
+        streams=args.streams or choose_streams(stats),
+        temp_dir=temp_dir,
+        temp_needed=temp_needed,
+        temp_free=temp_free,
+        archive_size=archive_size,
+        backup_free=free_space(args.backup_dir),
     )
 
-    return parser.parse_args(args)
+
+def get_throttle(args: Namespace) -> Throttle:
+    """
+    Generates the throttling settings from the arguments
+    """
+
+    return Throttle(
+        nice=args.nice,
+        ionice=args.ionice,
+        bwlimit=args.bwlimit,
+        dump_rate=args.dump_rate,
+    )
+
+
+def get_extension(args: Namespace) -> Text:
+    """
+    Computes the archive's file extension. For indexed archives and when
+    media are stored, the archive is split into individually compressed parts
+    so the outer TAR itself isn't compressed.
+    """
+
+    if args.archive_format == "indexed" or args.media == "store":
+        return ".tar"
+
+    return ".tar" + get_compression(args).extension
 
 
 def make_dump_file_name(args: Namespace, wp_config: Dict, now: datetime) -> Location:
@@ -63,7 +324,9 @@ def make_dump_file_name(args: Namespace, wp_config: Dict, now: datetime) -> Loca
     else:
         base_name = args.snapshot_base_name
 
-    name = args.file_name_template.format(base=base_name, time=now.isoformat() + "Z")
+    name = args.file_name_template.format(
+        base=base_name, time=now.isoformat() + "Z", ext=get_extension(args)
+    )
 
     return args.backup_dir.child(name)
 
@@ -83,6 +346,97 @@ def dump_settings(args: Namespace, wp_config: Dict, now: datetime, file_path: Te
         json.dump(content, f, indent=4)
 
 
+def resume_dir_name(args: Namespace) -> Text:
+    """
+    Name of the work directory of a resumable snapshot, after its source
+    """
+
+    return "luh3417-snapshot-" + sha1(f"{args.source}".encode()).hexdigest()[:16]
+
+
+def find_resume_dir(args: Namespace) -> Optional[Text]:
+    """
+    Finds the work directory left by a previous run of a resumable snapshot
+    in any of the temporary directories
+    """
+
+    paths = [join(c, resume_dir_name(args)) for c in temp_candidates(args)]
+    return next((p for p in paths if isdir(p)), None)
+
+
+def disk_usage(path: Text) -> int:
+    """
+    Size, in bytes, of the files of a local directory
+    """
+
+    total = 0
+
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(join(root, name)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+@contextmanager
+def work_dir(args: Namespace, plan: Plan) -> Iterator[Text]:
+    """
+    Provides the directory where the snapshot is prepared. It's a temporary
+    directory unless the snapshot is resumable: then it's named after the
+    source (and found again in any of the temporary directories) and it's
+    only deleted when the snapshot succeeds.
+    """
+
+    if not args.resume:
+        with TemporaryDirectory(dir=plan.temp_dir) as d:
+            yield d
+
+        return
+
+    name = resume_dir_name(args)
+    path = find_resume_dir(args) or join(
+        plan.temp_dir or temp_candidates(args)[0], name
+    )
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    try:
+        yield path
+    except BaseException:
+        doing.logger.warning(
+            "Work files kept in %s, run again with --resume to continue", path
+        )
+        raise
+
+    shutil.rmtree(path)
+
+
+def resume_settings(
+    checkpoint: Checkpoint, now: datetime, compression: Compression
+) -> Tuple[datetime, Compression]:
+    """
+    When resuming a snapshot, the time and compression codec of the first
+    run are used, so that the archive has the same name and its parts are
+    the same. Otherwise they are recorded for the next runs.
+    """
+
+    if not checkpoint.resumed:
+        checkpoint.set("time", now.strftime(CHECKPOINT_TIME_FORMAT))
+        checkpoint.set("codec", compression.codec)
+
+        return now, compression
+
+    doing.logger.info("Resuming snapshot started at %s", checkpoint.get("time"))
+
+    return (
+        datetime.strptime(checkpoint.get("time"), CHECKPOINT_TIME_FORMAT),
+        replace(compression, codec=checkpoint.get("codec")),
+    )
+
+
 def main(args: Optional[Sequence[str]] = None):
     """
     Executes things in order
@@ -91,31 +445,104 @@ def main(args: Optional[Sequence[str]] = None):
     setup_logging()
     args = parse_args(args)
     now = datetime.utcnow()
+    throttle = get_throttle(args)
+
+    with reporting(args.report, args.trace, make_sinks(args, "snapshot")):
+        with doing("Parsing remote configuration"):
+            wp_config = parse_wp_config(args.source)
+
+        with doing("Planning snapshot"):
+            plan = make_plan(args, wp_config)
+            doing.logger.info("Plan:\n%s", plan.describe())
+
+        if args.plan:
+            return None
+
+        with doing("Checking plan"):
+            plan.check()
+            plan.compression.ensure_available()
+
+        args.streams = plan.streams
+        SshManager.set_pool_size(args.streams)
+        compression = plan.compression
+
+        with work_dir(args, plan) as d:
+            work_location = parse_location(d)
+            checkpoint = Checkpoint(join(d, "checkpoint.json") if args.resume else None)
+            resume = checkpoint if args.resume else None
+            now, compression = resume_settings(checkpoint, now, compression)
+            args.compression = compression.codec
+
+            with doing("Saving settings"):
+                dump_settings(args, wp_config, now, join(d, "settings.json"))
+
+            if not checkpoint.is_done("steps", "database"):
+                with doing("Copying database") as phase:
+                    db = create_from_source(wp_config, args.source)
+
+                    total = plan.stats.db_size or None
+
+                    with Progress("Copying database", total) as progress:
+                        db.dump_to_file(join(d, "dump.sql"), throttle, progress, resume)
+
+                    phase.bytes_in = progress.done
+
+                checkpoint.mark_done("steps", "database")
+
+            if not checkpoint.is_done("steps", "files"):
+                with doing("Copying files") as phase:
+                    total = plan.stats.files_size
+
+                    with Progress("Copying files", total) as progress:
+                        copy_files(
+                            args.source,
+                            work_location.child("wordpress"),
+                            args.streams,
+                            make_excludes(args.exclude),
+                            throttle,
+                            progress,
+                            resume,
+                        )
+
+                    phase.bytes_in = progress.done
+
+                checkpoint.mark_done("steps", "files")
+
+            if not checkpoint.is_done("steps", "manifest"):
+                with doing("Building files manifest"):
+                    save_manifest(
+                        build_manifest(join(d, "wordpress")), join(d, "manifest.json")
+                    )
+
+                checkpoint.mark_done("steps", "manifest")
 
-    with doing("Parsing remote configuration"):
-        wp_config = parse_wp_config(args.source)
+            with doing("Writing archive") as phase:
+                args.backup_dir.ensure_exists_as_dir()
+                archive_location = make_dump_file_name(args, wp_config, now)
 
-    with TemporaryDirectory() as d:
-        work_location = parse_location(d)
+                if args.archive_format == "indexed":
+                    pack_parts(d, compression, args.media, checkpoint)
 
-        with doing("Saving settings"):
-            dump_settings(args, wp_config, now, join(d, "settings.json"))
+                    total = sum(getsize(join(d, name)) for name in os.listdir(d))
 
-        with doing("Copying database"):
-            db = create_from_source(wp_config, args.source)
-            db.dump_to_file(join(d, "dump.sql"))
+                    with Progress("Writing archive", total) as progress:
+                        phase.bytes_out = write_indexed_archive(
+                            d, archive_location, progress, resume
+                        )
 
-        with doing("Copying files"):
-            copy_files(args.source, work_location.child("wordpress"))
+                    report.set_value("archive_bytes", phase.bytes_out)
+                else:
+                    if args.media == "store":
+                        pack_parts(d, compression, args.media, checkpoint)
+                        compression = Compression("none")
 
-        with doing("Writing archive"):
-            args.backup_dir.ensure_exists_as_dir()
-            archive_location = make_dump_file_name(args, wp_config, now)
+                    archive_location.archive_local_dir(
+                        d, compression, Excludes(WORK_FILES)
+                    )
 
-            archive_location.archive_local_dir(d)
-            doing.logger.info("Wrote archive %s", archive_location)
+                doing.logger.info("Wrote archive %s", archive_location)
 
-    return archive_location
+        return archive_location
 
 
 def __main__():
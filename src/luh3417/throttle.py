@@ -0,0 +1,62 @@
+from dataclasses import dataclass
+from shlex import quote
+from typing import List, Optional, Sequence, Text
+
+from luh3417.utils import LuhError
+
+IONICE_CLASSES = {"best-effort": ["-c", "2", "-n", "7"], "idle": ["-c", "3"]}
+
+
+@dataclass
+class Throttle:
+    """
+    Limits the resources used by the commands reading the source, so that a
+    snapshot doesn't compete with the live traffic of the host:
+
+    - `nice` is the CPU niceness (from 0 to 19) of the commands
+    - `ionice` is their I/O scheduling class (`best-effort` with the lowest
+      priority or `idle`)
+    - `bwlimit` caps the rate at which files are read, in KiB/s
+    - `dump_rate` caps the rate at which the DB is dumped, in KiB/s
+
+    Limits that are None are not applied.
+    """
+
+    nice: Optional[int] = None
+    ionice: Optional[Text] = None
+    bwlimit: Optional[int] = None
+    dump_rate: Optional[int] = None
+
+    def __post_init__(self):
+        if self.nice is not None and not 0 <= self.nice <= 19:
+            raise LuhError("Niceness must be between 0 and 19")
+
+        if self.ionice is not None and self.ionice not in IONICE_CLASSES:
+            raise LuhError(f"Unknown I/O scheduling class: {self.ionice}")
+
+        for name in ("bwlimit", "dump_rate"):
+            value = getattr(self, name)
+
+            if value is not None and value <= 0:
+                raise LuhError(f"The {name} must be a positive rate in KiB/s")
+
+    def wrap(self, args: Sequence[Text], rate: Optional[int] = None) -> List[Text]:
+        """
+        Wraps the command so that it runs with the configured priorities and
+        its output is limited to the given rate (in KiB/s, using pv, which
+        must be installed on the host running the command)
+        """
+
+        out = list(args)
+
+        if self.ionice:
+            out = ["ionice"] + IONICE_CLASSES[self.ionice] + out
+
+        if self.nice is not None:
+            out = ["nice", "-n", f"{self.nice}"] + out
+
+        if rate:
+            command = " ".join(quote(a) for a in out)
+            out = ["bash", "-c", f"set -o pipefail; {command} | pv -q -L {rate}k"]
+
+        return out
@@ -1,5 +1,5 @@
 from copy import deepcopy
-from typing import Dict, Text
+from typing import Any, Dict, List, Text
 
 from luh3417.luhfs import Location
 from luh3417.utils import LuhError, import_file
@@ -47,3 +47,35 @@ def apply_wp_config(patch: Dict, wp_config: Dict, source: Location) -> Dict:
         raise LuhError(f"Generated wp_config is incorrect: {e}")
     else:
         return new_patch
+
+
+def make_snapshot_args(settings: Dict[Text, Any]) -> List[Text]:
+    """
+    Converts the snapshot settings returned by the generator into snapshot
+    CLI arguments. Keys are the long option names with underscores, by
+    example:
+
+    >>> assert make_snapshot_args({"compression_level": 3}) == [
+    >>>     "--compression-level",
+    >>>     "3",
+    >>> ]
+
+    Lists are repeated options, True is a flag and None/False are ignored.
+    """
+
+    out = []
+
+    for k, v in settings.items():
+        option = "--" + k.replace("_", "-")
+
+        if v is None or v is False:
+            continue
+        elif v is True:
+            out.append(option)
+        elif isinstance(v, (list, tuple)):
+            for item in v:
+                out += [option, f"{item}"]
+        else:
+            out += [option, f"{v}"]
+
+    return out
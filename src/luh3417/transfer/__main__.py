@@ -2,13 +2,15 @@ import json
 from argparse import ArgumentParser, ArgumentTypeError, Namespace
 from os.path import exists
 from tempfile import NamedTemporaryFile
-from typing import Optional, Sequence, Text
+from typing import List, Optional, Sequence, Text
 
 from luh3417.luhfs import parse_location
 from luh3417.luhphp import parse_wp_config
+from luh3417.metrics import add_metrics_args, make_sinks
+from luh3417.report import add_report_args, reporting
 from luh3417.restore.__main__ import main as restore
 from luh3417.snapshot.__main__ import main as snapshot
-from luh3417.transfer import UnknownEnvironment, apply_wp_config
+from luh3417.transfer import UnknownEnvironment, apply_wp_config, make_snapshot_args
 from luh3417.utils import import_file, make_doer, run_main, setup_logging
 
 doing = make_doer("luh3417.transfer")
@@ -83,6 +85,14 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
 
     parser.add_argument("origin", help="Origin environment")
     parser.add_argument("target", help="Target environment")
+    parser.add_argument(
+        "--plan",
+        help="Only prints how the origin would be snapshot and what it needs",
+        action="store_true",
+    )
+
+    add_report_args(parser)
+    add_metrics_args(parser)
 
     parsed = parser.parse_args(args)
 
@@ -104,6 +114,18 @@ def parse_args(args: Optional[Sequence[str]] = None) -> Namespace:
     return parsed
 
 
+def get_snapshot_args(gen, environment: Text) -> List[Text]:
+    """
+    Asks the generator for the snapshot settings of this environment, if it
+    has an opinion on them
+    """
+
+    if not hasattr(gen, "get_snapshot_settings"):
+        return []
+
+    return make_snapshot_args(gen.get_snapshot_settings(environment))
+
+
 def main(args: Optional[Sequence[str]] = None):
     """
     Executes things in order
@@ -112,45 +134,61 @@ def main(args: Optional[Sequence[str]] = None):
     setup_logging()
     args = parse_args(args)
 
-    gen = args.settings_generator
+    with reporting(args.report, args.trace, make_sinks(args, "transfer")):
+        gen = args.settings_generator
 
-    origin_source = parse_location(gen.get_source(args.origin))
-    origin_backup_dir = gen.get_backup_dir(args.origin)
+        origin_source = parse_location(gen.get_source(args.origin))
+        origin_backup_dir = gen.get_backup_dir(args.origin)
 
-    with doing(f"Backing up {args.origin} to {origin_backup_dir}"):
-        origin_archive = snapshot([f"{origin_source}", origin_backup_dir])
+        if args.plan:
+            with doing(f"Planning the backup of {args.origin}"):
+                snapshot(
+                    [f"{origin_source}", origin_backup_dir, "--plan"]
+                    + get_snapshot_args(gen, args.origin)
+                )
 
-    target_backup_dir = gen.get_backup_dir(args.target)
-    target_source = parse_location(gen.get_source(args.target))
+            return
 
-    with doing(f"Checking if {args.target} ({target_source}) already exists"):
-        target_exists = target_source.exists()
+        with doing(f"Backing up {args.origin} to {origin_backup_dir}"):
+            origin_archive = snapshot(
+                [f"{origin_source}", origin_backup_dir]
+                + get_snapshot_args(gen, args.origin)
+            )
 
-    if target_exists:
-        with doing(f"Backing up {args.target} to {target_backup_dir}"):
-            snapshot([f"{target_source}", target_backup_dir])
+        target_backup_dir = gen.get_backup_dir(args.target)
+        target_source = parse_location(gen.get_source(args.target))
 
-    if target_exists:
-        with doing(f"Reading wp_config from {args.target}"):
-            wp_config = parse_wp_config(target_source)
-    else:
-        with doing(f"Generating wp_config for {args.target}"):
-            wp_config = gen.get_wp_config(args.target)
+        with doing(f"Checking if {args.target} ({target_source}) already exists"):
+            target_exists = target_source.exists()
 
-    patch = apply_wp_config(
-        gen.get_patch(args.origin, args.target), wp_config, target_source
-    )
+        if target_exists:
+            with doing(f"Backing up {args.target} to {target_backup_dir}"):
+                snapshot(
+                    [f"{target_source}", target_backup_dir]
+                    + get_snapshot_args(gen, args.target)
+                )
+
+        if target_exists:
+            with doing(f"Reading wp_config from {args.target}"):
+                wp_config = parse_wp_config(target_source)
+        else:
+            with doing(f"Generating wp_config for {args.target}"):
+                wp_config = gen.get_wp_config(args.target)
+
+        patch = apply_wp_config(
+            gen.get_patch(args.origin, args.target), wp_config, target_source
+        )
 
-    with NamedTemporaryFile(mode="w", encoding="utf-8") as pf:
-        json.dump(patch, pf)
-        pf.flush()
+        with NamedTemporaryFile(mode="w", encoding="utf-8") as pf:
+            json.dump(patch, pf)
+            pf.flush()
 
-        with doing(f"Overriding {args.target} with {args.origin}"):
-            restore(["-p", pf.name, f"{origin_archive}"])
+            with doing(f"Overriding {args.target} with {args.origin}"):
+                restore(["-p", pf.name, f"{origin_archive}"])
 
-    if hasattr(gen, "post_exec"):
-        with doing("Running post-exec hook"):
-            gen.post_exec(args.origin, args.target)
+        if hasattr(gen, "post_exec"):
+            with doing("Running post-exec hook"):
+                gen.post_exec(args.origin, args.target)
 
 
 def __main__():
@@ -6,6 +6,8 @@ from typing import Text
 
 import coloredlogs
 
+from luh3417.report import report
+
 random = SystemRandom()
 
 
@@ -39,6 +41,13 @@ def make_doer(name):
     exceptions occurring during execution, displaying them in the logs as well.
 
     If an exception occurs, the program is exited.
+
+    Each doing() block is recorded as a phase of the report (see
+    luh3417.report), which is given to the block so it can add the amount
+    of data it processed:
+
+    >>> with doing("Copying files") as phase:
+    >>>     phase.bytes_in += copy_files()
     """
 
     logger = getLogger(name)
@@ -46,16 +55,21 @@ def make_doer(name):
     @contextmanager
     def doing(message):
         logger.info(message)
+        phase = report.start(name, message)
+        status = "error"
 
         # noinspection PyBroadException
         try:
-            yield
+            yield phase
+            status = "ok"
         except LuhError as e:
             logger.error(e.message)
             exit(1)
         except Exception:
             logger.exception("Unknown error")
             exit(2)
+        finally:
+            report.finish(phase, status)
 
     doing.logger = logger
 
@@ -109,6 +123,8 @@ def run_main(main, doing):
     except BaseException:
         doing.logger.exception("Unknown error")
     finally:
+        from luh3417.luhphp import PhpWorker
         from luh3417.luhssh import SshManager
 
         SshManager.shutdown()
+        PhpWorker.shutdown()
@@ -0,0 +1,5 @@
+import sys
+from os.path import dirname, join
+
+# Lets the tests import the package from a plain checkout as well
+sys.path.insert(0, join(dirname(dirname(__file__)), "src"))
@@ -0,0 +1,195 @@
+import os
+import tarfile
+
+import pytest
+
+from luh3417 import archive
+from luh3417.archive import pack_parts, read_index, write_indexed_archive
+from luh3417.checkpoint import Checkpoint
+from luh3417.compression import Compression
+from luh3417.exclude import Excludes
+from luh3417.luhfs import LocalLocation
+from luh3417.snapshot.__main__ import WORK_FILES
+
+
+class CutPipe:
+    """
+    Progress which breaks the output once enough bytes went through, like a
+    dropped connection would
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.done = 0
+
+    def add(self, size):
+        self.done += size
+
+        if self.done > self.limit:
+            raise BrokenPipeError
+
+
+def make_work_dir(path):
+    path.mkdir()
+    (path / "settings.json").write_text('{"foo": "bar"}')
+    (path / "dump.sql.gz").write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    (path / "wordpress.tar.gz").write_bytes(os.urandom(2 * 1024 * 1024 + 3))
+    (path / "checkpoint.json").write_text("{}")
+    return path
+
+
+def make_wp_work_dir(path):
+    (path / "wordpress" / "wp-content" / "uploads").mkdir(parents=True)
+    (path / "wordpress" / "index.php").write_text("<?php echo 'hello';")
+    (path / "wordpress" / "wp-content" / "uploads" / "a.jpg").write_bytes(b"jpg")
+    (path / "dump.sql").write_text("select 1;")
+    (path / "manifest.json").write_text("{}")
+    return path
+
+
+def tar_names(path):
+    with tarfile.open(path) as tar:
+        return sorted(tar.getnames())
+
+
+def test_indexed_archive_resumes_after_cut_pipe(tmp_path):
+    work_dir = make_work_dir(tmp_path / "work")
+    expected = LocalLocation(str(tmp_path / "expected.tar"))
+    write_indexed_archive(str(work_dir), expected)
+
+    location = LocalLocation(str(tmp_path / "archive.tar"))
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    with pytest.raises(BrokenPipeError):
+        write_indexed_archive(
+            str(work_dir),
+            location,
+            CutPipe(4 * 1024 * 1024),
+            Checkpoint(checkpoint_path),
+        )
+
+    assert os.path.getsize(location.path) < os.path.getsize(expected.path)
+    assert set(Checkpoint(checkpoint_path).get("archive")["index"]) == {
+        "settings.json",
+        "dump.sql.gz",
+    }
+
+    size = write_indexed_archive(
+        str(work_dir), location, None, Checkpoint(checkpoint_path)
+    )
+
+    with open(location.path, "rb") as a, open(expected.path, "rb") as b:
+        assert a.read() == b.read()
+
+    assert size == os.path.getsize(location.path)
+    assert sorted(read_index(location)) == [
+        "dump.sql.gz",
+        "settings.json",
+        "wordpress.tar.gz",
+    ]
+
+
+def test_indexed_archive_restarts_if_file_changed(tmp_path):
+    work_dir = make_work_dir(tmp_path / "work")
+    location = LocalLocation(str(tmp_path / "archive.tar"))
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+
+    with pytest.raises(BrokenPipeError):
+        write_indexed_archive(
+            str(work_dir),
+            location,
+            CutPipe(4 * 1024 * 1024),
+            Checkpoint(checkpoint_path),
+        )
+
+    size = os.path.getsize(location.path)
+
+    with open(location.path, "wb") as f:
+        f.write(os.urandom(size))
+
+    write_indexed_archive(str(work_dir), location, None, Checkpoint(checkpoint_path))
+
+    assert tar_names(location.path) == [
+        "dump.sql.gz",
+        "settings.json",
+        "wordpress.tar.gz",
+    ]
+
+
+def test_stream_archive_leaves_out_work_files(tmp_path):
+    work_dir = make_work_dir(tmp_path / "work")
+    (work_dir / "checkpoint.json.tmp").write_text("{}")
+    (work_dir / ".media.tar.tmp").write_text("")
+    (work_dir / "wordpress").mkdir()
+    (work_dir / "wordpress" / "cache.tmp").write_text("")
+
+    location = LocalLocation(str(tmp_path / "archive.tar.gz"))
+    location.archive_local_dir(str(work_dir), Compression(), Excludes(WORK_FILES))
+
+    assert tar_names(location.path) == [
+        ".",
+        "./dump.sql.gz",
+        "./settings.json",
+        "./wordpress",
+        "./wordpress.tar.gz",
+        "./wordpress/cache.tmp",
+    ]
+
+
+def test_pack_parts_resumes_after_interrupted_delete(tmp_path, monkeypatch):
+    work_dir = make_wp_work_dir(tmp_path)
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+
+    def interrupted_rmtree(path):
+        os.unlink(os.path.join(path, "index.php"))
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(archive, "rmtree", interrupted_rmtree)
+
+    with pytest.raises(KeyboardInterrupt):
+        pack_parts(str(work_dir), Compression(), "store", checkpoint)
+
+    monkeypatch.undo()
+
+    with open(work_dir / "wordpress.tar.gz", "rb") as f:
+        packed = f.read()
+
+    pack_parts(
+        str(work_dir),
+        Compression(),
+        "store",
+        Checkpoint(str(tmp_path / "checkpoint.json")),
+    )
+
+    with open(work_dir / "wordpress.tar.gz", "rb") as f:
+        assert f.read() == packed
+
+    assert not (work_dir / "wordpress").exists()
+    assert "index.php" in tar_names(work_dir / "wordpress.tar.gz")
+    assert tar_names(work_dir / "media.tar") == ["wp-content/uploads/a.jpg"]
+
+
+def test_pack_parts_never_leaves_partial_parts(tmp_path, monkeypatch):
+    work_dir = make_wp_work_dir(tmp_path)
+    tar_file_list = archive.tar_file_list
+
+    def interrupted_tar(root, files, dest, compression):
+        with open(dest, "wb") as f:
+            f.write(b"partial")
+
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(archive, "tar_file_list", interrupted_tar)
+
+    with pytest.raises(KeyboardInterrupt):
+        pack_parts(str(work_dir), Compression(), "store", Checkpoint())
+
+    assert (work_dir / "dump.sql.gz").exists()
+    assert not (work_dir / "dump.sql").exists()
+    assert not (work_dir / "wordpress.tar.gz").exists()
+
+    monkeypatch.setattr(archive, "tar_file_list", tar_file_list)
+    pack_parts(str(work_dir), Compression(), "store", Checkpoint())
+
+    assert "index.php" in tar_names(work_dir / "wordpress.tar.gz")
+    assert not (work_dir / "wordpress").exists()
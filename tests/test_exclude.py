@@ -0,0 +1,44 @@
+import subprocess
+
+import pytest
+
+from luh3417.exclude import Excludes, make_excludes
+
+FILES = [
+    ".git/objects/o",
+    "wp-content/cache/x/f",
+    "wp-content/uploads/cache/g",
+    "a/node_modules/m",
+    "b/k.php",
+    "b/l.php",
+    "b/l.swp",
+    "b/we(ird).txt",
+    "node_modules_top",
+]
+
+
+@pytest.mark.parametrize(
+    "excludes",
+    [
+        Excludes([]),
+        make_excludes(),
+        make_excludes(["node_modules", "/wp-content/cache", "we(ird).txt"]),
+        make_excludes(["/node_modules*", "[!k]*.php", "wp-*/*/cache"]),
+    ],
+)
+def test_find_args_match_python(tmp_path, excludes):
+    for path in FILES:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).touch()
+
+    out = subprocess.run(
+        ["find", "."] + excludes.find_args() + ["-type", "f", "-printf", "%P\\n"],
+        cwd=tmp_path,
+        stdout=subprocess.PIPE,
+        check=True,
+        encoding="utf-8",
+    ).stdout
+
+    assert sorted(out.splitlines()) == sorted(
+        p for p in FILES if not excludes.matches(p)
+    )
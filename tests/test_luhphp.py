@@ -0,0 +1,90 @@
+import json
+import os
+
+import pytest
+
+from luh3417.luhphp import PhpWorker, encode_php_value, parse_php_string
+from luh3417.utils import LuhError
+
+with open(
+    os.path.join(os.path.dirname(__file__), "fixtures", "php_literals.json"),
+    encoding="utf-8",
+) as f:
+    CORPUS = json.load(f)
+
+
+@pytest.mark.parametrize("case", CORPUS["strings"], ids=lambda c: c["php"])
+def test_parse_php_string(case):
+    assert parse_php_string(case["php"]) == case["value"]
+
+
+@pytest.mark.parametrize("case", CORPUS["strings"], ids=lambda c: c["php"])
+def test_encode_php_string_value(case):
+    assert encode_php_value(case["value"]) == case["var_export"]
+
+
+@pytest.mark.parametrize("case", CORPUS["strings"], ids=lambda c: c["php"])
+def test_php_string_round_trip(case):
+    if "\0" not in case["value"]:
+        assert parse_php_string(case["var_export"]) == case["value"]
+
+
+@pytest.mark.parametrize("literal", CORPUS["refused_strings"])
+def test_parse_php_string_refuses(literal):
+    with pytest.raises(LuhError):
+        parse_php_string(literal)
+
+
+@pytest.mark.parametrize("case", CORPUS["values"], ids=lambda c: repr(c["value"]))
+def test_encode_php_value(case):
+    assert encode_php_value(case["value"]) == case["var_export"]
+
+
+@pytest.fixture
+def fake_php(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    def install(script):
+        php = bin_dir / "php"
+        php.write_text(f"#!/bin/bash\n{script}\n")
+        php.chmod(0o755)
+        return PhpWorker()
+
+    yield install
+
+    PhpWorker.shutdown()
+
+
+def test_php_worker_runs_code(fake_php):
+    worker = fake_php(
+        """
+        echo single
+        read -r size
+        head -c "$size" > /dev/null
+        printf '0 5\\nhello'
+        """
+    )
+
+    assert worker.run("<?php echo 'hello';") == "hello"
+    assert worker.process is None
+
+
+def test_php_worker_reports_startup_error(fake_php):
+    worker = fake_php('echo "PHP Fatal error: Unknown extension" >&2; exit 1')
+
+    with pytest.raises(LuhError, match="php exited.*Unknown extension"):
+        worker.run("<?php echo 1;")
+
+    assert worker.process is None
+
+
+def test_php_worker_startup_timeout(fake_php, monkeypatch):
+    worker = fake_php('echo "Loading..." >&2; exec sleep 60')
+    monkeypatch.setattr(PhpWorker, "timeout", 0.5)
+
+    with pytest.raises(LuhError, match=r"no answer after 0.5s.*Loading\.\.\."):
+        worker.run("<?php echo 1;")
+
+    assert worker.process is None
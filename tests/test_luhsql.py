@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from luh3417.luhsql import LuhSql
+from luh3417.progress import Progress
+from luh3417.utils import LuhError
+
+# Fake mysql which warns a lot before reading the dump, more than a pipe can
+# hold, then stores the dump it received
+FAKE_MYSQL = """#!/bin/bash
+head -c 1000000 /dev/zero | tr '\\0' 'w' >&2
+cat > "$FAKE_MYSQL_DUMP"
+[ -z "$FAKE_MYSQL_ERROR" ] || { echo "$FAKE_MYSQL_ERROR" >&2; exit 1; }
+"""
+
+
+@pytest.fixture
+def fake_mysql(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    mysql = bin_dir / "mysql"
+    mysql.write_text(FAKE_MYSQL)
+    mysql.chmod(0o755)
+
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_MYSQL_DUMP", str(tmp_path / "received.sql"))
+    monkeypatch.delenv("FAKE_MYSQL_ERROR", raising=False)
+
+    dump = tmp_path / "dump.sql"
+    dump.write_text("INSERT INTO t VALUES (1);\n" * 100000)
+
+    yield dump
+
+
+def make_db():
+    return LuhSql("localhost", "wp", "", "wp", None, None)
+
+
+def test_restore_dump_with_many_warnings(fake_mysql, tmp_path):
+    with open(fake_mysql, "r", encoding="utf-8") as f, Progress("Test") as progress:
+        make_db().restore_dump(f, progress)
+
+    assert (tmp_path / "received.sql").read_text() == fake_mysql.read_text()
+    assert progress.done == fake_mysql.stat().st_size
+
+
+def test_restore_dump_reports_errors(fake_mysql, monkeypatch):
+    monkeypatch.setenv("FAKE_MYSQL_ERROR", "ERROR 1064 (42000) at line 1")
+
+    with open(fake_mysql, "r", encoding="utf-8") as f:
+        with pytest.raises(LuhError, match="ERROR 1064"):
+            make_db().restore_dump(f, Progress("Test"))
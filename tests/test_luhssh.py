@@ -0,0 +1,212 @@
+import os
+import signal
+from pathlib import Path
+from time import monotonic
+
+import pytest
+
+from luh3417 import luhssh
+from luh3417.luhssh import CIPHERS, SshManager, probe_ciphers
+from luh3417.utils import LuhError
+
+# Fake ssh which only knows about master connections. The "socket" is a file
+# holding the PID of the master, which is alive while the master is up.
+FAKE_SSH = """#!/bin/bash
+for arg in "$@"
+do
+    case "$arg" in
+        ControlPath=*) control="${arg#ControlPath=}";;
+    esac
+done
+
+if [[ " $* " == *" -O check "* ]]
+then
+    [ -e "$control" ] && kill -0 "$(cat "$control")" 2> /dev/null
+    exit $?
+fi
+
+echo master >> "$FAKE_SSH_LOG"
+
+if [ -n "$FAKE_SSH_ERROR" ]
+then
+    echo "$FAKE_SSH_ERROR" >&2
+    exit 255
+fi
+
+if [[ " $* " == *" -f "* ]]
+then
+    (
+        sleep "$FAKE_SSH_DELAY"
+        echo "$BASHPID" > "$control"
+        exec sleep 60
+    ) > /dev/null 2>&1 &
+    exit 0
+fi
+
+sleep "$FAKE_SSH_DELAY"
+[ -n "$FAKE_SSH_HANG" ] && exec sleep 60
+echo "$$" > "$control"
+exec sleep 60
+"""
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    ssh = bin_dir / "ssh"
+    ssh.write_text(FAKE_SSH)
+    ssh.chmod(0o755)
+
+    log = tmp_path / "ssh.log"
+    log.touch()
+
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_SSH_LOG", str(log))
+    monkeypatch.setenv("FAKE_SSH_DELAY", "0.3")
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "run"))
+    monkeypatch.delenv("LUH3417_SSH_PERSIST", raising=False)
+    monkeypatch.delenv("LUH3417_SSH_CIPHER", raising=False)
+
+    yield log
+
+    SshManager.shutdown()
+
+    for control in (tmp_path / "run").glob("luh3417-*/*"):
+        try:
+            os.kill(int(control.read_text()), signal.SIGTERM)
+        except (ValueError, ProcessLookupError):
+            pass
+
+
+def count_masters(log: Path) -> int:
+    return log.read_text().count("master")
+
+
+def test_instance_waits_for_master(fake_ssh):
+    manager = SshManager.instance("user", "host")
+
+    assert manager.is_ready()
+    assert count_masters(fake_ssh) == 1
+    assert SshManager.instance("user", "host") is manager
+
+    control_dir = manager.control_dir
+    SshManager.shutdown()
+
+    assert manager.process.poll() is not None
+    assert not os.path.exists(control_dir)
+
+
+def test_master_error_is_reported(fake_ssh, monkeypatch):
+    monkeypatch.setenv("FAKE_SSH_ERROR", "Permission denied (publickey)")
+
+    with pytest.raises(LuhError, match=r"Permission denied \(publickey\)"):
+        SshManager.instance("user", "host")
+
+
+def test_master_not_ready_times_out(fake_ssh, monkeypatch):
+    monkeypatch.setenv("FAKE_SSH_HANG", "1")
+    monkeypatch.setattr(SshManager, "timeout", 1)
+
+    with pytest.raises(LuhError, match="not ready after 1s"):
+        SshManager.instance("user", "host")
+
+
+def test_persistent_master_is_reused(fake_ssh, monkeypatch):
+    monkeypatch.setenv("LUH3417_SSH_PERSIST", "10m")
+
+    first = SshManager.instance("user", "host")
+    control = first.control
+    SshManager.shutdown()
+
+    assert os.path.exists(control)
+
+    second = SshManager.instance("user", "host")
+
+    assert second.control == control
+    assert second.is_ready()
+    assert count_masters(fake_ssh) == 1
+
+
+def test_stale_persistent_socket_is_replaced(fake_ssh, monkeypatch):
+    monkeypatch.setenv("LUH3417_SSH_PERSIST", "10m")
+
+    manager = SshManager("user", "host", 22)
+    manager.control_dir = SshManager.runtime_dir()
+    Path(manager.control).write_text("999999999")
+
+    manager = SshManager.instance("user", "host")
+
+    assert manager.is_ready()
+    assert count_masters(fake_ssh) == 1
+    assert os.stat(SshManager.runtime_dir()).st_mode & 0o777 == 0o700
+
+
+def test_only_bulk_payloads_are_pooled(fake_ssh, monkeypatch):
+    monkeypatch.setattr(SshManager, "pool_size", 4)
+
+    control = {id(SshManager.instance("user", "host")) for _ in range(0, 4)}
+
+    assert len(control) == 1
+    assert count_masters(fake_ssh) == 1
+
+    binary = {
+        id(SshManager.instance("user", "host", payload="binary")) for _ in range(0, 4)
+    }
+
+    assert len(binary) == 4
+    assert control < binary
+    assert count_masters(fake_ssh) == 4
+
+
+# Fake ssh for cipher probes, which either streams zeroes forever (to a host
+# faster than the probe's time) or never answers
+FAKE_PROBE_SSH = """#!/bin/bash
+echo "$@" >> "$FAKE_SSH_LOG"
+
+if [ -n "$FAKE_SSH_HANG" ]
+then
+    exec sleep 60
+fi
+
+exec cat /dev/zero
+"""
+
+
+@pytest.fixture
+def fake_probe_ssh(fake_ssh, monkeypatch):
+    ssh = Path(os.environ["PATH"].split(":")[0]) / "ssh"
+    ssh.write_text(FAKE_PROBE_SSH)
+    monkeypatch.setattr(luhssh, "PROBE_CONNECT_TIMEOUT", 0.5)
+    monkeypatch.setattr(luhssh, "PROBE_TIME", 0.3)
+
+    yield fake_ssh
+
+
+def test_probe_is_bounded_in_time(fake_probe_ssh):
+    start = monotonic()
+    rates = probe_ciphers("user", "host", 22)
+
+    assert set(rates) == set(CIPHERS)
+    assert all(rate > 0 for rate in rates.values())
+    assert monotonic() - start < 5
+    assert "ConnectTimeout=0.5" in fake_probe_ssh.read_text()
+
+
+def test_probe_gives_up_on_silent_host(fake_probe_ssh, monkeypatch):
+    monkeypatch.setenv("FAKE_SSH_HANG", "1")
+    start = monotonic()
+
+    assert probe_ciphers("user", "host", 22) == {}
+    assert monotonic() - start < 5
+
+
+def test_profile_is_noted_once(fake_ssh, monkeypatch):
+    notes = []
+    monkeypatch.setattr(luhssh.report, "note", lambda name, value: notes.append(name))
+    monkeypatch.setattr(SshManager, "_noted", set())
+
+    for _ in range(0, 3):
+        SshManager.instance("user", "host")
+
+    assert notes == ["ssh.user@host:22.control"]
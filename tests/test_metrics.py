@@ -0,0 +1,60 @@
+import socket
+
+from luh3417.metrics import StatsdSink
+
+
+def receive_all(sock):
+    packets = []
+
+    try:
+        while True:
+            packets.append(sock.recv(65536).decode())
+    except socket.timeout:
+        return packets
+
+
+def test_statsd_sink_sends_tagged_packets():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(0.5)
+
+    try:
+        port = server.getsockname()[1]
+        sink = StatsdSink(f"127.0.0.1:{port}", {"command": "snapshot", "env": "a,b"})
+
+        sink.phase(
+            {
+                "message": "Dumping database",
+                "wall": 1.5,
+                "bytes_in": 10,
+                "bytes_out": 20,
+                "status": "error",
+            }
+        )
+        sink.value("archive_size", 1234)
+        sink.close(True)
+
+        packets = receive_all(server)
+    finally:
+        server.close()
+
+    tags = "command:snapshot,env:a_b"
+    phase_tags = "command:snapshot,env:a_b,phase:dumping_database"
+
+    assert packets[:4] == [
+        f"luh3417.phase.duration:1500|ms|#{phase_tags}",
+        f"luh3417.phase.bytes_in:10|g|#{phase_tags}",
+        f"luh3417.phase.bytes_out:20|g|#{phase_tags}",
+        f"luh3417.phase.errors:1|c|#{phase_tags}",
+    ]
+    assert packets[4] == f"luh3417.archive_size:1234|g|#{tags}"
+    assert packets[5].startswith("luh3417.run.duration:")
+    assert packets[5].endswith(f"|ms|#{tags}")
+    assert packets[6] == f"luh3417.run.success:1|g|#{tags}"
+    assert len(packets) == 7
+
+
+def test_statsd_sink_ignores_unreachable_server():
+    sink = StatsdSink("127.0.0.1:9", {})
+    sink.value("archive_size", 1)
+    sink.close(False)
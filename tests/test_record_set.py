@@ -0,0 +1,166 @@
+from collections import Counter
+
+import pytest
+from libcloud.dns.base import DNSDriver, Record
+from libcloud.dns.drivers.dummy import DummyDNSDriver
+
+from luh3417 import record_set
+from luh3417.record_set import RecordSet, Zone, parse_domain
+
+
+class FakeDriver(DummyDNSDriver):
+    """
+    Dummy driver which counts the API calls and which implements the record
+    operations the dummy driver lacks
+    """
+
+    calls = Counter()
+
+    def __init__(self, *args, **kwargs):
+        self.calls["init"] += 1
+        super().__init__(*args, **kwargs)
+        self.next_id = 0
+
+        for domain in ("my.org", "other.net"):
+            zone = self.create_zone(domain)
+            self.add_record("www", zone, "A", "1.2.3.4")
+
+    def add_record(self, name, zone, type, data):
+        self.next_id += 1
+        record = Record(f"r{self.next_id}", name, type, data, zone, self)
+        self._zones[zone.id]["records"][record.id] = record
+        return record
+
+    def list_zones(self):
+        self.calls["list_zones"] += 1
+        return super().list_zones()
+
+    def list_records(self, zone):
+        self.calls["list_records"] += 1
+        return super().list_records(zone)
+
+    def iterate_zones(self):
+        raise NotImplementedError
+
+    def iterate_records(self, zone):
+        raise NotImplementedError
+
+    def create_record(self, name, zone, type, data, extra=None):
+        self.calls["create"] += 1
+        return self.add_record(name, zone, type, data)
+
+    def delete_record(self, record):
+        self.calls["delete"] += 1
+        del self._zones[record.zone.id]["records"][record.id]
+        return True
+
+    def update_record(self, record, name=None, type=None, data=None, extra=None):
+        self.calls["update"] += 1
+        updated = Record(record.id, name, type, data, record.zone, self)
+        self._zones[record.zone.id]["records"][record.id] = updated
+        return updated
+
+
+@pytest.fixture
+def make_record_set(monkeypatch):
+    FakeDriver.calls.clear()
+
+    def make(driver_class=FakeDriver):
+        monkeypatch.setattr(record_set, "get_driver", lambda provider: driver_class)
+        credentials = {"api_key": "k", "api_secret": "s"}
+
+        return RecordSet(
+            [
+                Zone(parse_domain("my.org"), "dummy", credentials),
+                Zone(parse_domain("other.net"), "dummy", credentials),
+            ]
+        )
+
+    return make
+
+
+def live_records(rs, domain):
+    zone = rs.get_zone(domain)
+    driver = rs.get_driver(zone)
+    cloud_zone = rs.get_cloud_zone(zone)
+
+    return sorted((r.name, r.type, r.data) for r in driver.list_records(cloud_zone))
+
+
+def test_listings_are_cached(make_record_set):
+    rs = make_record_set()
+
+    for i in range(10):
+        rs.set_ips(f"s{i}.my.org", ["1.2.3.4", "::1"])
+        rs.set_alias(f"w{i}.other.net", "lb.my.org")
+
+    assert FakeDriver.calls["init"] == 1
+    assert FakeDriver.calls["list_zones"] == 1
+    assert FakeDriver.calls["list_records"] == 2
+    assert FakeDriver.calls["create"] == 30
+
+
+def test_cache_follows_changes(make_record_set):
+    rs = make_record_set()
+
+    rs.set_ips("s1.my.org", ["1.2.3.4", "::1"])
+    rs.set_ips("s1.my.org", ["5.6.7.8"])
+    rs.set_alias("www.my.org", "lb.my.org")
+    rs.set_alias("www.my.org", "lb2.my.org")
+
+    zone = rs.get_zone("my.org")
+    cached = rs.get_records(rs.get_driver(zone), rs.get_cloud_zone(zone))
+
+    assert FakeDriver.calls["list_records"] == 1
+    assert sorted((r.name, r.type, r.data) for r in cached) == live_records(
+        rs, "my.org"
+    )
+    assert live_records(rs, "my.org") == [
+        ("s1", "A", "5.6.7.8"),
+        ("www", "CNAME", "lb2.my.org."),
+    ]
+
+    # Nothing left to change
+    assert rs.plan_ips("s1.my.org", ["5.6.7.8"]) == []
+    assert rs.plan_alias("www.my.org", "lb2.my.org") == []
+
+
+def test_returned_listing_is_a_copy(make_record_set):
+    rs = make_record_set()
+    zone = rs.get_zone("my.org")
+    driver = rs.get_driver(zone)
+    cloud_zone = rs.get_cloud_zone(zone)
+
+    rs.get_records(driver, cloud_zone).clear()
+
+    assert len(rs.get_records(driver, cloud_zone)) == 1
+
+
+class NoUpdateDriver(FakeDriver):
+    update_record = DNSDriver.update_record
+
+
+def test_replaces_records_without_update_support(make_record_set):
+    rs = make_record_set(NoUpdateDriver)
+
+    rs.set_ips("www.my.org", ["5.6.7.8"])
+    rs.set_alias("www.other.net", "lb.my.org")
+    rs.set_alias("www.other.net", "lb2.my.org")
+
+    assert live_records(rs, "my.org") == [("www", "A", "5.6.7.8")]
+    assert live_records(rs, "other.net") == [("www", "CNAME", "lb2.my.org.")]
+    assert FakeDriver.calls["update"] == 0
+
+
+def test_update_keeps_record_name(make_record_set):
+    rs = make_record_set()
+    zone = rs.get_zone("my.org")
+    driver = rs.get_driver(zone)
+    driver.add_record(None, rs.get_cloud_zone(zone), "A", "1.1.1.1")
+
+    rs.set_ips("my.org", ["2.2.2.2"])
+
+    assert FakeDriver.calls["update"] == 1
+    assert (None, "A", "2.2.2.2") in [
+        (r.name, r.type, r.data) for r in driver.list_records(rs.get_cloud_zone(zone))
+    ]
@@ -0,0 +1,25 @@
+from luh3417.manifest import Entry, diff_manifests
+from luh3417.restore import get_excludes
+
+
+def make_manifest(*paths):
+    return {p: Entry(path=p, type="f", size=1, mtime=0, mode=0o644) for p in paths}
+
+
+def test_snapshot_excludes_are_not_deleted():
+    config = {
+        "args": {"exclude": ["/wp-content/uploads"]},
+        "exclude": ["/wp-content/cache"],
+    }
+    source = make_manifest("index.php")
+    target = make_manifest(
+        "index.php", "wp-content/cache/page.html", "wp-content/uploads/a.jpg", "old.php"
+    )
+
+    assert diff_manifests(source, target, get_excludes(config)) == ([], ["old.php"])
+
+
+def test_old_snapshots_have_no_excludes():
+    config = {"args": {"exclude": None}, "exclude": []}
+
+    assert get_excludes(config).matches("wp-config.php") is False
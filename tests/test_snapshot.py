@@ -0,0 +1,106 @@
+import os
+from unittest.mock import Mock
+
+import luh3417.snapshot.__main__ as snapshot_main
+from luh3417.checkpoint import Checkpoint
+from luh3417.exclude import Excludes
+from luh3417.luhfs import LocalLocation
+from luh3417.manifest import list_location
+from luh3417.snapshot import _copy_shard, copy_files, make_tree_shards
+from luh3417.throttle import Throttle
+
+OLD_TIME = 1000000000
+
+
+def make_site(root):
+    """
+    Creates a tree with one directory big enough to be split between shards
+    """
+
+    uploads = root / "uploads"
+
+    for i in range(0, 8):
+        (uploads / f"{i}").mkdir(parents=True)
+        (uploads / f"{i}" / "image.jpg").write_bytes(b"x" * 1000)
+
+    (root / "index.php").write_text("<?php\n")
+    uploads.chmod(0o750)
+    os.utime(str(uploads), (OLD_TIME, OLD_TIME))
+
+
+def test_make_tree_shards_returns_split_dirs(tmp_path):
+    make_site(tmp_path)
+    shards, dirs = make_tree_shards(list_location(LocalLocation(str(tmp_path))), 4)
+
+    assert dirs == ["uploads"]
+    assert "uploads" not in sum(shards, [])
+    assert sorted(sum(shards, [])) == sorted(
+        ["index.php"] + [f"uploads/{i}" for i in range(0, 8)]
+    )
+
+
+def test_copy_files_keeps_split_dirs(tmp_path):
+    make_site(tmp_path / "source")
+    target = tmp_path / "target"
+
+    copy_files(LocalLocation(str(tmp_path / "source")), LocalLocation(str(target)), 4)
+
+    stat = (target / "uploads").stat()
+    assert stat.st_mode & 0o777 == 0o750
+    assert int(stat.st_mtime) == OLD_TIME
+    assert (target / "uploads" / "7" / "image.jpg").read_bytes() == b"x" * 1000
+
+
+def test_copy_shard_skips_vanished_files(tmp_path):
+    make_site(tmp_path / "source")
+    target = tmp_path / "target"
+    target.mkdir()
+
+    _copy_shard(
+        LocalLocation(str(tmp_path / "source")),
+        LocalLocation(str(target)),
+        ["index.php", "wp-content/cache/gone.html"],
+        Excludes(),
+        Throttle(),
+        None,
+    )
+
+    assert (target / "index.php").read_text() == "<?php\n"
+
+
+def test_resumed_copy_gets_new_files(tmp_path):
+    make_site(tmp_path / "source")
+    source = LocalLocation(str(tmp_path / "source"))
+    target = tmp_path / "target"
+    checkpoint = Checkpoint()
+
+    copy_files(source, LocalLocation(str(target)), 2, checkpoint=checkpoint)
+
+    (tmp_path / "source" / "new.php").write_text("<?php\n")
+    (tmp_path / "source" / "uploads" / "8").mkdir()
+    (tmp_path / "source" / "uploads" / "8" / "image.jpg").write_bytes(b"y")
+    (target / "index.php").unlink()
+
+    copy_files(source, LocalLocation(str(target)), 2, checkpoint=checkpoint)
+
+    assert (target / "new.php").exists()
+    assert (target / "uploads" / "8" / "image.jpg").read_bytes() == b"y"
+    assert not (target / "index.php").exists()
+
+
+def test_resumed_plan_counts_work_dir(tmp_path, monkeypatch):
+    make_site(tmp_path / "source")
+    monkeypatch.setattr(
+        snapshot_main, "create_from_source", lambda *_: Mock(table_sizes=dict)
+    )
+    args = snapshot_main.parse_args(
+        [str(tmp_path / "source"), str(tmp_path), "--temp-dir", str(tmp_path)]
+    )
+    needed = snapshot_main.make_plan(args, {}).temp_needed
+
+    args.resume = True
+    work_dir = tmp_path / snapshot_main.resume_dir_name(args) / "wordpress"
+    work_dir.mkdir(parents=True)
+    (work_dir / "index.php").write_bytes(b"x" * 5000)
+
+    assert snapshot_main.make_plan(args, {}).temp_needed == needed - 5000